@@ -1,22 +1,58 @@
 from __future__ import print_function
-import os, os.path, json, datetime
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, make_response
-from werkzeug import secure_filename
-from app.rxparse import process_pricetable, process_formulary, process_usermatches
+import os, os.path, json, datetime, shutil, time, cProfile, logging, threading
+from flask import Flask, Response, render_template, request, redirect, url_for, send_from_directory, make_response, abort, jsonify, stream_with_context, g
+from werkzeug.utils import secure_filename
+from app.rxparse import process_pricetable, process_formulary, process_usermatches, write_fuzzymatches, read_fuzzymatches
+import app.workspace as ws
+import app.pricehistory as ph
+import app.druglookup as dl
+import app.pricereport as pr
+import app.categorymap as cm
+import app.compaction as ct
+import app.metrics as mt
+import app.eventlog as ev
+from dateutil.parser import parse as parse_date
 
 UPLOAD_FOLDER = 'app/input'
 PERSISTENT_FOLDER = 'app/persistent'
 BACKUP_FOLDER = 'app/markdown-backup'
 OUTPUT_FOLDER = 'app/output'
-ALLOWED_EXTENSIONS = set(['txt','xls','xlsx','csv','tsv','md', 'markdown'])
+WORKSPACE_FOLDER = 'app/workspaces'
+PROFILE_FOLDER = 'app/profiles'
+LOG_FOLDER = 'app/logs'
+ALLOWED_EXTENSIONS = set(['txt','xls','xlsx','ods','csv','tsv','md', 'markdown'])
 PERSISTENT_PRICETABLE_FILENAME = 'persistent-pricetable.tsv'
+PRICE_HISTORY_FILENAME = 'price-history.bin'
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['PERSISTENT_FOLDER'] = PERSISTENT_FOLDER
 app.config['BACKUP_FOLDER'] = BACKUP_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
+app.config['WORKSPACE_FOLDER'] = WORKSPACE_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 100*1024*1024  # Set max upload file size to 100mb
+app.config['MATCH_PAGE_SIZE'] = 100  # Fuzzy matches shown per batch on the selection page
+app.config['PRICE_CHANGE_SIGNIFICANCE'] = pr.SIGNIFICANCE_PERCENT  # Flag price changes of at least this many percent
+app.config['SHOW_TIMINGS'] = os.environ.get('SHOW_TIMINGS') == '1'  # Show a per-stage timing breakdown on the result page
+app.config['PROFILE_FOLDER'] = PROFILE_FOLDER
+# Save a cProfile dump of every request slower than this many seconds, e.g. PROFILE_SLOW_REQUESTS=5
+app.config['PROFILE_SLOW_REQUESTS'] = float(os.environ['PROFILE_SLOW_REQUESTS']) if os.environ.get('PROFILE_SLOW_REQUESTS') else None
+app.config['LOG_FOLDER'] = LOG_FOLDER
+app.config['EVENT_LOG_LEVEL'] = os.environ.get('EVENT_LOG_LEVEL', 'INFO')  # e.g. DEBUG to also log every parsed drug and match
+if not isinstance(logging.getLevelName(app.config['EVENT_LOG_LEVEL'].upper()), int):
+    raise ValueError('EVENT_LOG_LEVEL must be a logging level: DEBUG, INFO, WARNING, ERROR or CRITICAL')
+# Compare invoice medications with the formulary categories mapped to their commodity: first, only or off
+app.config['CATEGORY_MATCHING'] = os.environ.get('CATEGORY_MATCHING', cm.MODE_OFF)
+if app.config['CATEGORY_MATCHING'] not in cm.MODES:
+    raise ValueError('CATEGORY_MATCHING must be one of {}'.format(', '.join(cm.MODES)))
+# Archive pricetable rows older than this many days, or off the formulary for this many uploads in a row (0 to keep)
+app.config['PRICETABLE_MAX_AGE_DAYS'] = int(os.environ.get('PRICETABLE_MAX_AGE_DAYS', ct.MAX_AGE_DAYS))
+app.config['PRICETABLE_MAX_OFF_FORMULARY_RUNS'] = int(os.environ.get('PRICETABLE_MAX_OFF_FORMULARY_RUNS', ct.MAX_OFF_FORMULARY_RUNS))
+
+# In-memory drug lookup, filled on first search and updated after each upload
+drug_index = dl.DrugIndex()
+drug_index_loaded = False
+drug_index_lock = threading.Lock()
 
 
 def json_encode_set(obj):
@@ -25,6 +61,65 @@ def json_encode_set(obj):
     raise TypeError
 
 
+def stream_template(template_name, **context):
+    # Render a template in chunks so the browser can start drawing large pages early
+    app.update_template_context(context)
+    t = app.jinja_env.get_template(template_name)
+    rv = t.stream(context)
+    rv.enable_buffering(5)
+    return rv
+
+
+def start_event_log():
+    # Pipeline events are written as JSON lines to LOG_FOLDER by a background thread, started by the first request
+    ev.configure(app.config['LOG_FOLDER'], logging.getLevelName(app.config['EVENT_LOG_LEVEL'].upper()))
+
+
+@app.before_request
+def start_request_metrics():
+    start_event_log()
+    g.request_start = time.perf_counter()
+    g.profile = None
+    mt.begin_request()
+
+    if app.config['PROFILE_SLOW_REQUESTS'] is not None:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            g.profile = profile
+        except ValueError:
+            pass  # Another profiler is already active
+
+
+@app.after_request
+def record_response_status(resp):
+    g.response_status = resp.status_code
+    return resp
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    # Streamed responses can tear down more than once, so only the first call records the request
+    if g.get('request_start') is None:
+        return
+    elapsed = time.perf_counter() - g.request_start
+    g.request_start = None
+    endpoint = request.endpoint or 'unknown'
+    mt.inc('formulary_http_requests_total', endpoint=endpoint, status=str(g.get('response_status', 500)))
+    mt.inc('formulary_http_request_seconds_total', elapsed, endpoint=endpoint)
+    mt.end_request()
+    ev.clear_context()
+
+    profile = g.get('profile')
+    if profile is not None:
+        profile.disable()
+        if elapsed >= app.config['PROFILE_SLOW_REQUESTS']:
+            if not os.path.isdir(app.config['PROFILE_FOLDER']):
+                os.makedirs(app.config['PROFILE_FOLDER'])
+            profile_filename = '{}_{}_{}ms.prof'.format(datetime.datetime.now().strftime("%Y.%m.%d-%H%M%S"), endpoint, int(1000*elapsed))
+            profile.dump_stats(os.path.join(app.config['PROFILE_FOLDER'], profile_filename))
+
+
 def allowed_file(filename):
     return '.' in filename and \
         filename.rsplit('.',1)[1] in ALLOWED_EXTENSIONS
@@ -42,20 +137,27 @@ def process_file():
     uploaded_files = request.files.getlist("file")
     upload_filepath_list = []
 
-    for file in uploaded_files:
+    # If file is missing, return error and remain on start page
+    if any(file.filename == '' for file in uploaded_files):
+        error_prompt = 'Please check that all files have been selected for upload'
+        return render_template('index.html', error_prompt=error_prompt)
+
+    # Each upload runs in its own workspace so simultaneous uploads do not share files
+    shared_pricetable_path = os.path.join(app.config['PERSISTENT_FOLDER'],PERSISTENT_PRICETABLE_FILENAME)
+    job_id = ws.create_workspace(app.config['WORKSPACE_FOLDER'], shared_pricetable_path)
+    upload_folder = ws.input_folder(app.config['WORKSPACE_FOLDER'], job_id)
+    output_folder = ws.output_folder(app.config['WORKSPACE_FOLDER'], job_id)
+    ev.set_context(job_id=job_id)
 
-        # If file is missing, return error and remain on start page
-        if file.filename == '':  
-            error_prompt = 'Please check that all files have been selected for upload'
-            return render_template('index.html', error_prompt=error_prompt)
+    for file in uploaded_files:
 
         # Save files and create list of file paths
         if file and allowed_file(file.filename):
 
-            # Save files in upload folder
+            # Save files in the workspace upload folder
             filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'],filename))
-            upload_filepath_list.append(os.path.join(app.config['UPLOAD_FOLDER'],filename))
+            file.save(os.path.join(upload_folder,filename))
+            upload_filepath_list.append(os.path.join(upload_folder,filename))
 
             # Also save additional backup of the markdown file with a datetime in filename
             if filename.split('.')[-1] == 'md' or filename.split('.')[-1] == 'markdown':
@@ -63,28 +165,53 @@ def process_file():
                 backup_directory = app.config['BACKUP_FOLDER']
                 num_files = len([f for f in os.listdir(backup_directory) if os.path.isfile(os.path.join(backup_directory,f))])
                 filename_datetime = datetime_string+'_backup_'+filename
-                file.save(os.path.join(backup_directory,filename_datetime))
+                shutil.copyfile(os.path.join(upload_folder,filename), os.path.join(backup_directory,filename_datetime))
 
                 # Only keep 15 most recent backups
                 num_files = len([f for f in os.listdir(backup_directory) if os.path.isfile(os.path.join(backup_directory,f))])
                 if num_files > 15:
-                    first_file = os.listdir(path)[0]
+                    first_file = sorted(f for f in os.listdir(backup_directory) if f != '.gitignore')[0]
                     os.remove(os.path.join(backup_directory,first_file))
 
     formulary_md_path = str(upload_filepath_list[0])
     invoice_path = str(upload_filepath_list[1])
-    pricetable_persist_path = os.path.join(app.config['PERSISTENT_FOLDER'],PERSISTENT_PRICETABLE_FILENAME)
+    pricetable_persist_path = ws.work_pricetable_path(app.config['WORKSPACE_FOLDER'], job_id)
 
     # Run update function for pricetable and formulary and capture fuzzy matches
-    screen_output, output_filename_list, pricetable_output_path = process_pricetable(invoice_path, pricetable_persist_path, verbose_debug=False)
+    price_history_path = os.path.join(app.config['PERSISTENT_FOLDER'],PRICE_HISTORY_FILENAME)
+    screen_output, output_filename_list, pricetable_output_path = process_pricetable(invoice_path, pricetable_persist_path, verbose_debug=False, output_folder=output_folder, history_path=price_history_path)
     
-    pricetable_unmatched_meds, output_filename_list, screen_output, fuzzymatches = process_formulary(pricetable_persist_path, formulary_md_path, output_filename_list, screen_output)
+    category_map_path = os.path.join(app.config['PERSISTENT_FOLDER'],cm.CATEGORY_MAP_FILENAME)
+    pricetable_unmatched_meds, output_filename_list, screen_output, fuzzymatches = process_formulary(pricetable_persist_path, formulary_md_path, output_filename_list, screen_output, output_folder=output_folder, significance_percent=app.config['PRICE_CHANGE_SIGNIFICANCE'], category_map_path=category_map_path, category_mode=app.config['CATEGORY_MATCHING'])
+
+    # Keep fuzzy matches on the server; the selection page only sends back their ids.
+    # They are saved before the commit so that the rows they offer stay in this job's pricetable.
+    matchlist = write_fuzzymatches(fuzzymatches, ws.fuzzymatches_path(app.config['WORKSPACE_FOLDER'], job_id))
+
+    # Merge this job's pricetable changes into the shared pricetable
+    conflicts = ws.commit_pricetable(app.config['WORKSPACE_FOLDER'], job_id, shared_pricetable_path)
+    app.logger.debug('Pricetable merge conflicts: {}'.format(conflicts))
+
+    # Move rows the retention policy marks cold out of the shared pricetable, except those jobs still offer for review
+    offered = ws.live_offered_namedoses(app.config['WORKSPACE_FOLDER'])
+    compaction = ct.compact_pricetable(shared_pricetable_path, app.config['PRICETABLE_MAX_AGE_DAYS'], app.config['PRICETABLE_MAX_OFF_FORMULARY_RUNS'], keep=offered)
+    screen_output.append(['Number of price table entries archived',compaction.ROWS_ARCHIVED])
+    screen_output.append(['Price table bytes reclaimed',compaction.BYTES_RECLAIMED])
+
+    # Keep drug lookup in step with the uploaded formulary and the merged pricetable
+    update_drug_index(formulary_md_path, shared_pricetable_path)
 
     #app.logger.debug(pricetable_unmatched_meds) #debugging
     
+    # Keep the upload's stage timings for the breakdown on the result page
+    mt.write_timings(mt.current_request().snapshot(), ws.timings_path(app.config['WORKSPACE_FOLDER'], job_id))
+
+    page_size = app.config['MATCH_PAGE_SIZE']
+
     # Store output files list, screen output, and unmatched medications as cookies
-    # Render selection.html page
-    resp = make_response(render_template('selection.html', output_filename_list=output_filename_list, screen_output=screen_output, pricetable_unmatched_meds=pricetable_unmatched_meds, fuzzymatches=fuzzymatches))
+    # Stream selection.html page with the first batch of matches, the rest are loaded on request
+    resp = Response(stream_with_context(stream_template('selection.html', output_filename_list=output_filename_list, screen_output=screen_output, pricetable_unmatched_meds=pricetable_unmatched_meds,
+                                                        matches=enumerate(matchlist[:page_size]), next_offset=min(page_size, len(matchlist)), total_matches=len(matchlist))))
 
     json_output_filename_list = json.dumps(output_filename_list)
     json_pricetable_unmatched_meds = json.dumps(pricetable_unmatched_meds, default=json_encode_set)
@@ -93,18 +220,38 @@ def process_file():
     app.logger.debug(json_pricetable_unmatched_meds)  #debugging
     app.logger.debug('Unmatched Medications')  #debugging
 
-    resp.set_cookie('formulary_md_path', formulary_md_path)
+    resp.set_cookie('job_id', job_id)
+    resp.set_cookie('formulary_md_filename', os.path.basename(formulary_md_path))
     resp.set_cookie('output_filename_list', json_output_filename_list)
     resp.set_cookie('screen_output', json_screen_output)
     resp.set_cookie('pricetable_unmatched_meds', json_pricetable_unmatched_meds)
-    resp.set_cookie('pricetable_persist_path', pricetable_persist_path)
-    resp.set_cookie('pricetable_output_path', pricetable_output_path)
     return resp
 
 
-@app.route('/output/<filename>')
-def output_file(filename):
-    return send_from_directory(app.config['OUTPUT_FOLDER'],filename)
+@app.route('/selection/matches')
+def selection_matches():
+    # Next batch of fuzzy matches for the selection page, e.g. /selection/matches?offset=100
+    job_id = request.cookies.get('job_id')
+    if not ws.is_job_id(job_id) or not os.path.isfile(ws.fuzzymatches_path(app.config['WORKSPACE_FOLDER'], job_id)):
+        abort(404)
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        abort(400)
+
+    matchlist = read_fuzzymatches(ws.fuzzymatches_path(app.config['WORKSPACE_FOLDER'], job_id))
+    next_offset = min(offset + app.config['MATCH_PAGE_SIZE'], len(matchlist))
+
+    resp = make_response(render_template('fuzzymatches.html', matches=zip(range(offset, next_offset), matchlist[offset:next_offset])))
+    resp.headers['X-Next-Offset'] = str(next_offset)
+    return resp
+
+
+@app.route('/output/<job_id>/<filename>')
+def output_file(job_id, filename):
+    if not ws.is_job_id(job_id):
+        abort(404)
+    return send_from_directory(ws.output_folder(app.config['WORKSPACE_FOLDER'], job_id),filename)
 
 
 @app.route('/result', methods=['POST'])
@@ -112,9 +259,22 @@ def result():
     json_output_filename_list = request.cookies.get('output_filename_list')
     json_screen_output = request.cookies.get('screen_output')
     json_pricetable_unmatched_meds = request.cookies.get('pricetable_unmatched_meds')
-    formulary_md_path = request.cookies.get('formulary_md_path')
-    pricetable_persist_path = request.cookies.get('pricetable_persist_path')
-    pricetable_output_path = request.cookies.get('pricetable_output_path')
+    job_id = request.cookies.get('job_id')
+    formulary_md_filename = request.cookies.get('formulary_md_filename')
+
+    # Paths are rebuilt from the job id rather than trusted from cookies
+    session_cookies = [json_output_filename_list, json_screen_output, json_pricetable_unmatched_meds, formulary_md_filename]
+    if not ws.is_job_id(job_id) or not all(session_cookies) or \
+            not os.path.isdir(ws.workspace_path(app.config['WORKSPACE_FOLDER'], job_id)):
+        error_prompt = 'Your upload session has expired. Please upload the files again'
+        return render_template('index.html', error_prompt=error_prompt)
+    ev.set_context(job_id=job_id)
+
+    shared_pricetable_path = os.path.join(app.config['PERSISTENT_FOLDER'],PERSISTENT_PRICETABLE_FILENAME)
+    formulary_md_path = os.path.join(ws.input_folder(app.config['WORKSPACE_FOLDER'], job_id), secure_filename(formulary_md_filename))
+    pricetable_persist_path = ws.work_pricetable_path(app.config['WORKSPACE_FOLDER'], job_id)
+    output_folder = ws.output_folder(app.config['WORKSPACE_FOLDER'], job_id)
+    pricetable_output_path = os.path.join(output_folder, ws.WORK_PRICETABLE_FILENAME)
     
     output_filename_list = json.loads(json_output_filename_list)
 
@@ -128,18 +288,138 @@ def result():
     for entry in pricetable_unmatched_meds_list:
         pricetable_unmatched_meds.add(entry)
     
-    usermatches = request.form.getlist('usermatches')
+    # Resolve the ids of the selected matches against the matches saved for this job
+    matchlist = read_fuzzymatches(ws.fuzzymatches_path(app.config['WORKSPACE_FOLDER'], job_id))
+    match_ids = [int(i) for i in request.form.getlist('usermatches') if i.isdecimal()]  # isdigit() also accepts '²'
+    usermatches = [matchlist[i] for i in match_ids if i < len(matchlist)]
     app.logger.debug(usermatches)  #debugging
     
-    pricetable_unmatched_meds, screen_output = process_usermatches(usermatches, formulary_md_path, pricetable_unmatched_meds, pricetable_persist_path, pricetable_output_path, output_filename_list, screen_output)
+    category_map_path = os.path.join(app.config['PERSISTENT_FOLDER'],cm.CATEGORY_MAP_FILENAME)
+    pricetable_unmatched_meds, screen_output = process_usermatches(usermatches, formulary_md_path, pricetable_unmatched_meds, pricetable_persist_path, pricetable_output_path, output_filename_list, screen_output, output_folder=output_folder, significance_percent=app.config['PRICE_CHANGE_SIGNIFICANCE'], category_map_path=category_map_path)
+
+    # Merge the user's matches into the shared pricetable and offer the merged table for download
+    conflicts = ws.commit_pricetable(app.config['WORKSPACE_FOLDER'], job_id, shared_pricetable_path)
+    app.logger.debug('Pricetable merge conflicts: {}'.format(conflicts))
+    shutil.copyfile(pricetable_persist_path, pricetable_output_path)
+    update_drug_index(os.path.join(output_folder, output_filename_list[1]), shared_pricetable_path)
 
     # Convert screen output from array to strings
     screen_output_strings = []
     for line in screen_output:
         screen_output_strings.append(line[0] + ': ' + str(line[1]))
     screen_output = screen_output_strings
+
+    # Stage timings of the upload and of this request
+    timings = []
+    if app.config['SHOW_TIMINGS']:
+        upload_timings = mt.read_timings(ws.timings_path(app.config['WORKSPACE_FOLDER'], job_id))
+        if upload_timings is not None:
+            timings.append(('Upload', upload_timings.breakdown()))
+        timings.append(('Selected matches', mt.current_request().snapshot().breakdown()))
     
-    return render_template('result.html', output_filename_list=output_filename_list, screen_output=screen_output, pricetable_unmatched_meds=pricetable_unmatched_meds)
+    return render_template('result.html', job_id=job_id, output_filename_list=output_filename_list, price_report_filename=pr.PRICE_REPORT_FILENAME, screen_output=screen_output, pricetable_unmatched_meds=pricetable_unmatched_meds, timings=timings)
+
+def update_drug_index(formulary_md_path, pricetable_path):
+    changes = drug_index.update_source('formulary', dl.formulary_entries(formulary_md_path))
+    changes += drug_index.update_source('pricetable', dl.pricetable_entries(pricetable_path))
+    app.logger.debug('Drug lookup entries re-indexed: {}'.format(changes))
+
+
+def load_drug_index():
+    # On first use, index the shared pricetable and the most recent formulary backup.
+    # Searches wait for the first load; a load that fails is tried again on the next search.
+    global drug_index_loaded
+    if drug_index_loaded:
+        return
+
+    with drug_index_lock:
+        if drug_index_loaded:
+            return
+
+        backup_directory = app.config['BACKUP_FOLDER']
+        backups = sorted(f for f in os.listdir(backup_directory) if f.split('.')[-1] in ('md', 'markdown'))
+        if backups:
+            drug_index.update_source('formulary', dl.formulary_entries(os.path.join(backup_directory, backups[-1])))
+        pricetable_path = os.path.join(app.config['PERSISTENT_FOLDER'],PERSISTENT_PRICETABLE_FILENAME)
+        drug_index.update_source('pricetable', dl.pricetable_entries(pricetable_path))
+        drug_index_loaded = True
+
+
+@app.route('/pricetable/restore', methods=['POST'])
+def pricetable_restore():
+    # Bring archived pricetable rows back, e.g. POST drug=72955&drug=AMOXICILLIN 500MG CAP
+    drugs = request.form.getlist('drug')
+    if not drugs:
+        abort(400)
+
+    pricetable_path = os.path.join(app.config['PERSISTENT_FOLDER'],PERSISTENT_PRICETABLE_FILENAME)
+    restored = ct.restore(pricetable_path, drugs)
+    if not restored:
+        abort(404)
+    drug_index.update_source('pricetable', dl.pricetable_entries(pricetable_path))
+
+    return jsonify(restored=[{'namedose': v.NAMEDOSE, 'itemnum': v.ITEMNUM, 'price': v.COST, 'category': v.CATEGORY,
+                              'reqdate': v.REQDATE.isoformat()} for v in restored])
+
+
+@app.route('/metrics')
+def metrics():
+    # Counters in the Prometheus text format, for scraping
+    return Response(mt.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/lookup')
+def lookup():
+    # Search the formulary and pricetable for autocomplete, e.g. /lookup?q=amox+500
+    query = request.args.get('q', '')
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        abort(400)
+
+    load_drug_index()
+    results = drug_index.search(query, limit)
+
+    return jsonify(query=query, results=[dl.entry_to_dict(score, entry) for score, entry in results])
+
+
+@app.route('/price-history')
+def price_history():
+    # Look up a drug by its invoice NAMEDOSE or item number, e.g. /price-history?drug=72955
+    drug = request.args.get('drug', '')
+    period = request.args.get('period', 'month')
+    if period not in ph.PERIODS:
+        abort(400)
+    history = ph.load_history(os.path.join(app.config['PERSISTENT_FOLDER'],PRICE_HISTORY_FILENAME))
+
+    results = []
+    for keyid in history.keyids(drug):
+        results.append({
+            'namedose': history.KEYS[keyid],
+            'itemnum': history.ITEMNUMS[keyid],
+            'history': [{'date': ph.from_epoch(epoch).isoformat(), 'cents': cents} for epoch, cents in history.history(keyid)],
+            'deltas': history.period_deltas(keyid, period)})
+
+    if not results:
+        abort(404)
+    return jsonify(drug=drug, results=results)
+
+
+@app.route('/price-history/movers')
+def price_history_movers():
+    # Biggest price changes between two dates, e.g. /price-history/movers?since=2015-01-01&limit=20
+    try:
+        since = ph.to_epoch(parse_date(request.args['since']))
+        until = ph.to_epoch(parse_date(request.args['until'])) if 'until' in request.args else None
+        limit = int(request.args.get('limit', 10))
+    except (KeyError, ValueError, OverflowError):
+        abort(400)
+    if limit < 1:
+        abort(400)
+    history = ph.load_history(os.path.join(app.config['PERSISTENT_FOLDER'],PRICE_HISTORY_FILENAME))
+
+    return jsonify(movers=history.top_movers(since, until, limit))
+
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5050))
@@ -0,0 +1,181 @@
+import os
+import csv
+import fcntl
+from collections import OrderedDict, Counter
+
+"""
+###################################################################
+## Invoice commodity to formulary category map for matching      ##
+###################################################################
+"""
+# Invoice lines carry a commodity name (the 'Comdty Name' column, stored as
+# InvRec.CATEGORY, e.g. OPHTHALMICS/GENERAL) and formulary drugs sit under a
+# '* CATEGORY' heading. The map says which formulary categories a commodity
+# can match, so each invoice line is only compared with the drugs in those
+# categories instead of the whole formulary.
+#
+# The map is a tab separated file with one row per commodity and category:
+#
+#   COMMODITY  CATEGORY  SOURCE  MATCHES
+#
+# Rows with SOURCE 'config' are added by hand and, when a commodity has any,
+# are the only categories used for it. Rows with SOURCE 'learned' are written
+# by the pipeline, which counts every name and dose match between an invoice
+# line and a formulary drug, and every match the user confirms. Learned
+# categories are used once they have at least MIN_LEARNED_MATCHES matches in
+# the file, so a single wrong match does not narrow a commodity's search and
+# matches learned during a run do not change how the rest of it is searched.
+#
+# Matching modes:
+#
+#   'first' - compare with the mapped categories, then with the rest of the
+#             formulary if no name and dose matched there
+#   'only'  - compare with the mapped categories only
+#   'off'   - compare with the whole formulary (matches are still learned);
+#             the default
+#
+# Commodities without a mapping are always compared with the whole formulary.
+
+CATEGORY_MAP_FILENAME = 'category-map.tsv'
+MODE_FIRST = 'first'
+MODE_ONLY = 'only'
+MODE_OFF = 'off'
+MODES = (MODE_FIRST, MODE_ONLY, MODE_OFF)
+SOURCE_CONFIG = 'config'
+SOURCE_LEARNED = 'learned'
+MIN_LEARNED_MATCHES = 3
+LOCK_SUFFIX = '.lock'
+
+_HEADER_ = ['COMMODITY', 'CATEGORY', 'SOURCE', 'MATCHES']
+
+
+def _key(name):
+    return name.strip().upper()
+
+
+class CategoryMap:
+    """Formulary categories for each invoice commodity, and matching statistics.
+
+    * CONFIGURED - commodity -> set of categories added by hand
+    * LEARNED - commodity -> Counter of confirmed matches by category
+    * NEW - (commodity, category) -> matches learned since the map was read
+    * LOOKUPS - Counter of invoice lines by outcome: hit, fallback, miss, unmapped
+    * COMPARISONS - fuzzy comparisons made while matching
+    * PRUNED - fuzzy comparisons a search of the whole formulary would have added
+    """
+
+    def __init__(self):
+        self.CONFIGURED = {}
+        self.LEARNED = {}
+        self.NEW = Counter()
+        self.LOOKUPS = Counter()
+        self.COMPARISONS = 0
+        self.PRUNED = 0
+
+    def __len__(self):
+        return len(set(self.CONFIGURED) | set(self.LEARNED))
+
+    def configure(self, commodity, category):
+        self.CONFIGURED.setdefault(_key(commodity), set()).add(category.strip())
+
+    def _add_learned(self, commodity, category, matches):
+        commodity = _key(commodity)
+        category = category.strip()
+        if commodity and category:
+            self.LEARNED.setdefault(commodity, Counter())[category] += matches
+
+    def learn(self, commodity, category, matches=1):
+        """Count a confirmed match between an invoice commodity and a formulary category.
+
+        The match is added to the map file by save_learned, and so only guides
+        matching once the map is read again.
+        """
+        commodity = _key(commodity)
+        category = category.strip()
+        if commodity and category:
+            self.NEW[(commodity, category)] += matches
+
+    def categories(self, commodity):
+        """Return the set of categories mapped to a commodity, or None if it has none.
+        """
+        commodity = _key(commodity)
+        if commodity in self.CONFIGURED:
+            return self.CONFIGURED[commodity]
+
+        learned = set(category for category, matches in self.LEARNED.get(commodity, {}).items()
+                      if matches >= MIN_LEARNED_MATCHES)
+        return learned or None
+
+
+def partition_formulary(formulary):
+    """Group (formulary position, FormularyRecord) pairs by CATEGORY, in formulary order.
+    """
+    partitions = OrderedDict()
+    for position, record in enumerate(formulary):
+        partitions.setdefault(record.CATEGORY, []).append((position, record))
+    return partitions
+
+
+def read_category_map(category_map_path):
+    """Load a category map file. A missing file gives an empty map.
+    """
+    categorymap = CategoryMap()
+    if not os.path.isfile(category_map_path):
+        return categorymap
+
+    with open(category_map_path, 'r') as f:
+        readerobj = csv.reader(f, delimiter='\t')
+        next(readerobj, None)  # Skip line with column headings
+        for item in readerobj:
+            if len(item) < 2 or not item[0].strip() or item[0].startswith('#'):
+                continue
+            source = item[2].strip().lower() if len(item) > 2 and item[2].strip() else SOURCE_CONFIG
+            if source == SOURCE_LEARNED:
+                matches = int(item[3]) if len(item) > 3 and item[3].strip().isdigit() else 1
+                categorymap._add_learned(item[0], item[1], matches)
+            else:
+                categorymap.configure(item[0], item[1])
+
+    return categorymap
+
+
+def write_category_map(categorymap, category_map_path):
+    """Write a category map as a tab separated file, configured rows first.
+    """
+    with open(category_map_path, 'w') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(_HEADER_)
+        for commodity in sorted(categorymap.CONFIGURED):
+            for category in sorted(categorymap.CONFIGURED[commodity]):
+                writer.writerow([commodity, category, SOURCE_CONFIG, ''])
+        for commodity in sorted(categorymap.LEARNED):
+            for category, matches in sorted(categorymap.LEARNED[commodity].items()):
+                writer.writerow([commodity, category, SOURCE_LEARNED, matches])
+
+
+def save_learned(categorymap, category_map_path):
+    """Add the matches learned since the map was read to the map file.
+
+    The file is re-read under an exclusive lock so that matches learned by
+    other jobs in the meantime, and hand edits, are kept. Returns the number
+    of (commodity, category) pairs updated.
+    """
+    if not categorymap.NEW:
+        return 0
+
+    with open(category_map_path + LOCK_SUFFIX, 'a') as lockfile:
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        try:
+            current = read_category_map(category_map_path)
+            for (commodity, category), matches in categorymap.NEW.items():
+                current._add_learned(commodity, category, matches)
+
+            tmp_path = '{}.{}.tmp'.format(category_map_path, os.getpid())
+            write_category_map(current, tmp_path)
+            os.replace(tmp_path, category_map_path)
+        finally:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+    updated = len(categorymap.NEW)
+    categorymap.NEW.clear()
+    return updated
@@ -0,0 +1,202 @@
+import os
+import csv
+import logging
+from datetime import timedelta
+from collections import namedtuple
+import app.workspace as ws
+import app.metrics as mt
+from app.eventlog import get_logger, event
+
+log = get_logger('compaction')
+
+"""
+#####################################################################
+## Retention policy for the shared pricetable: hot and cold rows   ##
+#####################################################################
+"""
+# The shared pricetable is the hot segment: it is snapshotted into every job
+# and every row in it is matched against the formulary and written back on
+# every run. Rows that are no longer useful are moved to a cold segment next
+# to it, in the same format:
+#
+#   <persistent_folder>/persistent-pricetable.tsv   hot rows
+#   <persistent_folder>/pricetable-archive.tsv      cold rows
+#   <persistent_folder>/pricetable-runs.tsv         NAMEDOSE<TAB>runs in a row with ON FORMULARY False
+#
+# A row goes cold when its requisition date is more than 'max_age_days' older
+# than the most recent requisition date in the table, or when it has been
+# off the formulary for 'max_off_formulary_runs' runs in a row. Ages are
+# measured against the table rather than the clock so that loading an old
+# invoice does not archive it straight away. A limit of 0 turns that rule off.
+#
+# Rows that a job still offers for review on its selection page are kept hot
+# whatever their age, so the user can still select them. A job that took its
+# snapshot before a row was archived only brings it back when it commits if
+# its invoice has a new price for it (see ws.merge_pricetable), but keeps the
+# rows it offers in its own copy until it is submitted (see ws.commit_pricetable).
+#
+# A drug that appears on a new invoice is added to the hot segment again by
+# the pipeline; restore() brings archived rows back on demand.
+
+ARCHIVE_FILENAME = 'pricetable-archive.tsv'
+RUNS_FILENAME = 'pricetable-runs.tsv'
+MAX_AGE_DAYS = 730
+MAX_OFF_FORMULARY_RUNS = 5
+
+CompactionReport = namedtuple('CompactionReport', ['ROWS_HOT', 'ROWS_ARCHIVED', 'ROWS_COLD', 'BYTES_BEFORE',
+                                                   'BYTES_AFTER', 'BYTES_RECLAIMED'])
+
+
+def archive_path(pricetable_persist_path):
+    return os.path.join(os.path.dirname(pricetable_persist_path), ARCHIVE_FILENAME)
+
+
+def runs_path(pricetable_persist_path):
+    return os.path.join(os.path.dirname(pricetable_persist_path), RUNS_FILENAME)
+
+
+def _size(path):
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def read_runs(path):
+    """Load the number of runs in a row each NAMEDOSE has been off the formulary.
+    """
+    runs = {}
+    if not os.path.isfile(path):
+        return runs
+
+    with open(path, 'r') as f:
+        for item in csv.reader(f, delimiter='\t'):
+            if len(item) == 2 and item[1].isdigit():
+                runs[item[0]] = int(item[1])
+
+    return runs
+
+
+def write_runs(runs, path):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        for k in sorted(runs):
+            if runs[k]:
+                writer.writerow([k, runs[k]])
+    os.replace(tmp_path, path)
+
+
+def count_run(pricetable, runs):
+    """Add one run to every row that is off the formulary and reset the others.
+    """
+    return dict((k, runs.get(k, 0) + 1 if v.ON_FORMULARY == 'False' else 0) for k, v in pricetable.items())
+
+
+def cold_keys(pricetable, runs, max_age_days=MAX_AGE_DAYS, max_off_formulary_runs=MAX_OFF_FORMULARY_RUNS):
+    """Return the NAMEDOSEs of the rows the retention policy moves to the cold segment.
+    """
+    if not pricetable:
+        return set()
+
+    cold = set()
+    if max_age_days:
+        cutoff = max(v.REQDATE for v in pricetable.values()) - timedelta(days=max_age_days)
+        cold.update(k for k, v in pricetable.items() if v.REQDATE < cutoff)
+    if max_off_formulary_runs:
+        cold.update(k for k in pricetable if runs.get(k, 0) >= max_off_formulary_runs)
+
+    return cold
+
+
+def _merge_newer(table, rows):
+    # Keep the most recent row for each NAMEDOSE
+    for k, v in rows.items():
+        if k not in table or v.REQDATE >= table[k].REQDATE:
+            table[k] = v
+
+
+def compact_pricetable(pricetable_persist_path, max_age_days=MAX_AGE_DAYS,
+                       max_off_formulary_runs=MAX_OFF_FORMULARY_RUNS, new_run=True, keep=()):
+    """Move the rows of the shared pricetable that the retention policy marks cold to the archive.
+
+    If 'new_run', the pricetable's ON FORMULARY flags first count as another
+    run. NAMEDOSEs in 'keep', e.g. those offered for review by jobs in
+    flight, are never archived. Holds the shared pricetable lock throughout.
+    Returns a CompactionReport.
+    """
+    archive = archive_path(pricetable_persist_path)
+    runs_file = runs_path(pricetable_persist_path)
+
+    with mt.stage('compact_pricetable') as s:
+        with ws.pricetable_lock(pricetable_persist_path):
+            bytes_before = _size(pricetable_persist_path)
+            pricetable = ws.read_pricetable_or_empty(pricetable_persist_path)
+            runs = read_runs(runs_file)
+            if new_run:
+                runs = count_run(pricetable, runs)
+
+            cold = cold_keys(pricetable, runs, max_age_days, max_off_formulary_runs) - set(keep)
+            coldtable = ws.read_pricetable_or_empty(archive)
+            _merge_newer(coldtable, dict((k, pricetable.pop(k)) for k in cold))
+
+            # A drug that is hot again is no longer archived
+            rehot = [k for k in pricetable if k in coldtable]
+            for k in rehot:
+                del coldtable[k]
+            for k in cold:
+                runs.pop(k, None)
+
+            if cold or rehot:
+                ws.replace_pricetable(coldtable, archive)
+                ws.replace_pricetable(pricetable, pricetable_persist_path)
+            write_runs(runs, runs_file)
+            bytes_after = _size(pricetable_persist_path)
+
+        s.ROWS_IN = len(pricetable) + len(cold)
+        s.ROWS_OUT = len(pricetable)
+
+    report = CompactionReport(ROWS_HOT=len(pricetable), ROWS_ARCHIVED=len(cold), ROWS_COLD=len(coldtable),
+                              BYTES_BEFORE=bytes_before, BYTES_AFTER=bytes_after,
+                              BYTES_RECLAIMED=bytes_before - bytes_after)
+
+    mt.inc('formulary_pricetable_rows_archived_total', report.ROWS_ARCHIVED)
+    mt.inc('formulary_pricetable_bytes_reclaimed_total', max(report.BYTES_RECLAIMED, 0))
+    event(log, logging.INFO, 'pricetable_compacted', **dict((k.lower(), v) for k, v in report._asdict().items()))
+
+    return report
+
+
+def restore(pricetable_persist_path, drugs):
+    """Move archived rows back to the shared pricetable.
+
+    'drugs' are NAMEDOSEs or item numbers, compared without regard to case.
+    A restored row does not replace a more recent hot row. Returns the
+    restored InvRec records.
+    """
+    archive = archive_path(pricetable_persist_path)
+    wanted = set(d.strip().lower() for d in drugs if d.strip())
+
+    with ws.pricetable_lock(pricetable_persist_path):
+        coldtable = ws.read_pricetable_or_empty(archive)
+        restored = dict((k, v) for k, v in coldtable.items()
+                        if k.lower() in wanted or v.ITEMNUM.lower() in wanted)
+        if not restored:
+            return []
+
+        pricetable = ws.read_pricetable_or_empty(pricetable_persist_path)
+        _merge_newer(pricetable, restored)
+        for k in restored:
+            del coldtable[k]
+
+        ws.replace_pricetable(pricetable, pricetable_persist_path)
+        ws.replace_pricetable(coldtable, archive)
+
+        # Restored rows start counting runs off the formulary afresh
+        runs_file = runs_path(pricetable_persist_path)
+        runs = read_runs(runs_file)
+        for k in restored:
+            runs.pop(k, None)
+        write_runs(runs, runs_file)
+
+    mt.inc('formulary_pricetable_rows_restored_total', len(restored))
+    event(log, logging.INFO, 'pricetable_restored', rows=len(restored), namedoses=sorted(restored))
+
+    return [restored[k] for k in sorted(restored)]
@@ -0,0 +1,222 @@
+import re
+import os
+import heapq
+import threading
+from collections import namedtuple, Counter
+import app.formularyhelper as fh
+import app.rxparse as rx
+
+"""
+##########################################################################
+## In-memory drug lookup over the formulary and the persistent pricetable ##
+##########################################################################
+"""
+# Each searchable entry is indexed twice:
+#
+# * every word of its NAMEDOSE goes into a prefix trie whose nodes hold the
+#   ids of all entries below them, so "amox 500" is two dictionary walks
+#   and a set intersection
+# * the whole NAMEDOSE is split into trigrams, which catches misspellings
+#   and partial words that the trie cannot ("amoxicilin", "clavul")
+#
+# Entries are grouped by source ('formulary' or 'pricetable') and each source
+# is replaced by diffing, so only entries that changed are re-indexed.
+#
+# A search only scores a small candidate set: the entries every query word
+# is a prefix of, plus, while those are fewer than asked for, the entries
+# sharing a trigram with the query. Dose trigrams such as "mg " and "0mg"
+# are in most entries, so trigrams found in more than COMMON_TRIGRAM_SHARE
+# of the entries only add to the score of prefix matches.
+
+COMMON_TRIGRAM_SHARE = 0.02
+COMMON_TRIGRAM_MIN = 50  # Small indexes score every trigram
+
+LookupEntry = namedtuple('LookupEntry', ['SOURCE', 'NAMEDOSE', 'NAME', 'DOSE', 'COST', 'CATEGORY',
+                                         'ON_FORMULARY', 'BLACKLISTED'])
+
+_WORDPATT_ = re.compile(r'[a-z0-9.%]+')
+
+
+def _words(text):
+    return _WORDPATT_.findall(text.lower())
+
+
+def _trigrams(text):
+    padded = '  {} '.format(' '.join(_words(text)))
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class _TrieNode:
+    __slots__ = ('CHILDREN', 'IDS')
+
+    def __init__(self):
+        self.CHILDREN = {}
+        self.IDS = set()
+
+
+class DrugIndex:
+    """Prefix trie and trigram index over LookupEntry records.
+    """
+
+    def __init__(self):
+        self.ENTRIES = {}  # (SOURCE, NAMEDOSE) -> LookupEntry
+        self.TRIE = _TrieNode()
+        self.TRIGRAMS = {}
+        self._lock = threading.Lock()
+
+    def _add(self, entry_id, entry):
+        self.ENTRIES[entry_id] = entry
+
+        for word in set(_words(entry.NAMEDOSE)):
+            node = self.TRIE
+            for c in word:
+                node = node.CHILDREN.setdefault(c, _TrieNode())
+                node.IDS.add(entry_id)
+
+        for t in _trigrams(entry.NAMEDOSE):
+            self.TRIGRAMS.setdefault(t, set()).add(entry_id)
+
+    def _remove(self, entry_id):
+        entry = self.ENTRIES.pop(entry_id)
+
+        for word in set(_words(entry.NAMEDOSE)):
+            node = self.TRIE
+            for c in word:
+                node = node.CHILDREN[c]
+                node.IDS.discard(entry_id)
+
+        for t in _trigrams(entry.NAMEDOSE):
+            ids = self.TRIGRAMS[t]
+            ids.discard(entry_id)
+            if not ids:
+                del self.TRIGRAMS[t]
+
+    def _prefix_ids(self, prefix):
+        node = self.TRIE
+        for c in prefix:
+            node = node.CHILDREN.get(c)
+            if node is None:
+                return set()
+        return node.IDS
+
+    # Public Instance Methods
+
+    def update_source(self, source, entries):
+        """Replace all entries of a source, re-indexing only those that changed.
+
+        Returns the number of entries added, changed and removed.
+        """
+        new = {(source, e.NAMEDOSE): e for e in entries}
+
+        with self._lock:
+            old_ids = [k for k in self.ENTRIES if k[0] == source]
+            changes = 0
+
+            for entry_id in old_ids:
+                if new.get(entry_id) != self.ENTRIES[entry_id]:
+                    self._remove(entry_id)
+                    changes += 1
+
+            for entry_id, entry in new.items():
+                if entry_id not in self.ENTRIES:
+                    self._add(entry_id, entry)
+                    changes += 1
+
+        return changes
+
+    def search(self, query, limit=10):
+        """Return up to 'limit' (score, LookupEntry) pairs ranked best first.
+
+        An entry scores 1 if every query word is a prefix of one of its
+        words, and the share of the query's trigrams found in the entry is
+        added on top, so complete prefix matches rank first and fuzzy
+        matches follow.
+        """
+        words = set(_words(query))
+        if not words or limit < 1:
+            return []
+        qtrigrams = _trigrams(query)
+
+        with self._lock:
+            # Intersect from the smallest set so common words such as "20mg" cost little
+            prefix_ids = sorted((self._prefix_ids(word) for word in words), key=len)
+            full = prefix_ids[0].intersection(*prefix_ids[1:])
+
+            common = max(COMMON_TRIGRAM_MIN, int(COMMON_TRIGRAM_SHARE * len(self.ENTRIES)))
+            fuzzy = len(full) < limit
+            trigram_hits = Counter()
+            for t in qtrigrams:
+                ids = self.TRIGRAMS.get(t, ())
+                if fuzzy and len(ids) <= common:
+                    trigram_hits.update(ids)
+                else:
+                    trigram_hits.update(full.intersection(ids))
+
+            scored = []
+            for entry_id in full.union(trigram_hits):
+                score = (entry_id in full) + trigram_hits[entry_id]/len(qtrigrams)
+                entry = self.ENTRIES[entry_id]
+                # Prefer formulary entries and drugs we stock when scores tie
+                scored.append((round(score, 4), entry.SOURCE == 'formulary', entry.ON_FORMULARY == 'True',
+                               -len(entry.NAMEDOSE), entry))
+
+        best = heapq.nlargest(limit, scored, key=lambda s: s[:4])
+
+        # Drop weak trigram-only matches once there are better results
+        results = [(s[0], s[4]) for s in best]
+        if results and results[0][0] >= 1:
+            results = [r for r in results if r[0] >= 0.5]
+
+        return results
+
+
+def formulary_entries(formulary_md_path):
+    """Build LookupEntry records for each dose of each drug in an EHHapp Markdown formulary.
+    """
+    formulary = fh.store_formulary(fh.parse_mddata(fh.read_md(formulary_md_path)))
+
+    entries = []
+    for record in formulary:
+        record._set_PRICETABLE()
+        for k, v in record.PRICETABLE.items():
+            entries.append(LookupEntry(
+                SOURCE='formulary',
+                NAMEDOSE=k,
+                NAME=v.NAME,
+                DOSE=v.DOSE,
+                COST=v.COST,
+                CATEGORY=v.CATEGORY,
+                ON_FORMULARY='True',
+                BLACKLISTED=str(record.BLACKLISTED)))
+
+    return entries
+
+
+def pricetable_entries(pricetable_path):
+    """Build LookupEntry records for each NAMEDOSE in a pricetable file.
+    """
+    if not os.path.isfile(pricetable_path):
+        return []
+
+    return [LookupEntry(
+                SOURCE='pricetable',
+                NAMEDOSE=k,
+                NAME=v.NAME,
+                DOSE=v.DOSE,
+                COST=v.COST,
+                CATEGORY=v.CATEGORY,
+                ON_FORMULARY=v.ON_FORMULARY,
+                BLACKLISTED='NaN')
+            for k, v in rx.read_pricetable(pricetable_path).items()]
+
+
+def entry_to_dict(score, entry):
+    return {'score': score,
+            'source': entry.SOURCE,
+            'namedose': entry.NAMEDOSE,
+            'name': entry.NAME,
+            'dose': entry.DOSE,
+            'price': entry.COST,
+            'category': entry.CATEGORY,
+            'on_formulary': entry.ON_FORMULARY,
+            'blacklisted': entry.BLACKLISTED}
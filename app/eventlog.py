@@ -0,0 +1,197 @@
+import os
+import json
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+from datetime import datetime
+
+"""
+#####################################################################
+## Structured event log, written off the request thread            ##
+#####################################################################
+"""
+# Pipeline code logs named events with keyword fields:
+#
+#   event(log, logging.INFO, 'price_change', namedose=k, old=mdcost, new=invcost)
+#
+# Records are put on an in-memory queue as they are, without formatting, and
+# a listener thread turns them into JSON lines and writes them in batches:
+#
+#   <log_folder>/events.jsonl       every event at or above the configured level
+#   <log_folder>/price-audit.jsonl  every price change, whatever the level
+#
+# Until configure() is called the loggers have no handlers, so events below
+# WARNING cost a level check and nothing else.
+
+ROOT_LOGGER = 'formulary'
+AUDIT_LOGGER = 'formulary.audit'
+EVENTS_FILENAME = 'events.jsonl'
+AUDIT_FILENAME = 'price-audit.jsonl'
+BATCH_SIZE = 200  # Records written per batch when events arrive faster than they are written
+
+_listener = None
+_listener_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_logger(name):
+    """Return the event logger for a module, e.g. get_logger('rxparse').
+    """
+    return logging.getLogger('{}.{}'.format(ROOT_LOGGER, name))
+
+
+audit = logging.getLogger(AUDIT_LOGGER)
+
+
+def event(logger, level, event_name, **fields):
+    """Log an event with 'fields' if the logger is enabled for 'level'.
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, event_name, extra={'fields': fields})
+
+
+def set_context(**context):
+    """Add fields such as the job id to every event logged from this thread.
+    """
+    _local.context = context
+
+
+def clear_context():
+    _local.context = None
+
+
+class _ContextFilter(logging.Filter):
+    # Runs in the thread that logged the event, before the record is queued
+    def filter(self, record):
+        record.context = getattr(_local, 'context', None)
+        return True
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queue records without formatting them; the listener thread formats them.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one line of JSON: time, level, event, then the event's fields.
+    """
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'event': record.getMessage()}
+        if getattr(record, 'context', None):
+            entry.update(record.context)
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str, sort_keys=True)
+
+
+class _BufferedFileHandler(logging.FileHandler):
+    """File handler that leaves flushing to _BatchHandler instead of flushing every record.
+    """
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class _BatchHandler(logging.handlers.MemoryHandler):
+    """Buffer records and write them together, as soon as the queue has been drained.
+    """
+
+    def __init__(self, target, log_queue):
+        super().__init__(BATCH_SIZE, flushLevel=logging.ERROR, target=target)
+        self.setLevel(target.level)
+        for f in target.filters:
+            self.addFilter(f)
+        self._queue = log_queue
+
+    def shouldFlush(self, record):
+        return super().shouldFlush(record) or self._queue.empty()
+
+    def flush(self):
+        super().flush()
+        if self.target is not None:
+            self.target.flush()
+
+    def close(self):
+        target = self.target
+        self.flush()
+        super().close()
+        target.close()
+
+
+def configure(log_folder, level=logging.INFO):
+    """Start writing events to JSON lines files in 'log_folder'. Safe to call more than once.
+    """
+    with _listener_lock:
+        if _listener is None:
+            _start(log_folder, level)
+
+
+def _start(log_folder, level):
+    global _listener
+    if not os.path.isdir(log_folder):
+        os.makedirs(log_folder)
+
+    log_queue = queue.Queue()
+    formatter = JsonFormatter()
+
+    events_handler = _BufferedFileHandler(os.path.join(log_folder, EVENTS_FILENAME), delay=True)
+    events_handler.setLevel(level)
+    events_handler.setFormatter(formatter)
+
+    audit_handler = _BufferedFileHandler(os.path.join(log_folder, AUDIT_FILENAME), delay=True)
+    audit_handler.setLevel(logging.INFO)
+    audit_handler.setFormatter(formatter)
+    audit_handler.addFilter(logging.Filter(AUDIT_LOGGER))
+
+    _listener = logging.handlers.QueueListener(log_queue,
+                                               _BatchHandler(events_handler, log_queue),
+                                               _BatchHandler(audit_handler, log_queue),
+                                               respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+    queue_handler = _LazyQueueHandler(log_queue)
+    queue_handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    root.propagate = False
+
+    # Price changes are always audited, even when the event log level is higher
+    audit.setLevel(logging.INFO)
+
+
+def shutdown():
+    """Write out any queued events and stop the listener thread.
+    """
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            return
+
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+        root = logging.getLogger(ROOT_LOGGER)
+        for handler in list(root.handlers):
+            if isinstance(handler, _LazyQueueHandler):
+                root.removeHandler(handler)
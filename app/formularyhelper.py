@@ -1,11 +1,95 @@
 import re
+import logging
+from functools import lru_cache
 from collections import namedtuple
+from app.eventlog import get_logger, event
+
+log = get_logger('formularyhelper')
 
 # Classes and Functions for reading and parsing invoices
 InvRec = namedtuple('InvoiceRecord', ['NAMEDOSE', 'NAME', 'DOSE', 'COST', 'CATEGORY', 'ITEMNUM',
                                       'ON_FORMULARY','REQDATE'])
 FuzzyMatch = namedtuple('FuzzyMatch', ['MD_NAMEDOSE', 'MD_PRICE', 'INV_NAMEDOSE', 'INV_PRICE', 'INV_ITEMNUM'])
 
+_COSTPATT_ = re.compile(r'\$?\s*(\d*)(?:\.(\d*))?')
+SUBCENT_PLACES = 4  # Invoices price some items per unit in fractions of a cent, e.g. '$0.0125'
+
+
+def _cost_to_units(coststring, places):
+    # Integer amount with 'places' decimal places of a dollar, rounding any further digits
+    m = _COSTPATT_.fullmatch(coststring.strip().replace(',', ''))
+    if not m or not (m.group(1) or m.group(2)):
+        return None
+
+    dollars = int(m.group(1) or 0)
+    fraction = (m.group(2) or '').ljust(places + 1, '0')
+    units = int(fraction[:places]) + (1 if int(fraction[places]) >= 5 else 0)
+
+    return dollars*10**places + units
+
+
+def cost_to_cents(coststring):
+    """Convert a cost string such as '$71.59' to an integer number of cents.
+
+    Thousands separators are ignored and fractions of a cent are rounded.
+    Returns None if no price can be read from the string.
+    """
+    return _cost_to_units(coststring, 2)
+
+
+def cost_to_subcents(coststring):
+    """Convert a cost string such as '$0.0125' to an integer number of hundredths of a cent.
+
+    Thousands separators are ignored and any further digits are rounded.
+    Returns None if no price can be read from the string.
+    """
+    return _cost_to_units(coststring, SUBCENT_PLACES)
+
+
+@lru_cache(maxsize=4096)
+def parse_cost(coststring):
+    """Parse a cost or cost range such as '$0.06' or '$2.88-$3.16' into (low, high) hundredths of a cent.
+
+    A single price has low == high. Returns None if the string holds no price.
+    Results are cached, so each distinct cost string is only parsed once.
+    """
+    parts = coststring.split('-')
+    if len(parts) > 2:
+        return None
+
+    subcents = [cost_to_subcents(p) for p in parts]
+    if None in subcents:
+        return None
+
+    return min(subcents), max(subcents)
+
+
+def subcents_to_cost(low, high=None):
+    """Format hundredths of a cent as a cost string, e.g. 28800, 31600 -> '$2.88-$3.16'.
+
+    Whole cents are shown with two decimal places and fractions of a cent with as many as they need.
+    """
+    if high is None or high == low:
+        fraction = '{:0{}d}'.format(low % 10**SUBCENT_PLACES, SUBCENT_PLACES).rstrip('0').ljust(2, '0')
+        return '${}.{}'.format(low // 10**SUBCENT_PLACES, fraction)
+    return '{}-{}'.format(subcents_to_cost(low), subcents_to_cost(high))
+
+
+def price_differs(cost_a, cost_b):
+    """Compare two cost strings by value, so '$0.5' and '$0.50' are the same price.
+
+    Prices are compared to a hundredth of a cent, so a change in a per unit
+    price below a cent still counts. Falls back to comparing the strings
+    when either cannot be parsed.
+    """
+    subcents_a = parse_cost(cost_a)
+    subcents_b = parse_cost(cost_b)
+
+    if subcents_a is None or subcents_b is None:
+        return cost_a.strip().lower() != cost_b.strip().lower()
+
+    return subcents_a != subcents_b
+
 
 class FormularyRecord:
     """Define a class that corresponds to a formulary entry.
@@ -54,11 +138,11 @@ class FormularyRecord:
         elif m:
             self.BLACKLISTED = False
             name = m.group(1)
-            print('{} came from {}'.format(name, namestring))
 
             if bool(name) == False:
                 name = m.group(3)
-                print('What was once None is now {}'.format(name))
+
+            event(log, logging.DEBUG, 'drug_name_parsed', name=name, namestring=namestring)
 
         else:
             self.BLACKLISTED = False
@@ -158,7 +242,7 @@ def read_md(filename):
 
         > ~DRUGNAME (brandname) - other metadata | COSTpD (DOSE) | SUBCATEGORY
     '''
-    with open(filename, 'rU') as f:
+    with open(filename, 'r') as f:
         rxlines = f.readlines()
 
         rxfiltered = []
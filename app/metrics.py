@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import threading
+from collections import namedtuple, OrderedDict
+import app.formularyhelper as fh
+
+"""
+#####################################################################
+## Stage timers and counters for the formulary update pipeline     ##
+#####################################################################
+"""
+# Counters are kept for the life of the process and exposed in the Prometheus
+# text format by render_prometheus. The same stage timings and counters are
+# also collected per request, for the thread that called begin_request, so a
+# single upload can be broken down stage by stage.
+
+METRICS = OrderedDict([
+    ('formulary_stage_calls_total', 'Number of times each pipeline stage ran.'),
+    ('formulary_stage_seconds_total', 'Wall clock seconds spent in each pipeline stage.'),
+    ('formulary_stage_cpu_seconds_total', 'CPU seconds spent in each pipeline stage.'),
+    ('formulary_stage_rows_in_total', 'Rows passed into each pipeline stage.'),
+    ('formulary_stage_rows_out_total', 'Rows produced by each pipeline stage.'),
+    ('formulary_fuzzy_comparisons_total', 'Fuzzy drug name comparisons made while matching.'),
+    ('formulary_dose_comparisons_total', 'Formulary doses compared with invoice medications while matching.'),
+    ('formulary_fuzzy_comparisons_pruned_total', 'Fuzzy comparisons skipped by matching within mapped formulary categories.'),
+    ('formulary_category_lookups_total', 'Invoice medications matched by category, by result (hit, fallback, miss, unmapped).'),
+    ('formulary_bytes_read_total', 'Bytes read from pipeline files, by kind of file.'),
+    ('formulary_bytes_written_total', 'Bytes written to pipeline files, by kind of file.'),
+    ('formulary_http_requests_total', 'HTTP requests handled, by endpoint and status code.'),
+    ('formulary_http_request_seconds_total', 'Wall clock seconds spent handling HTTP requests, by endpoint.'),
+    ('formulary_pricetable_rows_archived_total', 'Pricetable rows moved to the archive by the retention policy.'),
+    ('formulary_pricetable_rows_restored_total', 'Archived pricetable rows restored on request.'),
+    ('formulary_user_matches_missing_total', 'Selected matches skipped because their invoice row was no longer in the pricetable.'),
+    ('formulary_pricetable_bytes_reclaimed_total', 'Bytes removed from the shared pricetable by compaction.'),
+    ('formulary_cache_hits_total', 'Cache hits, by cache.'),
+    ('formulary_cache_misses_total', 'Cache misses, by cache.'),
+])
+
+# Functions wrapped in functools.lru_cache whose hit rates are reported
+CACHES = OrderedDict([
+    ('parse_cost', fh.parse_cost),
+])
+
+StageTiming = namedtuple('StageTiming', ['STAGE', 'WALL', 'CPU', 'ROWS_IN', 'ROWS_OUT'])
+
+_cpu_time = getattr(time, 'thread_time', time.process_time)
+
+_counters = {}  # metric name -> {labels: value}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _cache_counts():
+    counts = {}
+    for name, func in CACHES.items():
+        info = func.cache_info()
+        counts[name] = (info.hits, info.misses)
+    return counts
+
+
+class RequestTimings:
+    """Stage timings and counters collected during one request.
+
+    * STAGES - StageTiming for each stage, in the order they finished
+    * COUNTS - (metric name, labels) -> value
+    """
+
+    def __init__(self):
+        self.STAGES = []
+        self.COUNTS = OrderedDict()
+        self._cache_start = _cache_counts()
+
+    def _finish(self):
+        # Cache counters are process wide, so the request gets the difference over its lifetime
+        for name, (hits, misses) in _cache_counts().items():
+            start_hits, start_misses = self._cache_start.get(name, (0, 0))
+            self.COUNTS[('formulary_cache_hits_total', (('cache', name),))] = hits - start_hits
+            self.COUNTS[('formulary_cache_misses_total', (('cache', name),))] = misses - start_misses
+
+    def snapshot(self):
+        """Return a finished copy of the timings so far, while this request keeps collecting.
+        """
+        timings = RequestTimings.__new__(RequestTimings)
+        timings.STAGES = list(self.STAGES)
+        timings.COUNTS = OrderedDict(self.COUNTS)
+        timings._cache_start = self._cache_start
+        timings._finish()
+        return timings
+
+    def to_dict(self):
+        return {'stages': [list(s) for s in self.STAGES],
+                'counts': [[name, dict(labels), value] for (name, labels), value in self.COUNTS.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        timings = cls.__new__(cls)
+        timings.STAGES = [StageTiming(*s) for s in data['stages']]
+        timings.COUNTS = OrderedDict(((name, _labels_key(labels)), value) for name, labels, value in data['counts'])
+        return timings
+
+    def breakdown(self):
+        """Return rows of (stage, wall ms, CPU ms, rows in, rows out) and (counter, value) for display.
+        """
+        stages = [(s.STAGE, round(1000*s.WALL, 1), round(1000*s.CPU, 1), s.ROWS_IN, s.ROWS_OUT) for s in self.STAGES]
+        counts = []
+        for (name, labels), value in self.COUNTS.items():
+            label = ', '.join(v for _, v in labels)
+            counts.append(('{} ({})'.format(name, label) if label else name, value))
+        return stages, counts
+
+
+class stage:
+    """Context manager that times a pipeline stage.
+
+    Set ROWS_IN and ROWS_OUT inside the block to count the rows it handled:
+
+        with stage('read_invoice') as s:
+            recordlist = read_csv(invoice_path)
+            s.ROWS_OUT = len(recordlist)
+    """
+
+    def __init__(self, name, rows_in=None):
+        self.NAME = name
+        self.ROWS_IN = rows_in
+        self.ROWS_OUT = None
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = _cpu_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = _cpu_time() - self._cpu
+
+        inc('formulary_stage_calls_total', stage=self.NAME)
+        inc('formulary_stage_seconds_total', wall, stage=self.NAME)
+        inc('formulary_stage_cpu_seconds_total', cpu, stage=self.NAME)
+        if self.ROWS_IN is not None:
+            inc('formulary_stage_rows_in_total', self.ROWS_IN, stage=self.NAME)
+        if self.ROWS_OUT is not None:
+            inc('formulary_stage_rows_out_total', self.ROWS_OUT, stage=self.NAME)
+
+        timings = current_request()
+        if timings is not None:
+            timings.STAGES.append(StageTiming(self.NAME, wall, cpu, self.ROWS_IN, self.ROWS_OUT))
+
+        return False
+
+
+def inc(name, value=1, **labels):
+    """Add 'value' to a counter, and to the current request's counts for anything other than stage totals.
+    """
+    key = _labels_key(labels)
+    with _lock:
+        values = _counters.setdefault(name, {})
+        values[key] = values.get(key, 0) + value
+
+    timings = current_request()
+    if timings is not None and not name.startswith('formulary_stage_'):
+        timings.COUNTS[(name, key)] = timings.COUNTS.get((name, key), 0) + value
+
+
+def file_read(path, kind):
+    """Count the size of a file that was read.
+    """
+    if os.path.isfile(path):
+        inc('formulary_bytes_read_total', os.path.getsize(path), file=kind)
+
+
+def file_written(path, kind):
+    """Count the size of a file that was written.
+    """
+    if os.path.isfile(path):
+        inc('formulary_bytes_written_total', os.path.getsize(path), file=kind)
+
+
+def begin_request():
+    """Start collecting stage timings and counters for the request on this thread.
+    """
+    _local.timings = RequestTimings()
+    return _local.timings
+
+
+def current_request():
+    return getattr(_local, 'timings', None)
+
+
+def end_request():
+    """Stop collecting for this thread and return what was collected, or None.
+    """
+    timings = current_request()
+    _local.timings = None
+    if timings is not None:
+        timings._finish()
+    return timings
+
+
+def write_timings(timings, path):
+    with open(path, 'w') as f:
+        json.dump(timings.to_dict(), f)
+
+
+def read_timings(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return RequestTimings.from_dict(json.load(f))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    """Render every counter in the Prometheus text exposition format.
+    """
+    with _lock:
+        snapshot = {name: dict(values) for name, values in _counters.items()}
+
+    for name, (hits, misses) in _cache_counts().items():
+        snapshot.setdefault('formulary_cache_hits_total', {})[(('cache', name),)] = hits
+        snapshot.setdefault('formulary_cache_misses_total', {})[(('cache', name),)] = misses
+
+    lines = []
+    for name, description in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} counter'.format(name))
+        for labels, value in sorted(snapshot.get(name, {}).items()):
+            labelstring = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels)
+            lines.append('{}{} {}'.format(name, '{' + labelstring + '}' if labelstring else '', repr(float(value))))
+
+    return '\n'.join(lines) + '\n'
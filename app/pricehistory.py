@@ -0,0 +1,268 @@
+import os
+import fcntl
+import threading
+import struct
+import calendar
+from array import array
+from bisect import bisect_right
+from datetime import datetime
+from app.formularyhelper import cost_to_cents
+
+"""
+##################################################################
+## Append-only price history with integer cents and epoch dates ##
+##################################################################
+"""
+# The history is kept in two files that are only ever appended to:
+#
+#   <history_path>       fixed size binary records (key id, cents, epoch seconds)
+#   <history_path>.keys  one line per key id: NAMEDOSE<TAB>ITEMNUM
+#
+# Records are loaded into three array.array columns, with a per-key index of
+# row numbers and dates sorted by date, so that history lookups are a
+# dictionary lookup plus a slice and top-mover queries are a bisect per key.
+
+RECORD = struct.Struct('<iiq')  # key id, price in cents, requisition date in epoch seconds
+KEYS_SUFFIX = '.keys'
+PERIODS = ('month', 'year')
+
+_histories = {}  # Loaded histories by path, refreshed incrementally as the files grow
+_histories_lock = threading.Lock()
+
+
+def to_epoch(dt):
+    """Convert a naive datetime to epoch seconds.
+    """
+    return calendar.timegm(dt.timetuple())
+
+
+def from_epoch(epoch):
+    return datetime.utcfromtimestamp(epoch)
+
+
+class PriceHistory:
+    """In-memory, column oriented view of a price history file.
+
+    * KEYS, ITEMNUMS - NAMEDOSE and item number for each key id
+    * KEYID, CENTS, EPOCH - one entry per price record
+    * ROWS, ROWEPOCHS - row numbers and their dates for each key id, sorted by date
+    """
+
+    def __init__(self, history_path):
+        self.PATH = history_path
+        self.KEYS = []
+        self.ITEMNUMS = []
+        self.KEYINDEX = {}
+        self.ITEMNUMINDEX = {}
+        self.KEYID = array('i')
+        self.CENTS = array('i')
+        self.EPOCH = array('q')
+        self.ROWS = []
+        self.ROWEPOCHS = []
+        self._SEEN = set()
+        self._offset = 0
+        self._keys_offset = 0
+        # flock only serializes processes; threads of one process share this instance
+        self._lock = threading.RLock()
+
+    def _refresh(self):
+        """Read any keys and records appended since the last refresh.
+        """
+        with self._lock:
+            self._read_appended()
+
+    def _read_appended(self):
+        keys_path = self.PATH + KEYS_SUFFIX
+
+        if os.path.isfile(keys_path):
+            with open(keys_path, 'rb') as f:
+                f.seek(self._keys_offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # Partially written line, pick it up next time
+                    namedose, itemnum = line.decode('utf-8').rstrip('\n').split('\t')
+                    self._add_key(namedose, itemnum)
+                    self._keys_offset += len(line)
+
+        if os.path.isfile(self.PATH):
+            with open(self.PATH, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+            usable = len(data) - len(data) % RECORD.size
+            for keyid, cents, epoch in RECORD.iter_unpack(data[:usable]):
+                self._add_record(keyid, cents, epoch)
+            self._offset += usable
+
+    def _add_key(self, namedose, itemnum):
+        keyid = len(self.KEYS)
+        self.KEYS.append(namedose)
+        self.ITEMNUMS.append(itemnum)
+        self.KEYINDEX[namedose] = keyid
+        self.ITEMNUMINDEX.setdefault(itemnum, []).append(keyid)
+        self.ROWS.append(array('i'))
+        self.ROWEPOCHS.append(array('q'))
+        return keyid
+
+    def _add_record(self, keyid, cents, epoch):
+        row = len(self.KEYID)
+        self.KEYID.append(keyid)
+        self.CENTS.append(cents)
+        self.EPOCH.append(epoch)
+        self._SEEN.add((keyid, cents, epoch))
+
+        # Invoices mostly arrive in date order, so this is usually an append
+        rows = self.ROWS[keyid]
+        epochs = self.ROWEPOCHS[keyid]
+        if not epochs or epochs[-1] <= epoch:
+            rows.append(row)
+            epochs.append(epoch)
+        else:
+            i = bisect_right(epochs, epoch)
+            rows.insert(i, row)
+            epochs.insert(i, epoch)
+
+    # Public Instance Methods
+
+    def append(self, records):
+        """Append InvRec records, skipping prices that are already recorded.
+
+        Returns the number of records added.
+        """
+        with self._lock, open(self.PATH, 'ab') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                # Pick up anything another process appended before we took the lock
+                self._refresh()
+
+                newkeys = []
+                packed = []
+                for r in records:
+                    cents = cost_to_cents(r.COST)
+                    if cents is None:
+                        continue
+
+                    keyid = self.KEYINDEX.get(r.NAMEDOSE)
+                    if keyid is None:
+                        keyid = self._add_key(r.NAMEDOSE, r.ITEMNUM)
+                        newkeys.append('{}\t{}\n'.format(r.NAMEDOSE, r.ITEMNUM))
+
+                    epoch = to_epoch(r.REQDATE)
+                    if (keyid, cents, epoch) in self._SEEN:
+                        continue
+
+                    self._add_record(keyid, cents, epoch)
+                    packed.append(RECORD.pack(keyid, cents, epoch))
+
+                # Keys are written first so every record refers to a known key
+                if newkeys:
+                    with open(self.PATH + KEYS_SUFFIX, 'ab') as kf:
+                        kf.write(''.join(newkeys).encode('utf-8'))
+                    self._keys_offset = os.path.getsize(self.PATH + KEYS_SUFFIX)
+
+                f.write(b''.join(packed))
+                f.flush()
+                self._offset += len(packed)*RECORD.size
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+        return len(packed)
+
+    # Queries hold the lock too, since another request thread may be appending to the columns
+
+    def keyids(self, drug):
+        """Look up key ids by NAMEDOSE or by item number.
+        """
+        with self._lock:
+            if drug in self.KEYINDEX:
+                return [self.KEYINDEX[drug]]
+            return list(self.ITEMNUMINDEX.get(drug, []))
+
+    def history(self, keyid):
+        """Return (epoch, cents) pairs for a key, oldest first.
+        """
+        with self._lock:
+            return [(self.EPOCH[r], self.CENTS[r]) for r in self.ROWS[keyid]]
+
+    def price_at(self, keyid, epoch):
+        """Return the most recent price in cents on or before 'epoch', or None.
+        """
+        with self._lock:
+            rows = self.ROWS[keyid]
+            i = bisect_right(self.ROWEPOCHS[keyid], epoch)
+            if i == 0:
+                return None
+            return self.CENTS[rows[i-1]]
+
+    def period_deltas(self, keyid, period='month'):
+        """Return the closing price for each period along with the change from the previous period.
+
+        'period' is one of PERIODS; anything else raises ValueError.
+        """
+        if period not in PERIODS:
+            raise ValueError('Unknown period: {!r}'.format(period))
+
+        closing = {}
+        for epoch, cents in self.history(keyid):  # A snapshot taken under the lock
+            d = from_epoch(epoch)
+            label = '{:04d}-{:02d}'.format(d.year, d.month) if period == 'month' else '{:04d}'.format(d.year)
+            closing[label] = cents  # Rows are in date order, so the last price in a period wins
+
+        deltas = []
+        previous = None
+        for label in sorted(closing):
+            cents = closing[label]
+            change = None if previous is None else cents - previous
+            deltas.append({'period': label, 'cents': cents, 'change_cents': change})
+            previous = cents
+
+        return deltas
+
+    def top_movers(self, since, until=None, limit=10):
+        """Rank keys by the absolute percentage change in price between 'since' and 'until'.
+
+        The starting price is the most recent price on or before 'since', or the
+        first price after it if the drug was first seen in the window.
+        """
+        movers = []
+        with self._lock:
+            for keyid, rows in enumerate(self.ROWS):
+                epochs = self.ROWEPOCHS[keyid]
+
+                end = len(rows) if until is None else bisect_right(epochs, until)
+                start = max(bisect_right(epochs, since) - 1, 0)
+                if start >= end - 1:
+                    continue  # Fewer than two prices in the window
+
+                old = self.CENTS[rows[start]]
+                new = self.CENTS[rows[end-1]]
+                if old == new or old == 0:
+                    continue
+
+                movers.append((abs(new - old)/old, keyid, old, new))
+
+        movers.sort(reverse=True)
+
+        return [{'namedose': self.KEYS[keyid],
+                 'itemnum': self.ITEMNUMS[keyid],
+                 'old_cents': old,
+                 'new_cents': new,
+                 'change_cents': new - old,
+                 'change_percent': round(100*(new - old)/old, 2)}
+                for _, keyid, old, new in movers[:limit]]
+
+
+def load_history(history_path):
+    """Return the PriceHistory for a path, reading only what was appended since the last call.
+    """
+    with _histories_lock:
+        history = _histories.get(history_path)
+        if history is None:
+            history = _histories[history_path] = PriceHistory(history_path)
+    history._refresh()
+    return history
+
+
+def append_records(history_path, records):
+    """Record the prices of InvRec records in the price history.
+    """
+    return load_history(history_path).append(records)
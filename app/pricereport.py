@@ -0,0 +1,122 @@
+import os
+import csv
+from array import array
+from collections import namedtuple
+import app.formularyhelper as fh
+
+"""
+#########################################################
+## Formulary versus invoice price change report        ##
+#########################################################
+"""
+# Matched prices are collected column by column in integer hundredths of a
+# cent, so per unit prices below a cent are kept, with the low and high end of
+# a range in separate columns, and the whole diff is
+# computed in a single pass over the columns once matching is finished.
+
+PRICE_REPORT_FILENAME = 'price-changes.tsv'
+SIGNIFICANCE_PERCENT = 10  # Default percentage change at which a price change is flagged
+
+PriceChange = namedtuple('PriceChange', ['MD_NAMEDOSE', 'INV_NAMEDOSE', 'INV_ITEMNUM', 'OLD_LOW', 'OLD_HIGH',
+                                         'NEW_LOW', 'NEW_HIGH', 'CHANGE_SUBCENTS', 'CHANGE_PERCENT', 'SIGNIFICANT'])
+
+_HEADER_ = ['MD NAME DOSE', 'INVOICE NAME DOSE', 'ITEM NUM', 'OLD PRICE', 'NEW PRICE', 'CHANGE', 'CHANGE %',
+            'SIGNIFICANT']
+
+
+class PriceColumns:
+    """Matched formulary and invoice prices, one column per field.
+
+    * MD_NAMEDOSE, INV_NAMEDOSE, INV_ITEMNUM - labels for each matched pair
+    * OLD_LOW, OLD_HIGH - formulary price in hundredths of a cent
+    * NEW_LOW, NEW_HIGH - invoice price in hundredths of a cent
+    """
+
+    def __init__(self):
+        self.MD_NAMEDOSE = []
+        self.INV_NAMEDOSE = []
+        self.INV_ITEMNUM = []
+        self.OLD_LOW = array('q')
+        self.OLD_HIGH = array('q')
+        self.NEW_LOW = array('q')
+        self.NEW_HIGH = array('q')
+
+    def __len__(self):
+        return len(self.MD_NAMEDOSE)
+
+    def add(self, md_namedose, mdcost, inv_namedose, invcost, itemnum):
+        """Add a matched pair. Pairs whose prices cannot be parsed are skipped.
+        """
+        old = fh.parse_cost(mdcost)
+        new = fh.parse_cost(invcost)
+        if old is None or new is None:
+            return False
+
+        self.MD_NAMEDOSE.append(md_namedose)
+        self.INV_NAMEDOSE.append(inv_namedose)
+        self.INV_ITEMNUM.append(itemnum)
+        self.OLD_LOW.append(old[0])
+        self.OLD_HIGH.append(old[1])
+        self.NEW_LOW.append(new[0])
+        self.NEW_HIGH.append(new[1])
+        return True
+
+
+def price_change_report(columns, significance_percent=SIGNIFICANCE_PERCENT):
+    """Compute the price change of every matched pair and return the changes, largest first.
+
+    The change of a range is taken at whichever end moved the most. Percentages
+    are relative to the old price; a change from a price of zero counts as 100%.
+    Pairs whose price did not change are left out.
+    """
+    change_low = [n - o for n, o in zip(columns.NEW_LOW, columns.OLD_LOW)]
+    change_high = [n - o for n, o in zip(columns.NEW_HIGH, columns.OLD_HIGH)]
+    use_high = [abs(h) > abs(l) for l, h in zip(change_low, change_high)]
+    change = [h if u else l for l, h, u in zip(change_low, change_high, use_high)]
+    base = [oh if u else ol for ol, oh, u in zip(columns.OLD_LOW, columns.OLD_HIGH, use_high)]
+    percent = [100.0*c/b if b else 100.0*bool(c) for c, b in zip(change, base)]
+
+    report = [PriceChange(*row, SIGNIFICANT=abs(row[8]) >= significance_percent)
+              for row in zip(columns.MD_NAMEDOSE, columns.INV_NAMEDOSE, columns.INV_ITEMNUM,
+                             columns.OLD_LOW, columns.OLD_HIGH, columns.NEW_LOW, columns.NEW_HIGH,
+                             change, percent)
+              if (row[3], row[4]) != (row[5], row[6])]
+
+    report.sort(key=lambda r: (abs(r.CHANGE_PERCENT), abs(r.CHANGE_SUBCENTS)), reverse=True)
+
+    return report
+
+
+def write_report(report, report_path):
+    """Write a price change report as a tab separated spreadsheet.
+    """
+    with open(report_path, 'w') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(_HEADER_)
+        for r in report:
+            writer.writerow([r.MD_NAMEDOSE, r.INV_NAMEDOSE, r.INV_ITEMNUM,
+                             fh.subcents_to_cost(r.OLD_LOW, r.OLD_HIGH),
+                             fh.subcents_to_cost(r.NEW_LOW, r.NEW_HIGH),
+                             '{}{}'.format('-' if r.CHANGE_SUBCENTS < 0 else '', fh.subcents_to_cost(abs(r.CHANGE_SUBCENTS))),
+                             '{:.1f}'.format(r.CHANGE_PERCENT),
+                             str(r.SIGNIFICANT)])
+
+
+def read_report_columns(report_path):
+    """Read a written report back into PriceColumns so that more pairs can be added.
+    """
+    columns = PriceColumns()
+    if not os.path.isfile(report_path):
+        return columns
+
+    with open(report_path, 'r') as f:
+        readerobj = csv.reader(f, delimiter='\t')
+        next(readerobj)  # Skip line with column headings
+        for item in readerobj:
+            columns.add(item[0], item[3], item[1], item[4], item[2])
+
+    return columns
+
+
+def significant_count(report):
+    return sum(1 for r in report if r.SIGNIFICANT)
@@ -1,12 +1,22 @@
 import re
 import csv
+import json
 from statistics import mean
 from fuzzywuzzy import fuzz
 from datetime import datetime
 from collections import namedtuple, OrderedDict
 from dateutil.parser import parse
 import app.formularyhelper as fh
+import app.pricehistory as ph
+import app.pricereport as pr
+import app.metrics as mt
+import app.spreadsheet as ss
+import app.categorymap as cm
 import os
+import logging
+from app.eventlog import get_logger, event, audit
+
+log = get_logger('rxparse')
 
 """
 ###########################################################################
@@ -19,26 +29,76 @@ InvRec = namedtuple('InvoiceRecord', ['NAMEDOSE', 'NAME', 'DOSE', 'COST', 'CATEG
 FuzzyMatch = namedtuple('FuzzyMatch', ['MD_NAMEDOSE', 'MD_PRICE', 'INV_NAMEDOSE', 'INV_PRICE', 'INV_ITEMNUM'])
 
 
+# Invoice columns holding prices, which spreadsheets store as plain numbers
+_INVOICE_PRICE_COLUMNS_ = (15, 16)
+
+
+def filter_invoice(rows):
+    """Keep the drug entries of invoice rows, i.e. those with a five digit item number.
+    """
+    drugitemnumpatt = re.compile(r"\d{5}")
+    itemnumcolumnindex = 2
+
+    invoice = [i for i in rows if len(i) > itemnumcolumnindex and drugitemnumpatt.fullmatch(i[itemnumcolumnindex])]
+
+    return invoice
+
+
 def read_csv(filename):
     """Read and filter a csv to create a list of drug and price records.
     """
     # Open, read, and filter
-    with open(filename, 'rU') as f:
+    with open(filename, 'r') as f:
  
         # Instantiate csv.reader
         readerobj = csv.reader(f)
-        csvlines = [i for i in readerobj]
 
         # Filter for drug entries
-        drugitemnumpatt = "\d{5}"
-        itemnumcolumnindex = 2
-
-        invoice = [i for i in csvlines if re.fullmatch(drugitemnumpatt,\
-            i[itemnumcolumnindex])]
+        invoice = filter_invoice(readerobj)
 
         return invoice
 
 
+def spreadsheet_row_to_strings(row):
+    """Convert spreadsheet cell values to the strings a CSV export of the invoice holds.
+
+    Dates become '1/6/15 12:45', prices '$71.59' and whole numbers lose their '.0'.
+    """
+    strings = []
+
+    for column, value in enumerate(row):
+        if isinstance(value, datetime):
+            value = '{}/{}/{:02d} {}:{:02d}'.format(value.month, value.day, value.year % 100, value.hour, value.minute)
+        elif isinstance(value, bool):
+            value = str(value).upper()
+        elif isinstance(value, float):
+            if column in _INVOICE_PRICE_COLUMNS_:
+                value = '${:,.2f}'.format(value)
+            elif value.is_integer():
+                value = str(int(value))
+            else:
+                value = str(value)
+        strings.append(value)
+
+    return strings
+
+
+def read_spreadsheet(filename):
+    """Read and filter the first sheet of an XLS, XLSX or ODS invoice like read_csv does for CSV.
+
+    Rows are read one at a time, so only the drug entries are held in memory.
+    """
+    return filter_invoice(spreadsheet_row_to_strings(row) for row in ss.iter_rows(filename))
+
+
+def read_invoice(filename):
+    """Read and filter an invoice in CSV or spreadsheet format, by file extension.
+    """
+    if ss.is_spreadsheet(filename):
+        return read_spreadsheet(filename)
+    return read_csv(filename)
+
+
 def read_pricetable(pricetable_persist_path):
     """Import unique drug and price records from a persistent pricetable.
 
@@ -48,7 +108,7 @@ def read_pricetable(pricetable_persist_path):
     """
 
     # Open, read, and filter
-    with open(pricetable_persist_path, 'rU') as f:
+    with open(pricetable_persist_path, 'r') as f:
 
         # Instantiate csv.reader
         readerobj = csv.reader(f, delimiter='\t')
@@ -91,13 +151,10 @@ def read_pricetable(pricetable_persist_path):
         return pricetable
 
 
-def compare_pricetable(pricetable, invoice):
-    """Update pricetable using only unique and most recent drug and price records from medication invoice.
-
-    Parse drug and price records and load them as InvRec(Collections.namedtuple) instances.
-    Store uniquely in a dictionary by using the NAMEDOSE field as a key and the InvRec
-    instance as the value. If an entry with a more recent price is encountered, update the dictionary entry.
+def invoice_records(invoice):
+    """Parse drug and price records from a filtered invoice into InvRec(Collections.namedtuple) instances.
     """
+    records = []
 
     # Iterate over and parse each drug and price record
     for item in invoice:
@@ -117,6 +174,19 @@ def compare_pricetable(pricetable, invoice):
                 ON_FORMULARY = "NaN", \
                 REQDATE = converteddatetime)
 
+        records.append(entry)
+
+    return records
+
+
+def compare_records(pricetable, records):
+    """Update pricetable using only unique and most recent InvRec records.
+
+    Store uniquely in a dictionary by using the NAMEDOSE field as a key and the InvRec
+    instance as the value. If an entry with a more recent price is encountered, update the dictionary entry.
+    """
+    for entry in records:
+
         # Use NAMEDOSE field as the key 'k' for our dictionary of InvRec objects
         k = entry.NAMEDOSE
 
@@ -132,6 +202,16 @@ def compare_pricetable(pricetable, invoice):
     return pricetable
 
 
+def compare_pricetable(pricetable, invoice):
+    """Update pricetable using only unique and most recent drug and price records from medication invoice.
+
+    Parse drug and price records and load them as InvRec(Collections.namedtuple) instances.
+    Store uniquely in a dictionary by using the NAMEDOSE field as a key and the InvRec
+    instance as the value. If an entry with a more recent price is encountered, update the dictionary entry.
+    """
+    return compare_records(pricetable, invoice_records(invoice))
+
+
 def write_pricetable(pricetable, pricetable_path):
     """ Write as pricetable based on Invoice Records in CSV format.
     """
@@ -202,8 +282,145 @@ def match_string_fuzzy(string, phrase, set_similarity_rating):
     return is_fuzzy_match
 
 
-def formulary_update_from_pricetable(formulary, pricetable, set_similarity_rating=70):
+def match_formulary_records(records, nd, ir, set_similarity_rating=70, pricecolumns=None, categorymap=None,
+                            fuzzy=True):
+    """Compare one invoice-derived pricetable entry with the doses of formulary records.
+
+    'records' are (formulary position, FormularyRecord) pairs; the records are
+    updated in place. Every price change is also added to 'pricecolumns' and
+    every name and dose match learned into 'categorymap', if given.
+
+    Without 'fuzzy', only formulary names whose words are all in the invoice
+    name are looked at. Those always match fuzzily too, so the same matches
+    are found and the same ON FORMULARY flags set, but no fuzzy matches.
+
+    Returns whether any formulary name matched, the number of name and dose
+    matches, of soft matches and of price changes, the last fuzzy match as
+    (formulary position, FuzzyMatch) or None, and the number of fuzzy
+    comparisons made.
+    """
+    invnamedose = nd.lower()
+    invcost = ir.COST.lower()
+    itemnum = ir.ITEMNUM.lower()
+
+    # Keeps track of whether there a match for the pricetable medication
+    has_pricetable_match = False
+
+    mcount = 0
+    smatchcount = 0
+    pricechanges = 0
+    fuzzymatch = None
+    comparisons = 0
+
+    # Loop through each FormularyRecord
+    for position, record in records:
+
+        # Then loop through each dose/cost pair for the given record
+        for k, v in record.PRICETABLE.items():
+            mdcost = v.COST.lower()
+            mdnamedose = k.lower()
+            mdname = v.NAME.lower()
+            mddose = v.DOSE.lower()
+
+            dosepatt = re.compile(r"\b{}".format(mddose))
+
+            # Use fuzzy matching to capture edge cases
+            if fuzzy:
+                comparisons += 1
+                is_fuzzy_match = match_string_fuzzy(mdname, invnamedose, set_similarity_rating)
+            else:
+                is_fuzzy_match = match_string(mdname, invnamedose)
+            if is_fuzzy_match:
+
+                # Is soft match if formulary name is similar of pricetable name of same dose
+                if dosepatt.search(invnamedose):
+                    softmatch = True
+                    smatchcount += 1
+
+                # Is match formulary name is subset of pricetable name and doses are same
+                if match_string(mdname, invnamedose):
+
+                    # Mark if invoice entry as a match with an EHHapp formuary medication (regardless of dose)
+                    has_pricetable_match = True
+                    record.PRICETABLE[k] = v._replace(ON_FORMULARY = 'True')
+
+                    if dosepatt.search(invnamedose):
+
+                        mcount += 1
+                        if categorymap is not None:
+                            categorymap.learn(ir.CATEGORY, record.CATEGORY)
+
+                        if fh.price_differs(mdcost, invcost):
+                            pricechanges += 1
+                            if pricecolumns is not None:
+                                pricecolumns.add(k, mdcost, invnamedose, invcost, itemnum)
+                            record.PRICETABLE[k] = v._replace(COST = invcost, ITEMNUM = itemnum)
+                            event(audit, logging.INFO, 'price_change', source='invoice', inv_namedose=invnamedose,
+                                  md_namedose=k, itemnum=itemnum, old_price=mdcost, new_price=invcost)
+
+                # Is partial match if formulary name is not subset of pricetable name,
+                # formulary name is similar to pricetable name, and doses are same
+                else:
+                    record.PRICETABLE[k] = v._replace(ON_FORMULARY = 'False')
+                    if dosepatt.search(invnamedose):
+                        fuzzymatch = position, FuzzyMatch(
+                            MD_NAMEDOSE = mdnamedose,\
+                            MD_PRICE = mdcost,\
+                            INV_NAMEDOSE = invnamedose,\
+                            INV_PRICE = invcost,\
+                            INV_ITEMNUM = itemnum)
+                        event(log, logging.DEBUG, 'fuzzy_match', md_namedose=mdnamedose, inv_namedose=invnamedose,
+                              itemnum=itemnum)
+                        '''
+                        print('\nFound a poor match...')
+                        print('Formulary name and dose is: '+str(mdname)+' '+ str(mddose))
+                        print('Invoice name and dose is: '+str(invnamedose))
+
+                        user_input = input('Are these the same medication?\nPlease type \'y\' or \'n\': ')
+
+                        while not user_input == 'y' and not user_input == 'n':
+                            user_input = input('Please try again. Are these the same medication?\nPlease type \'y\' or \'n\': ') # error check for user input
+
+                        if user_input == 'y':
+                            has_pricetable_match = True
+                            mcount += 1
+                            if price_disc(mdcost, invcost):
+                                pricechanges += 1
+                                record.PRICETABLE[k] = v._replace(COST = invcost, ITEMNUM = itemnum)
+                                print("New price found for {} a.k.a. {}\nFormulary price: {}\nInvoice price: {}".format(invnamedose, k, mdcost, invcost))
+                                print("Formulary updated so price is now {}".format(record.PRICETABLE[k].COST))
+                        elif user_input == 'n':
+                            print('This medication price will not be changed.')
+                        '''
+            else:
+                record.PRICETABLE[k] = v._replace(ON_FORMULARY = 'False')
+
+    return has_pricetable_match, mcount, smatchcount, pricechanges, fuzzymatch, comparisons
+
+
+def _mark_unvisited(records, lastvisit, line):
+    # Every invoice line sets the ON FORMULARY flag of every dose it is compared with,
+    # so a record that was skipped by the line before 'line' is left as if no name matched there
+    for position, record in records:
+        if lastvisit[position] < line - 1:
+            for k, v in record.PRICETABLE.items():
+                record.PRICETABLE[k] = v._replace(ON_FORMULARY = 'False')
+        lastvisit[position] = line
+
+
+def formulary_update_from_pricetable(formulary, pricetable, set_similarity_rating=70, pricecolumns=None,
+                                     categorymap=None, category_mode=cm.MODE_OFF):
     """Update drugs in formulary with prices from invoice.
+
+    Prices are compared by value, to a hundredth of a cent. Every price change is also added to
+    'pricecolumns' (a pricereport.PriceColumns), if given.
+
+    With a 'categorymap' (a categorymap.CategoryMap), each invoice medication is
+    compared with the formulary categories mapped to its commodity, as set by
+    'category_mode', and every name and dose match is learned into the map.
+    In 'first' mode the rest of the formulary is searched too: with fuzzy
+    matching if no name and dose matched within the mapped categories, and
+    otherwise only for other doses and categories of the drugs that matched.
     """
     # Keeps track of soft matches
     smatchcount = 0
@@ -220,102 +437,145 @@ def formulary_update_from_pricetable(formulary, pricetable, set_similarity_ratin
     # Captures fuzzy matches between invoice and formulary medications
     fuzzymatches = {}
 
+    # Keeps track of work done for the metrics counters
+    fuzzycomparisons = 0
+    dosecomparisons = 0
+
     # Loop through each FormularyRecord
     for record in formulary:
         # Set the PRICETABLE attribute
         record._set_PRICETABLE()
 
-    # Look up a matching record stored in the invoice-derived pricetable
-    for nd, ir in pricetable.items():
-        invnamedose = nd.lower()
-        invcost = ir.COST.lower()
-        itemnum = ir.ITEMNUM.lower()
+    # Formulary records by category, and (mapped, remaining) record lists by set of mapped categories
+    indexed = list(enumerate(formulary))
+    partition = categorymap is not None and category_mode != cm.MODE_OFF
+    partitions = cm.partition_formulary(formulary) if partition else None
+    partitioncache = {}
+    lookups = {}
+    prunedcomparisons = 0
+    formularydoses = sum(len(record.PRICETABLE) for record in formulary)
 
-        # Keeps track of whether there a match for each pricetable medication
-        has_pricetable_match = False
+    # Last invoice line each record was compared with
+    lastvisit = [-1]*len(formulary)
 
-        # Loop through each FormularyRecord
-        for record in formulary:
-
-            # Then loop through each dose/cost pair for the given record
-            for k, v in record.PRICETABLE.items():
-                mdcost = v.COST.lower()
-                mdnamedose = k.lower()
-                mdname = v.NAME.lower()
-                mddose = v.DOSE.lower()
+    # Look up a matching record stored in the invoice-derived pricetable
+    for line, (nd, ir) in enumerate(pricetable.items()):
+
+        # Records to compare with, in turn
+        searches = [indexed]
+        mapped = categorymap.categories(ir.CATEGORY) if partition else None
+        if mapped:
+            key = frozenset(mapped)
+            if key not in partitioncache:
+                inside = sorted((pair for category in partitions if category in key for pair in partitions[category]),
+                                key=lambda pair: pair[0])
+                outside = sorted((pair for category in partitions if category not in key for pair in partitions[category]),
+                                 key=lambda pair: pair[0])
+                partitioncache[key] = (inside, outside)
+            inside, outside = partitioncache[key]
+            searches = [inside, outside] if category_mode == cm.MODE_FIRST else [inside]
 
-                dosepatt = re.compile(r"\b{}".format(mddose))
+        has_pricetable_match = False
+        linemcount = 0
+        linecomparisons = 0
+        fuzzymatch = None
+        searched = 0
+
+        for records in searches:
+            # Once a name and dose matched, the rest of the formulary is only checked for other drugs of that name
+            fuzzy = not linemcount
+            if fuzzy:
+                if searched:
+                    event(log, logging.DEBUG, 'category_fallback', inv_namedose=nd.lower(), commodity=ir.CATEGORY)
+                searched += 1
+
+            _mark_unvisited(records, lastvisit, line)
+            matched, m, s, p, f, c = match_formulary_records(records, nd, ir, set_similarity_rating, pricecolumns,
+                                                             categorymap, fuzzy)
+            has_pricetable_match = has_pricetable_match or matched
+            linemcount += m
+            smatchcount += s
+            pricechanges += p
+            linecomparisons += c
+            dosecomparisons += sum(len(record.PRICETABLE) for _, record in records)
+
+            # The match found last in formulary order is kept, as when the whole formulary is searched at once
+            if f is not None and (fuzzymatch is None or f[0] > fuzzymatch[0]):
+                fuzzymatch = f
+
+        mcount += linemcount
+        fuzzycomparisons += linecomparisons
+        if fuzzymatch is not None:
+            fuzzymatches[fuzzymatch[1].INV_NAMEDOSE] = fuzzymatch[1]
+
+        if has_pricetable_match:
+            pricetable[nd] = ir._replace(ON_FORMULARY = 'True')
+        else:
+            capture = nd.lower()
+            pricetable_unmatched_meds.add(capture)
+            pricetable[nd] = ir._replace(ON_FORMULARY = 'False')
 
-                # Use fuzzy matching to capture edge cases
-                if match_string_fuzzy(mdname, invnamedose, set_similarity_rating):
+        # Count how the line was searched, and the comparisons the mapped categories saved
+        if partition:
+            if not mapped:
+                lookup = 'unmapped'
+            elif searched > 1:
+                lookup = 'fallback'
+            elif has_pricetable_match:
+                lookup = 'hit'
+            else:
+                lookup = 'miss'
+            lookups[lookup] = lookups.get(lookup, 0) + 1
+            prunedcomparisons += formularydoses - linecomparisons
+
+    # Records the last line skipped are left as if it had been compared with them
+    _mark_unvisited(indexed, lastvisit, len(pricetable))
+
+    mt.inc('formulary_fuzzy_comparisons_total', fuzzycomparisons)
+    mt.inc('formulary_dose_comparisons_total', dosecomparisons)
+    if partition:
+        categorymap.COMPARISONS += fuzzycomparisons
+        categorymap.PRUNED += prunedcomparisons
+        categorymap.LOOKUPS.update(lookups)
+        mt.inc('formulary_fuzzy_comparisons_pruned_total', prunedcomparisons)
+        for lookup, lines in sorted(lookups.items()):
+            mt.inc('formulary_category_lookups_total', lines, result=lookup)
 
-                    # Is soft match if formulary name is similar of pricetable name of same dose
-                    if dosepatt.search(invnamedose):
-                        softmatch = True
-                        smatchcount += 1
+    return mcount, pricechanges, formulary, pricetable, smatchcount, pricetable_unmatched_meds, fuzzymatches
 
-                    # Is match formulary name is subset of pricetable name and doses are same
-                    if match_string(mdname, invnamedose):
 
-                        # Mark if invoice entry as a match with an EHHapp formuary medication (regardless of dose)
-                        has_pricetable_match = True
-                        record.PRICETABLE[k] = v._replace(ON_FORMULARY = 'True')
-                        pricetable[nd] = ir._replace(ON_FORMULARY = 'True')
+def write_fuzzymatches(fuzzymatches, fuzzymatches_path):
+    """Save fuzzy matches for review as a JSON list, ordered by invoice NAMEDOSE.
 
-                        if dosepatt.search(invnamedose):
+    The position of a match in the list is its id on the selection page.
+    The file is renamed into place, since other jobs read it while compacting.
+    Returns the list of FuzzyMatch entries as saved.
+    """
+    matchlist = [fuzzymatches[k] for k in sorted(fuzzymatches)]
 
-                            mcount += 1
+    tmp_path = '{}.{}.tmp'.format(fuzzymatches_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump([list(m) for m in matchlist], f)
+    os.replace(tmp_path, fuzzymatches_path)
 
-                            if mdcost != invcost:
-                                pricechanges += 1
-                                record.PRICETABLE[k] = v._replace(COST = invcost, ITEMNUM = itemnum)
-                                print("New price found for {} a.k.a. {}\nFormulary price: {}\nInvoice price: {}".format(invnamedose, k, mdcost, invcost))
-                                print("Formulary updated so price is now {}".format(record.PRICETABLE[k].COST))
+    return matchlist
 
-                    # Is partial match if formulary name is not subset of pricetable name,
-                    # formulary name is similar to pricetable name, and doses are same
-                    else:
-                        record.PRICETABLE[k] = v._replace(ON_FORMULARY = 'False')
-                        if dosepatt.search(invnamedose):
-                            fuzzymatches[invnamedose] = FuzzyMatch(
-                                MD_NAMEDOSE = mdnamedose,\
-                                MD_PRICE = mdcost,\
-                                INV_NAMEDOSE = invnamedose,\
-                                INV_PRICE = invcost,\
-                                INV_ITEMNUM = itemnum)
-                            '''
-                            print('\nFound a poor match...')
-                            print('Formulary name and dose is: '+str(mdname)+' '+ str(mddose))
-                            print('Invoice name and dose is: '+str(invnamedose))
-
-                            user_input = input('Are these the same medication?\nPlease type \'y\' or \'n\': ')
-
-                            while not user_input == 'y' and not user_input == 'n':
-                                user_input = input('Please try again. Are these the same medication?\nPlease type \'y\' or \'n\': ') # error check for user input
-
-                            if user_input == 'y':
-                                has_pricetable_match = True
-                                mcount += 1
-                                if price_disc(mdcost, invcost):
-                                    pricechanges += 1
-                                    record.PRICETABLE[k] = v._replace(COST = invcost, ITEMNUM = itemnum)
-                                    print("New price found for {} a.k.a. {}\nFormulary price: {}\nInvoice price: {}".format(invnamedose, k, mdcost, invcost))
-                                    print("Formulary updated so price is now {}".format(record.PRICETABLE[k].COST))
-                            elif user_input == 'n':
-                                print('This medication price will not be changed.')
-                            '''
-                else:
-                    record.PRICETABLE[k] = v._replace(ON_FORMULARY = 'False')
-        if has_pricetable_match == False:
-            capture = invnamedose
-            pricetable_unmatched_meds.add(capture)
-            pricetable[nd] = ir._replace(ON_FORMULARY = 'False')
 
-    return mcount, pricechanges, formulary, pricetable, smatchcount, pricetable_unmatched_meds, fuzzymatches
+def read_fuzzymatches(fuzzymatches_path):
+    """Load the list of fuzzy matches saved by write_fuzzymatches.
+    """
+    with open(fuzzymatches_path, 'r') as f:
+        return [FuzzyMatch(*item) for item in json.load(f)]
 
 
-def formulary_update_from_usermatches(formulary, pricetable, pricetable_unmatched_meds, usermatches):
+def formulary_update_from_usermatches(formulary, pricetable, pricetable_unmatched_meds, usermatches, pricecolumns=None,
+                                      categorymap=None, missing=None):
     """Update drugs in formulary with prices from user.
+
+    'usermatches' are the FuzzyMatch entries the user confirmed.
+    Every price change is also added to 'pricecolumns', if given, and every
+    match is learned into 'categorymap', if given. Matches whose invoice row
+    is no longer in 'pricetable' are skipped and added to 'missing', if given.
     """
     # Keeps track of the number of matches
     newmcount = 0
@@ -328,19 +588,21 @@ def formulary_update_from_usermatches(formulary, pricetable, pricetable_unmatche
 
     # Add fuzzy matches info to a dictionary
     matches = {}
-    for line in usermatches:
 
-        # Divide each line into items which have been deliminated by ":"
-        item = line.split(':')
-        print(item)
-
-        # Instantiate namedtuple from using values returned by list indices
-        entry = FuzzyMatch(
-            MD_NAMEDOSE = item[0],\
-            MD_PRICE = item[1],\
-            INV_NAMEDOSE = item[2],\
-            INV_PRICE = item[3],\
-            INV_ITEMNUM = item[4])
+    # Invoice commodity of each matched medication, by formulary NAMEDOSE
+    commodities = {}
+    for entry in usermatches:
+        event(log, logging.DEBUG, 'user_match', md_namedose=entry.MD_NAMEDOSE, inv_namedose=entry.INV_NAMEDOSE,
+              itemnum=entry.INV_ITEMNUM)
+
+        # The invoice row may have been archived since the match was offered
+        v = pricetable.get(entry.INV_NAMEDOSE.upper())
+        if v is None:
+            event(log, logging.WARNING, 'user_match_missing', md_namedose=entry.MD_NAMEDOSE,
+                  inv_namedose=entry.INV_NAMEDOSE, itemnum=entry.INV_ITEMNUM)
+            if missing is not None:
+                missing.append(entry)
+            continue
 
         # Use markdown formulary NAMEDOSE field as the key 'k' for our dictionary of InvRec objects
         k = entry.MD_NAMEDOSE
@@ -350,8 +612,8 @@ def formulary_update_from_usermatches(formulary, pricetable, pricetable_unmatche
 
         # Update the persistent pricetable
         # Note that medication is on the formulary
-        v = pricetable[entry.INV_NAMEDOSE.upper()]
         pricetable[k] = v._replace(ON_FORMULARY = 'True')
+        commodities[k.lower()] = v.CATEGORY
 
     # Loop through each FormularyRecord
     for record in formulary:
@@ -374,13 +636,17 @@ def formulary_update_from_usermatches(formulary, pricetable, pricetable_unmatche
                 if md_namedose == mdnamedose:
 
                     newmcount += 1
+                    if categorymap is not None:
+                        categorymap.learn(commodities[md_namedose], record.CATEGORY)
 
                     # Update formulary medication price if there is price difference
-                    if mdcost != inv_price:
+                    if fh.price_differs(mdcost, inv_price):
                         newpricechanges += 1
+                        if pricecolumns is not None:
+                            pricecolumns.add(k, mdcost, inv_namedose, inv_price, inv_itemnum)
                         record.PRICETABLE[k] = v._replace(COST = inv_price, ITEMNUM = inv_itemnum, ON_FORMULARY = 'True')
-                        print("New price found for {} a.k.a. {}\nFormulary price: {}\nInvoice price: {}".format(inv_namedose, k, mdcost, inv_price))
-                        print("Formulary updated so price is now {}".format(record.PRICETABLE[k].COST))
+                        event(audit, logging.INFO, 'price_change', source='user_match', inv_namedose=inv_namedose,
+                              md_namedose=k, itemnum=inv_itemnum, old_price=mdcost, new_price=inv_price)
 
             # Remove user matched medcations from the list of unmatched invoice mediations
             pricetable_unmatched_meds.discard(md_namedose)
@@ -434,19 +700,64 @@ def screen_and_console_print(output, screen_output):
 '''
 
 
-def process_pricetable(invoice_path, pricetable_persist_path, debug=True, verbose_debug=False):
+def default_output_folder():
+    '''Output folder used when the caller does not provide one.
+    '''
+    current_script_path = os.path.realpath(__file__)[:-len('/rxparse.py')]
+    return current_script_path+'/output'
+
+
+def screen_output_row(screen_output, label):
+    '''Return the [label, value] row of 'screen_output' with the given label.
+    '''
+    for row in screen_output:
+        if row[0] == label:
+            return row
+    raise KeyError(label)
+
+
+def read_category_map(category_map_path):
+    '''Load the category map at 'category_map_path', or return None if no path is given.
+    '''
+    if not category_map_path:
+        return None
+
+    with mt.stage('read_category_map') as s:
+        categorymap = cm.read_category_map(category_map_path)
+        s.ROWS_OUT = len(categorymap)
+    mt.file_read(category_map_path, 'category_map')
+    return categorymap
+
+
+def save_category_map(categorymap, category_map_path):
+    '''Add the commodity to category matches learned during this run to the category map file.
+    '''
+    if categorymap is None or not categorymap.NEW:
+        return
+
+    with mt.stage('save_category_map', rows_in=len(categorymap.NEW)) as s:
+        s.ROWS_OUT = cm.save_learned(categorymap, category_map_path)
+    mt.file_written(category_map_path, 'category_map')
+
+
+def process_pricetable(invoice_path, pricetable_persist_path, debug=True, verbose_debug=False, output_folder=None,
+                       history_path=None):
     '''Main function of script. Creates updated formulary markdown and pricetable.
 
     Data files need to be place in a subfolder named "input".
     Input varibles are filenames without the file path prefix.
     Verbose output displays subsets of data during each step of processing.
+    Output files are placed in 'output_folder', by default the "output" subfolder.
+    Every invoice price is also appended to the price history at 'history_path', if given.
     '''
     # Process FileIO
     output_filename_list = []
 
+    if output_folder is None:
+        output_folder = default_output_folder()
+
     pricetable_filename = pricetable_persist_path.split('/')[-1]  # Remove directory from filename
-    current_script_path = os.path.realpath(__file__)[:-len('/rxparse.py')]
-    pricetable_output_path = current_script_path+'/output/'+pricetable_filename
+    pricetable_output_path = os.path.join(output_folder, pricetable_filename)
     ''' TODO DELETE AFTER CONFIRMING
     pricetable_filename_no_extension = pricetable_filename.split('.', 1)[0]
     current_script_path = os.path.realpath(__file__)[:-len('/rxparse.py')]
@@ -464,7 +775,10 @@ def process_pricetable(invoice_path, pricetable_persist_path, debug=True, verbos
     # Processing Invoice
     print('\nProcessing Invoice...')
 
-    recordlist = read_csv(str(invoice_path))
+    with mt.stage('read_invoice') as s:
+        recordlist = read_invoice(str(invoice_path))
+        s.ROWS_OUT = len(recordlist)
+    mt.file_read(str(invoice_path), 'invoice')
     print('Number of invoice entries: {}'.format(len(recordlist)))
     screen_output.append(['Number of invoice entries',len(recordlist)])
 
@@ -472,12 +786,31 @@ def process_pricetable(invoice_path, pricetable_persist_path, debug=True, verbos
         print('Sample Invoice:')
         print(recordlist[0])
 
-    if os.path.isfile(pricetable_persist_path):
-        pricetable = read_pricetable(pricetable_persist_path)
-    else:
-        pricetable = {}
-    pricetable_updated = compare_pricetable(pricetable, recordlist)
-    write_pricetable(pricetable, pricetable_persist_path)
+    with mt.stage('read_pricetable') as s:
+        if os.path.isfile(pricetable_persist_path):
+            pricetable = read_pricetable(pricetable_persist_path)
+            mt.file_read(pricetable_persist_path, 'pricetable')
+        else:
+            pricetable = {}
+        s.ROWS_OUT = len(pricetable)
+
+    with mt.stage('parse_invoice', rows_in=len(recordlist)) as s:
+        invoicerecords = invoice_records(recordlist)
+        s.ROWS_OUT = len(invoicerecords)
+
+    with mt.stage('compare_pricetable', rows_in=len(invoicerecords)) as s:
+        pricetable_updated = compare_records(pricetable, invoicerecords)
+        s.ROWS_OUT = len(pricetable_updated)
+
+    if history_path:
+        with mt.stage('append_price_history', rows_in=len(invoicerecords)) as s:
+            newprices = ph.append_records(history_path, invoicerecords)
+            s.ROWS_OUT = newprices
+        print('Number of new price history entries: {}'.format(newprices))
+
+    with mt.stage('write_pricetable', rows_in=len(pricetable)):
+        write_pricetable(pricetable, pricetable_persist_path)
+    mt.file_written(pricetable_persist_path, 'pricetable')
 
     print('Number of price table entries: {}'.format(len(pricetable)))
     screen_output.append(['Number of price table entries',len(pricetable)])
@@ -485,14 +818,22 @@ def process_pricetable(invoice_path, pricetable_persist_path, debug=True, verbos
     return(screen_output, output_filename_list, pricetable_output_path)
 
 
-def process_formulary(pricetable_persist_path, formulary_md_path, output_filename_list, screen_output, verbose_debug=False):
+def process_formulary(pricetable_persist_path, formulary_md_path, output_filename_list, screen_output, verbose_debug=False,
+                      output_folder=None, significance_percent=pr.SIGNIFICANCE_PERCENT, category_map_path=None,
+                      category_mode=cm.MODE_OFF):
     # Load updated pricetable
-    pricetable = read_pricetable(pricetable_persist_path)
+    with mt.stage('read_pricetable') as s:
+        pricetable = read_pricetable(pricetable_persist_path)
+        s.ROWS_OUT = len(pricetable)
+    mt.file_read(pricetable_persist_path, 'pricetable')
 
     # Processing formulary
     print('\nProcessing Formulary Markdown...')
-    formularylist = fh.read_md(str(formulary_md_path))
-    formularyparsed = fh.parse_mddata(formularylist)
+    with mt.stage('read_formulary') as s:
+        formularylist = fh.read_md(str(formulary_md_path))
+        formularyparsed = fh.parse_mddata(formularylist)
+        s.ROWS_OUT = len(formularyparsed)
+    mt.file_read(str(formulary_md_path), 'formulary')
 
     print('Number of EHHapp formulary medications: {}'.format(len(formularyparsed)))
     screen_output.append(['Number of EHHapp formulary medications',len(formularyparsed)])
@@ -504,12 +845,21 @@ def process_formulary(pricetable_persist_path, formulary_md_path, output_filenam
             print('from Formulary: NAME:{} DOSECOST:{}'.format(fh.FormularyRecord(formularyparsed[i]).NAME,
                                                                fh.FormularyRecord(formularyparsed[i]).DOSECOST))
 
-    formulary = fh.store_formulary(formularyparsed)
+    with mt.stage('store_formulary', rows_in=len(formularyparsed)) as s:
+        formulary = fh.store_formulary(formularyparsed)
+        s.ROWS_OUT = len(formulary)
+
+    # Invoice commodities are matched against their mapped formulary categories, if a map is kept
+    categorymap = read_category_map(category_map_path)
 
     # Updating Formulary Against Invoice
     print('\nFinding Matches...')
-    mcount, pricechanges, updatedformulary, updatedpricetable, softmatch, pricetable_unmatched_meds, fuzzymatches =\
-        formulary_update_from_pricetable(formulary, pricetable)
+    pricecolumns = pr.PriceColumns()
+    with mt.stage('match_pricetable', rows_in=len(pricetable)) as s:
+        mcount, pricechanges, updatedformulary, updatedpricetable, softmatch, pricetable_unmatched_meds, fuzzymatches =\
+            formulary_update_from_pricetable(formulary, pricetable, pricecolumns=pricecolumns,
+                                             categorymap=categorymap, category_mode=category_mode)
+        s.ROWS_OUT = mcount
 
     print('Number of partial medication matches: {}'.format(softmatch))
     screen_output.append(['Number of partial medication matches',softmatch])
@@ -537,49 +887,106 @@ def process_formulary(pricetable_persist_path, formulary_md_path, output_filenam
     print('Number of blacklisted drugs: {}'.format(len(blacklisted)))
     screen_output.append(['Number of blacklisted drugs',len(blacklisted)])
 
+    # Save price change report
+    if output_folder is None:
+        output_folder = default_output_folder()
+    with mt.stage('price_report', rows_in=len(pricecolumns)) as s:
+        report = pr.price_change_report(pricecolumns, significance_percent)
+        pr.write_report(report, os.path.join(output_folder, pr.PRICE_REPORT_FILENAME))
+        s.ROWS_OUT = len(report)
+    mt.file_written(os.path.join(output_folder, pr.PRICE_REPORT_FILENAME), 'price_report')
+
+    print('Number of significant price changes: {}'.format(pr.significant_count(report)))
+    screen_output.append(['Number of significant price changes',pr.significant_count(report)])
+
+    if categorymap is not None and category_mode != cm.MODE_OFF:
+        print('Number of comparisons skipped by category: {}'.format(categorymap.PRUNED))
+        screen_output.append(['Number of comparisons skipped by category',categorymap.PRUNED])
+        event(log, logging.INFO, 'category_matching', mode=category_mode, comparisons=categorymap.COMPARISONS,
+              pruned=categorymap.PRUNED, **categorymap.LOOKUPS)
+    save_category_map(categorymap, category_map_path)
+
     # Save updated pricetable
-    write_pricetable(updatedpricetable, pricetable_persist_path)
-    write_pricetable
+    with mt.stage('write_pricetable', rows_in=len(updatedpricetable)):
+        write_pricetable(updatedpricetable, pricetable_persist_path)
+    mt.file_written(pricetable_persist_path, 'pricetable')
 
     return pricetable_unmatched_meds, output_filename_list, screen_output, fuzzymatches
 
 
 def process_usermatches(usermatches, formulary_md_path, pricetable_unmatched_meds, pricetable_persist_path,
-                        pricetable_output_path, output_filename_list, screen_output):
+                        pricetable_output_path, output_filename_list, screen_output, output_folder=None,
+                        significance_percent=pr.SIGNIFICANCE_PERCENT, category_map_path=None):
     # Load updated pricetable
-    pricetable = read_pricetable(pricetable_persist_path)
+    with mt.stage('read_pricetable') as s:
+        pricetable = read_pricetable(pricetable_persist_path)
+        s.ROWS_OUT = len(pricetable)
+    mt.file_read(pricetable_persist_path, 'pricetable')
 
     # Process FileIO
     formulary_md_filename = formulary_md_path.split('/')[-1]  # Remove directory from filename
     formulary_md_filename_no_extension = formulary_md_filename.split('.', 1)[0]
 
-    current_script_path = os.path.realpath(__file__)[:-len('/rxparse.py')]
+    if output_folder is None:
+        output_folder = default_output_folder()
 
-    formulary_update_rm_path = current_script_path+'/output/'+formulary_md_filename_no_extension+'_UPDATED.markdown'
+    formulary_update_rm_path = os.path.join(output_folder, formulary_md_filename_no_extension+'_UPDATED.markdown')
     output_filename_list.append(formulary_md_filename_no_extension+'_UPDATED.markdown')
-    formulary_update_tsv_path = current_script_path+'/output/'+formulary_md_filename_no_extension+'_UPDATED.tsv'
+    formulary_update_tsv_path = os.path.join(output_folder, formulary_md_filename_no_extension+'_UPDATED.tsv')
     output_filename_list.append(formulary_md_filename_no_extension+'_UPDATED.tsv')
 
     # Processing formulary
     print('\nProcessing Formulary Markdown...')
-    formularylist = fh.read_md(str(formulary_md_path))
-    formularyparsed = fh.parse_mddata(formularylist)
-    formulary = fh.store_formulary(formularyparsed)
-
-    updatedpricetable, updatedformulary, newmcount, newpricechanges, pricetable_unmatched_meds= formulary_update_from_usermatches(formulary, pricetable, pricetable_unmatched_meds, usermatches)
+    with mt.stage('read_formulary') as s:
+        formularylist = fh.read_md(str(formulary_md_path))
+        formularyparsed = fh.parse_mddata(formularylist)
+        s.ROWS_OUT = len(formularyparsed)
+    mt.file_read(str(formulary_md_path), 'formulary')
+
+    with mt.stage('store_formulary', rows_in=len(formularyparsed)) as s:
+        formulary = fh.store_formulary(formularyparsed)
+        s.ROWS_OUT = len(formulary)
+
+    # Add user matched price changes to the report started by process_formulary
+    report_path = os.path.join(output_folder, pr.PRICE_REPORT_FILENAME)
+    mt.file_read(report_path, 'price_report')
+    pricecolumns = pr.read_report_columns(report_path)
+
+    categorymap = read_category_map(category_map_path)
+    missing = []
+    with mt.stage('match_usermatches', rows_in=len(usermatches)) as s:
+        updatedpricetable, updatedformulary, newmcount, newpricechanges, pricetable_unmatched_meds= formulary_update_from_usermatches(formulary, pricetable, pricetable_unmatched_meds, usermatches, pricecolumns, categorymap, missing)
+        s.ROWS_OUT = newmcount
+    mt.inc('formulary_user_matches_missing_total', len(missing))
+    save_category_map(categorymap, category_map_path)
+
+    with mt.stage('price_report', rows_in=len(pricecolumns)) as s:
+        report = pr.price_change_report(pricecolumns, significance_percent)
+        pr.write_report(report, report_path)
+        s.ROWS_OUT = len(report)
+    mt.file_written(report_path, 'price_report')
 
     # Save updated formulary as markdown and tsv
-    formulary_to_markdown(updatedformulary, formulary_update_rm_path)
-    formulary_to_tsv(updatedformulary, formulary_update_tsv_path)
+    with mt.stage('write_formulary', rows_in=len(updatedformulary)):
+        formulary_to_markdown(updatedformulary, formulary_update_rm_path)
+        formulary_to_tsv(updatedformulary, formulary_update_tsv_path)
+    mt.file_written(formulary_update_rm_path, 'formulary')
+    mt.file_written(formulary_update_tsv_path, 'formulary_tsv')
 
-    print(updatedpricetable)
+    event(log, logging.DEBUG, 'pricetable_updated', entries=len(updatedpricetable))
     # Save updated pricetable
-    write_pricetable(updatedpricetable, pricetable_persist_path)
-    write_pricetable(updatedpricetable, pricetable_output_path)
+    with mt.stage('write_pricetable', rows_in=len(updatedpricetable)):
+        write_pricetable(updatedpricetable, pricetable_persist_path)
+        write_pricetable(updatedpricetable, pricetable_output_path)
+    mt.file_written(pricetable_persist_path, 'pricetable')
+    mt.file_written(pricetable_output_path, 'pricetable')
 
     # Update screen outputs
-    screen_output[4][1] = screen_output[4][1] + newmcount  # Number of matches
-    screen_output[5][1] = screen_output[5][1] + newpricechanges  # Number of price changes
-    screen_output[6][1] = screen_output[6][1] - newmcount  # Number of unmatched invoice entries
+    screen_output_row(screen_output, 'Number of medication matches')[1] += newmcount
+    screen_output_row(screen_output, 'Number of EHHapp formulary price changes')[1] += newpricechanges
+    screen_output_row(screen_output, 'Number of invoice medications without match')[1] -= newmcount
+    screen_output_row(screen_output, 'Number of significant price changes')[1] = pr.significant_count(report)
+    if missing:
+        screen_output.append(['Selected matches no longer in the price table',', '.join(m.INV_NAMEDOSE for m in missing)])
 
     return pricetable_unmatched_meds, screen_output
\ No newline at end of file
@@ -0,0 +1,328 @@
+import re
+import zipfile
+import posixpath
+from datetime import datetime, timedelta
+from xml.etree.ElementTree import iterparse
+
+try:
+    import xlrd  # Optional, only needed for .xls workbooks
+except ImportError:
+    xlrd = None
+
+"""
+#####################################################################
+## Row by row readers for XLS, XLSX and ODS workbooks              ##
+#####################################################################
+"""
+# Each reader yields the rows of the first sheet of a workbook as lists of
+# cell values: str, float, bool, datetime for date cells, and '' for empty
+# cells. Rows without any values are skipped.
+#
+# XLSX and ODS files are zip archives of XML. Their sheet XML is parsed
+# incrementally with iterparse and every row is discarded once it has been
+# yielded, so memory use does not grow with the number of rows (XLSX shared
+# strings are the exception, they are held for the whole sheet).
+#
+# XLS files use the binary BIFF format and are read with xlrd, which loads
+# the whole sheet; it is only imported when an .xls file is read.
+
+SPREADSHEET_EXTENSIONS = set(['xls', 'xlsx', 'ods'])
+
+_CELLREFPATT_ = re.compile(r'([A-Z]+)')
+_DATEFMTPATT_ = re.compile(r'[dmyhs]', re.I)
+_FMTLITERALPATT_ = re.compile(r'"[^"]*"|\[[^\]]*\]|\\.')
+
+# Built in XLSX number formats that show dates or times
+_XLSX_DATE_FORMATS_ = set(range(14, 23)) | set(range(27, 37)) | set(range(45, 48)) | set(range(50, 59))
+
+_ODS_NS_ = {
+    'table': 'urn:oasis:names:tc:opendocument:xmlns:table:1.0',
+    'office': 'urn:oasis:names:tc:opendocument:xmlns:office:1.0',
+}
+
+
+_LOCALNAMES_ = {}
+_COLUMNS_ = {}
+
+
+def _local(tag):
+    # Drop the namespace so both transitional and strict XLSX files can be read.
+    # A sheet only uses a handful of tags, so the result is memoised.
+    try:
+        return _LOCALNAMES_[tag]
+    except KeyError:
+        return _LOCALNAMES_.setdefault(tag, tag.rsplit('}', 1)[-1])
+
+
+def _attr(elem, ns, name):
+    return elem.get('{{{}}}{}'.format(_ODS_NS_[ns], name))
+
+
+def _is_empty(row):
+    return all(v == '' for v in row)
+
+
+def _iter_rows(f, row_tag, stop_tag=None):
+    """Yield each complete row element of an XML sheet, removing it from the tree afterwards.
+
+    Parsing stops at the end of the first 'stop_tag' element, if given.
+    """
+    stack = []
+    for action, elem in iterparse(f, events=('start', 'end')):
+        if action == 'start':
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        tag = _local(elem.tag)
+        if tag == row_tag:
+            yield elem
+            if stack:
+                stack[-1].remove(elem)
+        elif tag == stop_tag:
+            return
+
+
+def is_spreadsheet(filename):
+    return filename.rsplit('.', 1)[-1].lower() in SPREADSHEET_EXTENSIONS
+
+
+"""
+XLSX
+"""
+
+
+def _xlsx_column(ref):
+    """Convert a cell reference such as 'C12' to a column index (2).
+    """
+    letters = ref.rstrip('0123456789')
+    try:
+        return _COLUMNS_[letters]
+    except KeyError:
+        pass
+
+    column = 0
+    for c in _CELLREFPATT_.match(letters).group(1):
+        column = column*26 + ord(c) - ord('A') + 1
+    return _COLUMNS_.setdefault(letters, column - 1)
+
+
+def _xlsx_first_sheet(archive):
+    """Return the archive path of the first worksheet and whether the workbook counts dates from 1904.
+    """
+    workbook = 'xl/workbook.xml'
+    sheet_rid = None
+    date1904 = False
+
+    with archive.open(workbook) as f:
+        for _, elem in iterparse(f):
+            tag = _local(elem.tag)
+            if tag == 'workbookPr':
+                date1904 = elem.get('date1904') in ('1', 'true')
+            elif tag == 'sheet' and sheet_rid is None:
+                sheet_rid = next((v for k, v in elem.attrib.items() if _local(k) == 'id'), None)
+
+    rels = 'xl/_rels/workbook.xml.rels'
+    if sheet_rid is not None and rels in archive.namelist():
+        with archive.open(rels) as f:
+            for _, elem in iterparse(f):
+                if _local(elem.tag) == 'Relationship' and elem.get('Id') == sheet_rid:
+                    target = elem.get('Target')
+                    if target.startswith('/'):
+                        return target.lstrip('/'), date1904
+                    return posixpath.normpath(posixpath.join('xl', target)), date1904
+
+    return 'xl/worksheets/sheet1.xml', date1904
+
+
+def _xlsx_shared_strings(archive):
+    strings = []
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return strings
+
+    with archive.open('xl/sharedStrings.xml') as f:
+        for elem in _iter_rows(f, 'si'):
+            # Rich text is split into runs; phonetic hints (rPh) are not part of the value
+            phonetic = set(t for rph in elem if _local(rph.tag) == 'rPh' for t in rph.iter())
+            strings.append(''.join(t.text or '' for t in elem.iter() if _local(t.tag) == 't' and t not in phonetic))
+
+    return strings
+
+
+def _xlsx_date_styles(archive):
+    """Return the set of cell style indices whose number format shows a date.
+    """
+    date_styles = set()
+    if 'xl/styles.xml' not in archive.namelist():
+        return date_styles
+
+    custom_formats = {}
+    style_formats = []
+    in_cellxfs = False
+
+    with archive.open('xl/styles.xml') as f:
+        for action, elem in iterparse(f, events=('start', 'end')):
+            tag = _local(elem.tag)
+            if tag == 'cellXfs':
+                in_cellxfs = action == 'start'
+            elif action == 'end' and tag == 'numFmt':
+                custom_formats[int(elem.get('numFmtId'))] = elem.get('formatCode', '')
+            elif action == 'end' and tag == 'xf' and in_cellxfs:
+                style_formats.append(int(elem.get('numFmtId', 0)))
+
+    for index, format_id in enumerate(style_formats):
+        if format_id in custom_formats:
+            if _DATEFMTPATT_.search(_FMTLITERALPATT_.sub('', custom_formats[format_id])):
+                date_styles.add(index)
+        elif format_id in _XLSX_DATE_FORMATS_:
+            date_styles.add(index)
+
+    return date_styles
+
+
+def _serial_to_datetime(serial, date1904=False):
+    base = datetime(1904, 1, 1) if date1904 else datetime(1899, 12, 30)
+    return base + timedelta(seconds=round(serial*86400))
+
+
+def iter_xlsx_rows(filename):
+    """Yield the rows of the first sheet of an XLSX workbook.
+    """
+    with zipfile.ZipFile(filename) as archive:
+        sheet, date1904 = _xlsx_first_sheet(archive)
+        strings = _xlsx_shared_strings(archive)
+        date_styles = _xlsx_date_styles(archive)
+
+        with archive.open(sheet) as f:
+            for elem in _iter_rows(f, 'row'):
+                row = []
+                for c in elem:
+                    if _local(c.tag) != 'c':
+                        continue
+
+                    ref = c.get('r')
+                    if ref:
+                        column = _xlsx_column(ref)
+                        row.extend([''] * (column - len(row)))
+
+                    celltype = c.get('t', 'n')
+                    value = ''
+                    for child in c:
+                        tag = _local(child.tag)
+                        if tag == 'v' and child.text is not None:
+                            value = child.text
+                        elif tag == 'is':
+                            value = ''.join(t.text or '' for t in child.iter() if _local(t.tag) == 't')
+
+                    if value == '':
+                        pass
+                    elif celltype == 's':
+                        value = strings[int(value)]
+                    elif celltype == 'b':
+                        value = value == '1'
+                    elif celltype == 'n':
+                        value = float(value)
+                        if int(c.get('s', 0)) in date_styles:
+                            value = _serial_to_datetime(value, date1904)
+
+                    row.append(value)
+
+                if not _is_empty(row):
+                    yield row
+
+
+"""
+ODS
+"""
+
+
+def _ods_date(value):
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return value
+
+
+def _ods_cell(cell):
+    valuetype = _attr(cell, 'office', 'value-type')
+
+    if valuetype in ('float', 'currency', 'percentage'):
+        return float(_attr(cell, 'office', 'value'))
+    if valuetype == 'date':
+        return _ods_date(_attr(cell, 'office', 'date-value'))
+    if valuetype == 'boolean':
+        return _attr(cell, 'office', 'boolean-value') == 'true'
+
+    # Strings and anything else: the text of each paragraph, one per line
+    return '\n'.join(''.join(p.itertext()) for p in cell if _local(p.tag) == 'p')
+
+
+def iter_ods_rows(filename):
+    """Yield the rows of the first sheet of an OpenDocument spreadsheet.
+    """
+    with zipfile.ZipFile(filename) as archive:
+        with archive.open('content.xml') as f:
+            # Only the first sheet is read
+            for elem in _iter_rows(f, 'table-row', stop_tag='table'):
+                row = []
+                for cell in elem:
+                    if _local(cell.tag) not in ('table-cell', 'covered-table-cell'):
+                        continue
+                    repeat = int(_attr(cell, 'table', 'number-columns-repeated') or 1)
+                    row.extend([_ods_cell(cell)] * repeat)
+
+                # Rows are padded to the width of the sheet with repeated empty cells
+                while row and row[-1] == '':
+                    row.pop()
+
+                if not _is_empty(row):
+                    repeat = int(_attr(elem, 'table', 'number-rows-repeated') or 1)
+                    for _ in range(repeat):
+                        yield list(row)
+
+
+"""
+XLS
+"""
+
+
+def iter_xls_rows(filename):
+    """Yield the rows of the first sheet of an XLS workbook. Needs the xlrd package.
+    """
+    if xlrd is None:
+        raise ImportError('Reading .xls invoices needs the xlrd package: pip install xlrd')
+
+    book = xlrd.open_workbook(filename, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        for cells in sheet.get_rows():
+            row = []
+            for c in cells:
+                if c.ctype == xlrd.XL_CELL_DATE:
+                    row.append(xlrd.xldate.xldate_as_datetime(c.value, book.datemode))
+                elif c.ctype == xlrd.XL_CELL_BOOLEAN:
+                    row.append(bool(c.value))
+                elif c.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR):
+                    row.append('')
+                else:
+                    row.append(c.value)
+
+            if not _is_empty(row):
+                yield row
+    finally:
+        book.release_resources()
+
+
+def iter_rows(filename):
+    """Yield the rows of the first sheet of an XLS, XLSX or ODS file, by file extension.
+    """
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension == 'xlsx':
+        return iter_xlsx_rows(filename)
+    if extension == 'ods':
+        return iter_ods_rows(filename)
+    if extension == 'xls':
+        return iter_xls_rows(filename)
+    raise ValueError('Not a spreadsheet: {}'.format(filename))
@@ -0,0 +1,245 @@
+import os
+import re
+import time
+import uuid
+import shutil
+import fcntl
+from contextlib import contextmanager
+import app.rxparse as rx
+
+"""
+#######################################################################
+## Per-job workspaces and merge-on-commit for the shared pricetable  ##
+#######################################################################
+"""
+# Each upload gets its own directory under the workspace folder:
+#
+#   <workspace_folder>/<job_id>/input/             uploaded formulary and invoice
+#   <workspace_folder>/<job_id>/output/            files offered for download
+#   <workspace_folder>/<job_id>/base-pricetable.tsv  snapshot of the shared pricetable
+#   <workspace_folder>/<job_id>/persistent-pricetable.tsv  private working copy
+#   <workspace_folder>/<job_id>/fuzzymatches.json    matches awaiting review on the selection page
+#   <workspace_folder>/<job_id>/timings.json         stage timings of the upload, for the result page
+#
+# The pipeline only ever touches the private working copy. Changes reach the
+# shared pricetable through commit_pricetable(), which holds an exclusive lock
+# on the shared file while it merges row by row.
+
+JOB_ID_PATT = re.compile(r'[0-9a-f]{32}')
+BASE_PRICETABLE_FILENAME = 'base-pricetable.tsv'
+WORK_PRICETABLE_FILENAME = 'persistent-pricetable.tsv'
+FUZZYMATCHES_FILENAME = 'fuzzymatches.json'
+TIMINGS_FILENAME = 'timings.json'
+LOCK_SUFFIX = '.lock'
+WORKSPACE_MAX_AGE = 24*60*60  # Seconds before an abandoned workspace is removed
+
+
+def is_job_id(job_id):
+    """Check that a job id (e.g. read back from a cookie) is well formed.
+    """
+    return bool(job_id) and JOB_ID_PATT.fullmatch(job_id) is not None
+
+
+def workspace_path(workspace_folder, job_id):
+    """Return the directory of a workspace, refusing malformed job ids.
+    """
+    if not is_job_id(job_id):
+        raise ValueError('Invalid job id: {!r}'.format(job_id))
+    return os.path.join(workspace_folder, job_id)
+
+
+def input_folder(workspace_folder, job_id):
+    return os.path.join(workspace_path(workspace_folder, job_id), 'input')
+
+
+def output_folder(workspace_folder, job_id):
+    return os.path.join(workspace_path(workspace_folder, job_id), 'output')
+
+
+def work_pricetable_path(workspace_folder, job_id):
+    return os.path.join(workspace_path(workspace_folder, job_id), WORK_PRICETABLE_FILENAME)
+
+
+def base_pricetable_path(workspace_folder, job_id):
+    return os.path.join(workspace_path(workspace_folder, job_id), BASE_PRICETABLE_FILENAME)
+
+
+def fuzzymatches_path(workspace_folder, job_id):
+    return os.path.join(workspace_path(workspace_folder, job_id), FUZZYMATCHES_FILENAME)
+
+
+def timings_path(workspace_folder, job_id):
+    return os.path.join(workspace_path(workspace_folder, job_id), TIMINGS_FILENAME)
+
+
+@contextmanager
+def pricetable_lock(pricetable_persist_path):
+    """Hold an exclusive lock on the shared pricetable for the duration of the block.
+
+    The lock is taken on a sidecar file so that the pricetable itself can be
+    replaced atomically while the lock is held.
+    """
+    with open(pricetable_persist_path + LOCK_SUFFIX, 'a') as lockfile:
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+
+def read_pricetable_or_empty(pricetable_path):
+    if os.path.isfile(pricetable_path):
+        return rx.read_pricetable(pricetable_path)
+    else:
+        return {}
+
+
+def replace_pricetable(pricetable, pricetable_path):
+    """Write a pricetable next to its destination and rename it into place.
+    """
+    tmp_path = '{}.{}.tmp'.format(pricetable_path, os.getpid())
+    rx.write_pricetable(pricetable, tmp_path)
+    os.replace(tmp_path, pricetable_path)
+
+
+def create_workspace(workspace_folder, pricetable_persist_path):
+    """Create a new job workspace holding a snapshot of the shared pricetable.
+
+    Returns the job id.
+    """
+    prune_workspaces(workspace_folder)
+
+    job_id = uuid.uuid4().hex
+    os.makedirs(input_folder(workspace_folder, job_id))
+    os.makedirs(output_folder(workspace_folder, job_id))
+
+    # Snapshot under the lock so a half-merged file is never copied
+    with pricetable_lock(pricetable_persist_path):
+        pricetable = read_pricetable_or_empty(pricetable_persist_path)
+
+    # An empty snapshot is still written so that later stages can read it back
+    rx.write_pricetable(pricetable, base_pricetable_path(workspace_folder, job_id))
+    rx.write_pricetable(pricetable, work_pricetable_path(workspace_folder, job_id))
+
+    return job_id
+
+
+def merge_pricetable(base, ours, theirs):
+    """Three-way merge of pricetables keyed by NAMEDOSE.
+
+    'base' is the snapshot the job started from, 'ours' is the job's working
+    copy and 'theirs' is the shared pricetable as it is now. Rows the job did
+    not touch keep the shared value. Rows only the job changed take the job's
+    value. When both sides changed the same row to different values, the most
+    recent REQDATE wins, with the job winning ties since it commits last.
+
+    Rows in 'base' that are gone from 'theirs' were deleted from the shared
+    pricetable (e.g. archived by compaction) and stay deleted, unless the job
+    brought a new price or requisition date for them. A job re-flagging ON
+    FORMULARY while matching does not count.
+
+    Returns the merged pricetable and the number of conflicting rows.
+    """
+    merged = dict(theirs)
+    conflicts = 0
+
+    for k, v in ours.items():
+        old = base.get(k)
+        if old == v:
+            continue  # Unchanged by this job
+
+        if k not in theirs:
+            if old is None or has_new_price(old, v):
+                merged[k] = v
+        elif theirs[k] == v:
+            continue  # Both sides made the same change
+        elif theirs[k] == old:
+            merged[k] = v
+        else:
+            conflicts += 1
+            if v.REQDATE >= theirs[k].REQDATE:
+                merged[k] = v
+
+    return merged, conflicts
+
+
+def has_new_price(old, new):
+    """Check whether a pricetable row carries a different price or requisition date than before.
+    """
+    return new.COST != old.COST or new.REQDATE != old.REQDATE
+
+
+def commit_pricetable(workspace_folder, job_id, pricetable_persist_path):
+    """Merge a job's working pricetable into the shared pricetable.
+
+    Only the merge itself is serialized; jobs run the rest of the pipeline
+    concurrently against their own copies. After the commit the job's base
+    and working copy are refreshed to the merged table so that later stages
+    of the same job see other jobs' changes and are merged against them.
+    Rows the job still offers for review in its fuzzymatches.json are kept in
+    both copies even when they are gone from the shared pricetable, so the
+    user can still select them; keeping them in the base as well means they
+    are not brought back by the next commit.
+
+    Returns the number of conflicting rows resolved during the merge.
+    """
+    base_path = base_pricetable_path(workspace_folder, job_id)
+    work_path = work_pricetable_path(workspace_folder, job_id)
+
+    base = read_pricetable_or_empty(base_path)
+    ours = read_pricetable_or_empty(work_path)
+
+    with pricetable_lock(pricetable_persist_path):
+        theirs = read_pricetable_or_empty(pricetable_persist_path)
+        merged, conflicts = merge_pricetable(base, ours, theirs)
+        replace_pricetable(merged, pricetable_persist_path)
+
+    refreshed = dict(merged)
+    for k in offered_namedoses(fuzzymatches_path(workspace_folder, job_id)):
+        if k not in refreshed and k in ours:
+            refreshed[k] = ours[k]
+
+    replace_pricetable(refreshed, base_path)
+    replace_pricetable(refreshed, work_path)
+
+    return conflicts
+
+
+def offered_namedoses(fuzzymatches_path):
+    """Return the invoice NAMEDOSEs, as pricetable keys, of the matches a job offers for review.
+    """
+    if not os.path.isfile(fuzzymatches_path):
+        return set()
+    return set(m.INV_NAMEDOSE.upper() for m in rx.read_fuzzymatches(fuzzymatches_path))
+
+
+def live_offered_namedoses(workspace_folder, max_age=WORKSPACE_MAX_AGE):
+    """Return the pricetable keys offered for review by every workspace not yet old enough to prune.
+
+    A job may be submitted at any time until its workspace is pruned, so
+    these rows must stay in the shared pricetable until then.
+    """
+    offered = set()
+    if not os.path.isdir(workspace_folder):
+        return offered
+
+    cutoff = time.time() - max_age
+    for name in os.listdir(workspace_folder):
+        path = os.path.join(workspace_folder, name)
+        if is_job_id(name) and os.path.isdir(path) and os.path.getmtime(path) >= cutoff:
+            offered.update(offered_namedoses(os.path.join(path, FUZZYMATCHES_FILENAME)))
+
+    return offered
+
+
+def prune_workspaces(workspace_folder, max_age=WORKSPACE_MAX_AGE):
+    """Remove workspaces that have not been modified for 'max_age' seconds.
+    """
+    if not os.path.isdir(workspace_folder):
+        return
+
+    cutoff = time.time() - max_age
+    for name in os.listdir(workspace_folder):
+        path = os.path.join(workspace_folder, name)
+        if is_job_id(name) and os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,307 @@
+import csv
+import random
+import zipfile
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+"""
+#####################################################################
+## Seeded generators for synthetic formularies and invoices        ##
+#####################################################################
+"""
+# The formulary follows the EHHapp Markdown format of app/input/rx.markdown:
+#
+#   * CATEGORY
+#   > ~DRUGNAME (brandname) - other metadata | COSTpD (DOSE), ... | SUBCATEGORY
+#
+# The invoice follows the column layout of app/input/sample-invoice.csv. Most
+# invoice items are named after formulary drugs so that the matching stage has
+# realistic work to do; the rest are names that should not match. The same
+# invoice lines can be written as CSV, XLSX or ODS; the spreadsheets hold
+# prices and quantities as numbers and requisition dates as dates, like the
+# pharmacy's own exports.
+
+INVOICE_HEADER = ['Supply Loc', 'Delivery Loc', 'Item No', 'Item Description', 'Vendor Name', 'Vendor Ctlg No',
+                  'Mfr Name', 'Mfr Ctlg No', 'Comdty Name ', 'Comdty Code', 'Exp Code', 'Requisition No',
+                  'Requisition Date', 'Issue Qty', 'UM', 'Price', 'Extended Price']
+
+CATEGORIES = ['ANALGESICS', 'VITAMINS', 'ANTIFUNGALS', 'ANTIMICROBIALS', 'CARDIOVASCULAR', 'DIABETES',
+              'GASTROINTESTINAL', 'PSYCHIATRIC', 'PULMONARY', 'DERMATOLOGY', 'OPHTHALMICS', 'UROLOGY']
+
+COMMODITIES = ['ANALGESICS/NARCOTIC', 'VITAMINS/MINERALS', 'ANTI-INFECTIVES/TOPICAL', 'ANTIBIOTICS/ORAL',
+               'CARDIOVASCULAR/GENERAL', 'ANTIDIABETICS', 'GASTROINTESTINAL', 'PSYCHOTHERAPEUTICS',
+               'RESPIRATORY/GENERAL', 'DERMATOLOGICALS', 'OPHTHALMICS/GENERAL', 'GENITOURINARY']
+
+SUBCATEGORIES = ['', '', '', 'Topical', 'Eye Drops', 'Oral antibiotics / antifungals / antivirals / anti-mycobacterium']
+
+_SYLLABLES_ = ['am', 'ox', 'ci', 'lin', 'pra', 'zo', 'le', 'met', 'for', 'min', 'ga', 'ba', 'pen', 'tin',
+               'lo', 'sar', 'tan', 'ator', 'va', 'sta', 'flu', 'cona', 'ceph', 'a', 'lex', 'nap', 'rox', 'en',
+               'di', 'clo', 'fen', 'ac', 'hy', 'dro', 'chlor', 'thia', 'zide', 'ome', 'pra', 'ser', 'tra']
+
+_DOSES_ = ['5mg', '10mg', '20mg', '25mg', '40mg', '50mg', '100mg', '250mg', '400mg', '500mg', '600mg',
+           '750mg', '875mg', '1g', '15g', '30g', '10meq', '400IU']
+
+_FORMS_ = ['TAB', 'CAP', 'TAB EC', 'CAP ER', 'CREAM', 'OINT', 'SOLN', 'SUSP']
+
+
+def _drug_name(rng, used):
+    """Make up a pronounceable, unique drug name.
+    """
+    while True:
+        name = ''.join(rng.choice(_SYLLABLES_) for _ in range(rng.randint(3, 5))).capitalize()
+        if name not in used:
+            used.add(name)
+            return name
+
+
+def _cost(rng):
+    return '${:.2f}'.format(rng.lognormvariate(-1.5, 1.5))
+
+
+def generate_formulary(n_drugs, seed=0):
+    """Return a list of (category, name, [(cost, dose), ...], blacklisted, subcategory) drugs.
+    """
+    rng = random.Random(seed)
+    used = set()
+    drugs = []
+
+    for i in range(n_drugs):
+        category = CATEGORIES[i * len(CATEGORIES) // n_drugs]
+        name = _drug_name(rng, used)
+        doses = rng.sample(_DOSES_, rng.randint(1, 4))
+        dosecosts = [(_cost(rng), dose) for dose in doses]
+        blacklisted = rng.random() < 0.1
+        drugs.append((category, name, dosecosts, blacklisted, rng.choice(SUBCATEGORIES)))
+
+    return drugs
+
+
+def write_formulary(drugs, path):
+    """Write generated drugs as an EHHapp Markdown formulary.
+    """
+    lines = []
+    category = None
+
+    for drugcategory, name, dosecosts, blacklisted, subcategory in drugs:
+        if drugcategory != category:
+            category = drugcategory
+            lines.append('* {}'.format(category))
+
+        if blacklisted:
+            namestring = '~{} - DO NOT PRESCRIBE'.format(name)
+        else:
+            namestring = name
+        dosecoststring = ', '.join('{} ({})'.format(cost, dose) for cost, dose in dosecosts)
+        lines.append('> {} | {} | {}'.format(namestring, dosecoststring, subcategory))
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def generate_catalog(drugs, n_items, seed=0):
+    """Return invoice items as (itemnum, description, commodity) for a generated formulary.
+
+    About 80% of items are formulary drugs at one of their formulary doses, the
+    rest are made up names that should end up unmatched.
+    """
+    rng = random.Random(seed + 1)
+    used = set(d[1] for d in drugs)
+    items = []
+    descriptions = set()
+
+    while len(items) < n_items:
+        if rng.random() < 0.8 and drugs:
+            category, name, dosecosts, _, _ = rng.choice(drugs)
+            dose = rng.choice(dosecosts)[1]
+        else:
+            category = rng.choice(CATEGORIES)
+            name = _drug_name(rng, used)
+            dose = rng.choice(_DOSES_)
+
+        description = '{} {} {}'.format(name.upper(), dose.upper(), rng.choice(_FORMS_))
+        if description in descriptions:
+            continue
+        descriptions.add(description)
+
+        commodity = COMMODITIES[CATEGORIES.index(category)]
+        items.append(('{:05d}'.format(10000 + len(items)), description, commodity))
+
+    return items
+
+
+def invoice_rows(items, n_rows, seed=0):
+    """Yield 'n_rows' invoice lines drawn from 'items' as cell values.
+
+    Prices and quantities are numbers and requisition dates are datetimes.
+    Every tenth line is a non-drug line, which the invoice readers are expected to filter out.
+    """
+    rng = random.Random(seed + 2)
+    prices = {item[0]: rng.lognormvariate(-1.5, 1.5) for item in items}
+
+    for i in range(n_rows):
+        if i % 10 == 9:
+            yield ['Location', 'Pharmacy', 'SUPPLY', 'GLOVES NITRILE MEDIUM'] + [''] * 13
+            continue
+
+        itemnum, description, commodity = rng.choice(items)
+        price = round(prices[itemnum] * rng.choice((1, 1, 1, 0.95, 1.05)), 2)
+        date = datetime(2015, rng.randint(1, 12), rng.randint(1, 28), rng.randint(7, 18), rng.randint(0, 59))
+        yield ['Location', 'Pharmacy', itemnum, description, 'AMERISOURCE CORP', '181697', 'AMERISOURCE',
+               '65064705', commodity, 'CMDY10OP01', '4212', str(1216418 + i), date, 1, 'EA', price, price]
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return '{}/{}/{:02d} {}:{:02d}'.format(value.month, value.day, value.year % 100, value.hour, value.minute)
+    if isinstance(value, float):
+        return '${:.2f}'.format(value)
+    return str(value)
+
+
+def write_invoice(items, n_rows, path, seed=0):
+    """Write an invoice CSV with 'n_rows' drug lines drawn from 'items'.
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(INVOICE_HEADER)
+        for row in invoice_rows(items, n_rows, seed):
+            writer.writerow([_csv_value(v) for v in row])
+
+
+_XLSX_FILES_ = {
+    '[Content_Types].xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '<Override PartName="/xl/sharedStrings.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+        '</Types>',
+    '_rels/.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>',
+    'xl/workbook.xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Invoice" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '<Relationship Id="rId2" Target="styles.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"/>'
+        '<Relationship Id="rId3" Target="sharedStrings.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings"/>'
+        '</Relationships>',
+    # Style 1 is the built in 'm/d/yy h:mm' date format, style 2 is '$#,##0.00'
+    'xl/styles.xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="&quot;$&quot;#,##0.00"/></numFmts>'
+        '<fonts count="1"><font/></fonts><fills count="1"><fill/></fills><borders count="1"><border/></borders>'
+        '<cellXfs count="3"><xf numFmtId="0"/><xf numFmtId="22" applyNumberFormat="1"/>'
+        '<xf numFmtId="164" applyNumberFormat="1"/></cellXfs></styleSheet>',
+}
+
+
+def _xlsx_column_name(index):
+    name = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        name = chr(ord('A') + remainder) + name
+    return name
+
+
+def write_invoice_xlsx(items, n_rows, path, seed=0):
+    """Write the same invoice lines as write_invoice as an XLSX workbook with shared strings.
+    """
+    columns = [_xlsx_column_name(i) for i in range(len(INVOICE_HEADER))]
+    strings = {}
+    sheet = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+             '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>']
+
+    def cell(ref, value):
+        if isinstance(value, datetime):
+            serial = (value - datetime(1899, 12, 30)).total_seconds() / 86400
+            return '<c r="{}" s="1"><v>{!r}</v></c>'.format(ref, serial)
+        if isinstance(value, float):
+            return '<c r="{}" s="2"><v>{!r}</v></c>'.format(ref, value)
+        if isinstance(value, int):
+            return '<c r="{}"><v>{}</v></c>'.format(ref, value)
+        if value == '':
+            return ''
+        index = strings.setdefault(value, len(strings))
+        return '<c r="{}" t="s"><v>{}</v></c>'.format(ref, index)
+
+    rows = [INVOICE_HEADER] + list(invoice_rows(items, n_rows, seed))
+    for r, row in enumerate(rows, 1):
+        sheet.append('<row r="{}">{}</row>'.format(
+            r, ''.join(cell('{}{}'.format(columns[c], r), v) for c, v in enumerate(row))))
+    sheet.append('</sheetData></worksheet>')
+
+    shared = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+              '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" count="{0}" uniqueCount="{0}">'
+              .format(len(strings))]
+    shared.extend('<si><t>{}</t></si>'.format(escape(s)) for s in sorted(strings, key=strings.get))
+    shared.append('</sst>')
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_FILES_.items():
+            archive.writestr(name, content)
+        archive.writestr('xl/sharedStrings.xml', ''.join(shared))
+        archive.writestr('xl/worksheets/sheet1.xml', ''.join(sheet))
+
+
+_ODS_MANIFEST_ = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2">'
+    '<manifest:file-entry manifest:full-path="/" manifest:media-type="application/vnd.oasis.opendocument.spreadsheet"/>'
+    '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>'
+    '</manifest:manifest>')
+
+
+def write_invoice_ods(items, n_rows, path, seed=0):
+    """Write the same invoice lines as write_invoice as an OpenDocument spreadsheet.
+    """
+    content = ['<?xml version="1.0" encoding="UTF-8"?>'
+               '<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+               'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+               'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" office:version="1.2">'
+               '<office:body><office:spreadsheet><table:table table:name="Invoice">']
+
+    def cell(value):
+        if isinstance(value, datetime):
+            return ('<table:table-cell office:value-type="date" office:date-value="{}">'
+                    '<text:p>{}</text:p></table:table-cell>').format(value.isoformat(), _csv_value(value))
+        if isinstance(value, float):
+            return ('<table:table-cell office:value-type="currency" office:currency="USD" office:value="{!r}">'
+                    '<text:p>{}</text:p></table:table-cell>').format(value, _csv_value(value))
+        if isinstance(value, int):
+            return ('<table:table-cell office:value-type="float" office:value="{0}">'
+                    '<text:p>{0}</text:p></table:table-cell>').format(value)
+        if value == '':
+            return '<table:table-cell/>'
+        return '<table:table-cell office:value-type="string"><text:p>{}</text:p></table:table-cell>'.format(
+            escape(value))
+
+    for row in [INVOICE_HEADER] + list(invoice_rows(items, n_rows, seed)):
+        content.append('<table:table-row>{}</table:table-row>'.format(''.join(cell(v) for v in row)))
+    content.append('</table:table></office:spreadsheet></office:body></office:document-content>')
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        # The mimetype must come first and be stored uncompressed
+        archive.writestr(zipfile.ZipInfo('mimetype'), 'application/vnd.oasis.opendocument.spreadsheet')
+        archive.writestr('META-INF/manifest.xml', _ODS_MANIFEST_)
+        archive.writestr('content.xml', ''.join(content))
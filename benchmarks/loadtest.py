@@ -0,0 +1,351 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+import threading
+import contextlib
+import importlib.util
+from collections import OrderedDict
+from http.cookiejar import CookieJar
+from urllib.request import build_opener, HTTPCookieProcessor, Request
+from urllib.error import HTTPError
+from benchmarks import generate
+
+"""
+#####################################################################
+## Load test the upload -> selection -> result flow over HTTP      ##
+#####################################################################
+"""
+# Usage, from the repository root:
+#
+#   python -m benchmarks.loadtest                              # 'small' invoices through the Flask test client
+#   python -m benchmarks.loadtest --mode server --concurrency 8
+#   python -m benchmarks.loadtest --size small --size medium --sessions 40 --json results.json
+#
+# Each session uploads a formulary and an invoice to /selection, pages through
+# /selection/matches, submits some of the matches to /result and downloads the
+# output files, keeping its cookies between requests like a browser would.
+# Sessions run on 'concurrency' threads against one app. The app's folders are
+# pointed at a temporary directory so the repository's persistent pricetable,
+# price history and markdown backups are not touched.
+#
+# In 'client' mode requests go through app.test_client(); in 'server' mode the
+# app is served on a local port by the threaded Werkzeug server and requests go
+# over real HTTP, so multipart parsing, cookies and streaming are all included.
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '__init__.py')
+
+# Matching cost grows with drugs x items, so these are kept small enough for
+# every upload to be a realistic but short request.
+SIZES = OrderedDict([
+    ('small', {'drugs': 40, 'rows': 500, 'items': 60}),
+    ('medium', {'drugs': 120, 'rows': 5000, 'items': 180}),
+    ('large', {'drugs': 300, 'rows': 50000, 'items': 400}),
+])
+
+ROUTES = ['POST /selection', 'GET /selection/matches', 'POST /result', 'GET /output']
+
+_MATCHPATT_ = re.compile(r'name="usermatches" value="(\d+)"')
+_OUTPUTPATT_ = re.compile(r'href="(/output/[^"]+)"')
+
+
+def load_app(root):
+    """Import the Flask app from the repository root with its folders moved under 'root'.
+    """
+    spec = importlib.util.spec_from_file_location('formularyapp', APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # Flask finds templates and static files through the module's path
+    spec.loader.exec_module(module)
+    app = module.app
+
+    for key in ('UPLOAD_FOLDER', 'PERSISTENT_FOLDER', 'BACKUP_FOLDER', 'OUTPUT_FOLDER', 'WORKSPACE_FOLDER',
+                'PROFILE_FOLDER', 'LOG_FOLDER'):
+        folder = os.path.join(root, key.lower())
+        os.makedirs(folder)
+        app.config[key] = folder
+
+    return app
+
+
+def generate_uploads(size, seed, directory):
+    """Write a synthetic formulary and invoice for a size and return their contents.
+    """
+    spec = SIZES[size]
+    drugs = generate.generate_formulary(spec['drugs'], seed)
+    items = generate.generate_catalog(drugs, spec['items'], seed)
+
+    formulary_path = os.path.join(directory, '{}-formulary.markdown'.format(size))
+    invoice_path = os.path.join(directory, '{}-invoice.csv'.format(size))
+    generate.write_formulary(drugs, formulary_path)
+    generate.write_invoice(items, spec['rows'], invoice_path, seed)
+
+    with open(formulary_path, 'rb') as f:
+        formulary = f.read()
+    with open(invoice_path, 'rb') as f:
+        invoice = f.read()
+
+    return formulary, invoice
+
+
+def current_rss_kb():
+    """Resident set size of this process in KiB, or the peak so far where /proc is unavailable.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class TestClientSession:
+    """One browser session driven through the Flask test client.
+    """
+
+    def __init__(self, app):
+        self.CLIENT = app.test_client()
+
+    def request(self, method, path, data=None, files=None):
+        if files:
+            data = dict(data or {})
+            data['file'] = [(io.BytesIO(content), filename) for filename, content in files]
+            resp = self.CLIENT.open(path, method=method, data=data, content_type='multipart/form-data')
+        else:
+            resp = self.CLIENT.open(path, method=method, data=data)
+        body = resp.get_data(as_text=True)  # Reads streamed responses to the end
+        return resp.status_code, resp.headers, body
+
+
+class HttpSession:
+    """One browser session sending real HTTP requests, with its own cookie jar.
+    """
+
+    def __init__(self, base_url):
+        self.BASE_URL = base_url
+        self.OPENER = build_opener(HTTPCookieProcessor(CookieJar()))
+
+    def request(self, method, path, data=None, files=None):
+        headers = {}
+        body = None
+        if files:
+            body, headers['Content-Type'] = encode_multipart(data or {}, files)
+        elif data:
+            body, headers['Content-Type'] = encode_multipart(data, [])
+
+        req = Request(self.BASE_URL + path, data=body, headers=headers, method=method)
+        try:
+            with self.OPENER.open(req) as resp:
+                return resp.status, resp.headers, resp.read().decode('utf-8')
+        except HTTPError as e:
+            return e.code, e.headers, e.read().decode('utf-8')
+
+
+def encode_multipart(fields, files):
+    """Encode form fields and (filename, bytes) files as multipart/form-data.
+
+    Field values may be lists, which are sent as repeated fields like checkboxes.
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+
+    for name, values in fields.items():
+        for value in values if isinstance(values, list) else [values]:
+            parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+                boundary, name, value).encode('utf-8'))
+    for filename, content in files:
+        parts.append('--{}\r\nContent-Disposition: form-data; name="file"; filename="{}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'.format(boundary, filename).encode('utf-8'))
+        parts.append(content)
+        parts.append(b'\r\n')
+    parts.append('--{}--\r\n'.format(boundary).encode('utf-8'))
+
+    return b''.join(parts), 'multipart/form-data; boundary={}'.format(boundary)
+
+
+class Recorder:
+    """Collects request latencies and RSS samples per route from many threads.
+    """
+
+    def __init__(self):
+        self.LATENCIES = {route: [] for route in ROUTES}
+        self.PEAK_RSS_KB = {route: 0 for route in ROUTES}
+        self.ERRORS = {route: 0 for route in ROUTES}
+        self._lock = threading.Lock()
+
+    def timed(self, route, session, method, path, data=None, files=None):
+        start = time.perf_counter()
+        status, headers, body = session.request(method, path, data, files)
+        elapsed = time.perf_counter() - start
+        rss = current_rss_kb()
+
+        with self._lock:
+            self.LATENCIES[route].append(elapsed)
+            self.PEAK_RSS_KB[route] = max(self.PEAK_RSS_KB[route], rss)
+            if status >= 400:
+                self.ERRORS[route] += 1
+
+        return status, headers, body
+
+
+def run_session(session, recorder, formulary, invoice, rng):
+    """Walk one session through upload, match paging, submission and downloads.
+    """
+    status, _, page = recorder.timed('POST /selection', session, 'POST', '/selection',
+                                     files=[('formulary.markdown', formulary), ('invoice.csv', invoice)])
+    if status != 200:
+        return
+
+    match_ids = _MATCHPATT_.findall(page)
+    offset = len(match_ids)
+    while True:
+        _, headers, fragment = recorder.timed('GET /selection/matches', session, 'GET',
+                                              '/selection/matches?offset={}'.format(offset))
+        next_offset = int(headers.get('X-Next-Offset', offset))
+        if next_offset <= offset:
+            break
+        match_ids.extend(_MATCHPATT_.findall(fragment))
+        offset = next_offset
+
+    # Users confirm some of the suggested matches, not all of them
+    selected = [i for i in match_ids if rng.random() < 0.5]
+    status, _, page = recorder.timed('POST /result', session, 'POST', '/result', data={'usermatches': selected})
+    if status != 200:
+        return
+
+    for link in _OUTPUTPATT_.findall(page):
+        recorder.timed('GET /output', session, 'GET', link)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(p / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def run_load(make_session, size, sessions, concurrency, seed, directory):
+    """Run 'sessions' sessions for one invoice size on 'concurrency' threads and summarise each route.
+    """
+    formulary, invoice = generate_uploads(size, seed, directory)
+    recorder = Recorder()
+    remaining = list(range(sessions))
+    remaining_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with remaining_lock:
+                if not remaining:
+                    return
+                n = remaining.pop()
+            run_session(make_session(), recorder, formulary, invoice, random.Random(seed + n))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    summary = OrderedDict()
+    for route in ROUTES:
+        latencies = recorder.LATENCIES[route]
+        if not latencies:
+            continue
+        summary[route] = OrderedDict([
+            ('requests', len(latencies)),
+            ('errors', recorder.ERRORS[route]),
+            ('p50_ms', round(1000 * percentile(latencies, 50), 2)),
+            ('p95_ms', round(1000 * percentile(latencies, 95), 2)),
+            ('p99_ms', round(1000 * percentile(latencies, 99), 2)),
+            ('throughput_rps', round(len(latencies) / wall, 2)),
+            ('peak_rss_kb', recorder.PEAK_RSS_KB[route]),
+        ])
+    summary['sessions'] = OrderedDict([
+        ('sessions', sessions),
+        ('invoice_bytes', len(invoice)),
+        ('wall_s', round(wall, 3)),
+        ('throughput_sps', round(sessions / wall, 3)),
+        ('peak_rss_kb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+    ])
+
+    return summary
+
+
+def print_summary(size, summary):
+    print('{:<8} {:<24} {:>8} {:>6} {:>10} {:>10} {:>10} {:>9} {:>12}'.format(
+        'size', 'route', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'peak RSS KiB'))
+    for route, s in summary.items():
+        if route == 'sessions':
+            continue
+        print('{:<8} {:<24} {:>8} {:>6} {:>10} {:>10} {:>10} {:>9} {:>12}'.format(
+            size, route, s['requests'], s['errors'], s['p50_ms'], s['p95_ms'], s['p99_ms'],
+            s['throughput_rps'], s['peak_rss_kb']))
+    s = summary['sessions']
+    print('{:<8} {} sessions of a {} byte invoice in {} s ({} sessions/s), peak RSS {} KiB\n'.format(
+        size, s['sessions'], s['invoice_bytes'], s['wall_s'], s['throughput_sps'], s['peak_rss_kb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the upload, selection and result pages.')
+    parser.add_argument('--mode', choices=['client', 'server'], default='client',
+                        help='drive the app through the Flask test client or a local HTTP server')
+    parser.add_argument('--size', action='append', choices=list(SIZES),
+                        help='invoice size to run, may be repeated (default: small)')
+    parser.add_argument('--sessions', type=int, default=20, help='sessions per size')
+    parser.add_argument('--concurrency', type=int, default=4, help='sessions running at the same time')
+    parser.add_argument('--warmup', type=int, default=1, help='unmeasured sessions to run first')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the data generators and match selection')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--show-app-output', action='store_true', help="print the app's progress output")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='ehhapp-loadtest-')
+    server = None
+
+    try:
+        app = load_app(os.path.join(directory, 'app'))
+
+        if args.mode == 'server':
+            from werkzeug.serving import make_server
+            server = make_server('127.0.0.1', 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+            make_session = lambda: HttpSession(base_url)
+        else:
+            make_session = lambda: TestClientSession(app)
+
+        results = OrderedDict()
+        for size in args.size or ['small']:
+            # The app still prints its progress, it just does not reach the terminal
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(sys.stdout if args.show_app_output else devnull):
+                if args.warmup:
+                    run_load(make_session, size, args.warmup, 1, args.seed, directory)
+                results[size] = run_load(make_session, size, args.sessions, args.concurrency, args.seed, directory)
+            print_summary(size, results[size])
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'mode': args.mode, 'concurrency': args.concurrency, 'results': results}, f, indent=2)
+        print('Results written to {}'.format(args.json))
+
+    return 1 if any(s.get('errors') for r in results.values() for s in r.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
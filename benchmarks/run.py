@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+from collections import namedtuple, OrderedDict
+import app.rxparse as rx
+import app.formularyhelper as fh
+import app.categorymap as cm
+from benchmarks import generate
+
+"""
+#####################################################################
+## Benchmark each pipeline stage on synthetic data of several sizes ##
+#####################################################################
+"""
+# Usage, from the repository root:
+#
+#   python -m benchmarks.run                       # time the 'small' size against the baseline
+#   python -m benchmarks.run --size medium --size large
+#   python -m benchmarks.run --stage read_csv --stage read_pricetable
+#   python -m benchmarks.run --save-baseline       # record the current numbers as the baseline
+#
+# Every stage is run once under tracemalloc for its peak memory, then timed
+# 'repeat' times without it, keeping the fastest run. The command exits with
+# status 1 if a stage is slower or uses more memory than the baseline by more
+# than the tolerance.
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# drugs: formulary drugs, rows: invoice lines, items: distinct invoice items.
+# Matching compares every formulary dose with every invoice item, so it is
+# skipped at sizes where a single run would take minutes. The spreadsheet
+# test files are built in memory, so they are skipped at the largest size.
+SIZES = OrderedDict([
+    ('small', {'drugs': 200, 'rows': 1000, 'items': 300, 'skip': []}),
+    ('medium', {'drugs': 2000, 'rows': 100000, 'items': 1000,
+                'skip': ['formulary_update_from_pricetable', 'formulary_update_by_category']}),
+    ('large', {'drugs': 20000, 'rows': 1000000, 'items': 3000,
+               'skip': ['formulary_update_from_pricetable', 'formulary_update_by_category', 'read_xlsx', 'read_ods']}),
+])
+
+# Stages that read the whole invoice, reported in rows per second as well
+INVOICE_READ_STAGES = ['read_csv', 'read_xlsx', 'read_ods']
+
+# PREPARE takes the context of earlier stage results and returns the callable
+# to measure. Work done in PREPARE itself is not measured.
+Stage = namedtuple('Stage', ['NAME', 'PREPARE'])
+
+
+def _output_path(ctx, filename):
+    return os.path.join(ctx['dir'], filename)
+
+
+def _formulary_with_pricetable(ctx):
+    formulary = ctx['store_formulary']
+    for record in formulary:
+        if not record.PRICETABLE:
+            record._set_PRICETABLE()
+    return formulary
+
+
+def _prepare_spreadsheet(writer, filename):
+    # Writing the workbook is part of preparing the stage, only reading it is measured
+    def prepare(ctx):
+        path = _output_path(ctx, filename)
+        writer(ctx['items'], ctx['rows'], path, ctx['seed'])
+        return lambda: rx.read_invoice(path)
+    return prepare
+
+
+def _prepare_match(ctx):
+    # Matching updates the records and pricetable it is given, so use fresh copies
+    formulary = fh.store_formulary(fh.parse_mddata(ctx['read_md']))
+    pricetable = dict(ctx['read_pricetable'])
+    return lambda: rx.formulary_update_from_pricetable(formulary, pricetable)
+
+
+def _prepare_match_by_category(ctx):
+    # Same as _prepare_match, with each generated commodity mapped to the category it was generated from
+    formulary = fh.store_formulary(fh.parse_mddata(ctx['read_md']))
+    pricetable = dict(ctx['read_pricetable'])
+    categorymap = cm.CategoryMap()
+    for commodity, category in zip(generate.COMMODITIES, generate.CATEGORIES):
+        categorymap.configure(commodity, category)
+    return lambda: rx.formulary_update_from_pricetable(formulary, pricetable, categorymap=categorymap,
+                                                       category_mode=cm.MODE_FIRST)
+
+
+STAGES = [
+    Stage('read_csv', lambda ctx: lambda: rx.read_csv(ctx['invoice_path'])),
+    Stage('read_xlsx', _prepare_spreadsheet(generate.write_invoice_xlsx, 'invoice.xlsx')),
+    Stage('read_ods', _prepare_spreadsheet(generate.write_invoice_ods, 'invoice.ods')),
+    Stage('compare_pricetable', lambda ctx: lambda: rx.compare_pricetable({}, ctx['read_csv'])),
+    Stage('write_pricetable', lambda ctx: lambda: rx.write_pricetable(
+        ctx['compare_pricetable'], _output_path(ctx, 'pricetable.tsv'))),
+    Stage('read_pricetable', lambda ctx: lambda: rx.read_pricetable(_output_path(ctx, 'pricetable.tsv'))),
+    Stage('read_md', lambda ctx: lambda: fh.read_md(ctx['formulary_path'])),
+    Stage('store_formulary', lambda ctx: lambda: fh.store_formulary(fh.parse_mddata(ctx['read_md']))),
+    Stage('formulary_update_from_pricetable', _prepare_match),
+    Stage('formulary_update_by_category', _prepare_match_by_category),
+    Stage('formulary_to_markdown', lambda ctx: lambda: rx.formulary_to_markdown(
+        _formulary_with_pricetable(ctx), _output_path(ctx, 'formulary_UPDATED.markdown'))),
+    Stage('formulary_to_tsv', lambda ctx: lambda: rx.formulary_to_tsv(
+        _formulary_with_pricetable(ctx), _output_path(ctx, 'formulary_UPDATED.tsv'))),
+]
+
+
+def generate_inputs(size, seed, directory):
+    """Write the synthetic formulary and invoice for a size and return their paths and the invoice items.
+    """
+    spec = SIZES[size]
+    drugs = generate.generate_formulary(spec['drugs'], seed)
+    items = generate.generate_catalog(drugs, spec['items'], seed)
+
+    formulary_path = os.path.join(directory, 'formulary.markdown')
+    invoice_path = os.path.join(directory, 'invoice.csv')
+    generate.write_formulary(drugs, formulary_path)
+    generate.write_invoice(items, spec['rows'], invoice_path, seed)
+
+    return formulary_path, invoice_path, items
+
+
+def measure(fn, repeat):
+    """Return (result, fastest seconds, peak traced memory in KiB) for a callable.
+    """
+    # Pipeline functions print progress; send it nowhere so the terminal does not dominate
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        tracemalloc.start()
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+
+    return result, min(times), peak // 1024
+
+
+def run_size(size, seed=0, repeat=3, stages=STAGES):
+    """Run every stage for one size. Returns {stage name: {'seconds': ..., 'peak_kb': ...}}.
+    """
+    directory = tempfile.mkdtemp(prefix='ehhapp-bench-')
+    results = OrderedDict()
+
+    try:
+        formulary_path, invoice_path, items = generate_inputs(size, seed, directory)
+        ctx = {'dir': directory, 'formulary_path': formulary_path, 'invoice_path': invoice_path,
+               'invoice_bytes': os.path.getsize(invoice_path), 'items': items, 'rows': SIZES[size]['rows'],
+               'seed': seed}
+
+        for stage in stages:
+            if stage.NAME in SIZES[size]['skip']:
+                continue
+
+            result, seconds, peak_kb = measure(stage.PREPARE(ctx), repeat)
+            ctx[stage.NAME] = result
+            results[stage.NAME] = {'seconds': round(seconds, 6), 'peak_kb': peak_kb}
+
+            throughput = ''
+            if stage.NAME in INVOICE_READ_STAGES:
+                results[stage.NAME]['rows_per_s'] = int(ctx['rows'] / seconds)
+                throughput = '{:>12,} rows/s'.format(results[stage.NAME]['rows_per_s'])
+            print('{:<8} {:<34} {:>10.4f} s {:>10} KiB{}'.format(size, stage.NAME, seconds, peak_kb, throughput))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of messages for every stage that regressed beyond the tolerance.
+    """
+    regressions = []
+
+    for size, stages in results.items():
+        for name, current in stages.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous is None:
+                continue
+
+            for metric in ('seconds', 'peak_kb'):
+                if previous[metric] and current[metric] > previous[metric] * (1 + tolerance):
+                    regressions.append('{} {} {}: {} -> {} (+{:.0%})'.format(
+                        size, name, metric, previous[metric], current[metric],
+                        current[metric] / previous[metric] - 1))
+
+    return regressions
+
+
+def unbaselined(results, baseline):
+    """Return (size, stage) for every result that has nothing in the baseline to compare with.
+    """
+    return [(size, name) for size, stages in results.items() for name in stages
+            if name not in baseline.get(size, {})]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the formulary update pipeline on synthetic data.')
+    parser.add_argument('--size', action='append', choices=list(SIZES),
+                        help='data size to run, may be repeated (default: small)')
+    parser.add_argument('--stage', action='append', choices=[stage.NAME for stage in STAGES],
+                        help='stage to run, may be repeated (default: all); stages before it also run')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the data generators')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown or memory growth over the baseline, as a fraction')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline results file')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    args = parser.parse_args(argv)
+
+    # Timings only compare on the machine they were taken on, so no baseline is kept in the repository
+    if not args.save_baseline and not os.path.isfile(args.baseline):
+        parser.error('no baseline at {}; record one on this machine with --save-baseline'.format(args.baseline))
+
+    stages = STAGES
+    if args.stage:
+        # Later stages take their input from earlier ones, so run everything up to the last stage asked for
+        last = max(i for i, stage in enumerate(STAGES) if stage.NAME in args.stage)
+        stages = STAGES[:last + 1]
+
+    results = OrderedDict((size, run_size(size, args.seed, args.repeat, stages)) for size in args.size or ['small'])
+
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    else:
+        baseline = {}
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Baseline saved to {}'.format(args.baseline))
+        return 0
+
+    for size, name in unbaselined(results, baseline):
+        print('SKIPPED {} {}: not in the baseline, run with --save-baseline to add it'.format(size, name))
+
+    regressions = compare(results, baseline, args.tolerance)
+    for message in regressions:
+        print('REGRESSION {}'.format(message))
+    if not regressions:
+        print('No regressions beyond {:.0%} of the baseline'.format(args.tolerance))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+import os
+import re
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import app.rxparse as rx
+import app.workspace as ws
+import app.eventlog as ev
+from benchmarks.loadtest import load_app
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+MATCH_PATT = re.compile(r'name="usermatches" value="(\d+)"')
+
+
+def upload(client):
+    """Upload the fixture formulary and invoice and return the selection page.
+    """
+    with open(os.path.join(FIXTURES, 'formulary.markdown'), 'rb') as formulary, \
+            open(os.path.join(FIXTURES, 'invoice.csv'), 'rb') as invoice:
+        resp = client.post('/selection', data={'file': [(formulary, 'formulary.markdown'), (invoice, 'invoice.csv')]},
+                           content_type='multipart/form-data')
+    return resp.status_code, resp.get_data(as_text=True)
+
+
+class ResultRouteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.client = load_app(self.dir).test_client()
+
+    def tearDown(self):
+        ev.shutdown()
+        shutil.rmtree(self.dir)
+
+    def test_result_without_session_cookies_returns_to_upload_page(self):
+        resp = self.client.post('/result')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'Please upload the files again', resp.get_data())
+
+    def test_result_with_unknown_job_returns_to_upload_page(self):
+        resp = self.client.post('/result', headers={'Cookie': 'job_id={}'.format('0'*32)})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'Please upload the files again', resp.get_data())
+
+
+class UploadFlowTest(unittest.TestCase):
+    """Upload an invoice, select a suggested match and submit it.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.app = load_app(self.dir)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        ev.shutdown()
+        shutil.rmtree(self.dir)
+
+    def test_selected_match_reaches_the_formulary_and_pricetable(self):
+        status, page = upload(self.client)
+        self.assertEqual(status, 200)
+        match_ids = MATCH_PATT.findall(page)
+        self.assertTrue(match_ids)
+
+        job_id = self.client.get_cookie('job_id').value
+        match = rx.read_fuzzymatches(ws.fuzzymatches_path(self.app.config['WORKSPACE_FOLDER'], job_id))[int(match_ids[0])]
+        matches_before = dict(json.loads(self.client.get_cookie('screen_output').decoded_value))['Number of medication matches']
+
+        resp = self.client.post('/result', data={'usermatches': [match_ids[0]]})
+        self.assertEqual(resp.status_code, 200)
+        page = resp.get_data(as_text=True)
+        self.assertIn('Number of medication matches: {}'.format(matches_before + 1), page)
+
+        shared = rx.read_pricetable(os.path.join(self.app.config['PERSISTENT_FOLDER'], 'persistent-pricetable.tsv'))
+        self.assertEqual(shared[match.INV_NAMEDOSE.upper()].ON_FORMULARY, 'True')
+        with open(os.path.join(ws.output_folder(self.app.config['WORKSPACE_FOLDER'], job_id), 'formulary_UPDATED.markdown')) as f:
+            self.assertIn(match.INV_PRICE, f.read())
+
+    def test_selected_match_missing_from_the_pricetable_is_reported(self):
+        status, page = upload(self.client)
+        match_ids = MATCH_PATT.findall(page)
+        job_id = self.client.get_cookie('job_id').value
+        match = rx.read_fuzzymatches(ws.fuzzymatches_path(self.app.config['WORKSPACE_FOLDER'], job_id))[int(match_ids[0])]
+
+        work_path = ws.work_pricetable_path(self.app.config['WORKSPACE_FOLDER'], job_id)
+        pricetable = rx.read_pricetable(work_path)
+        del pricetable[match.INV_NAMEDOSE.upper()]
+        rx.write_pricetable(pricetable, work_path)
+
+        resp = self.client.post('/result', data={'usermatches': [match_ids[0]]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Selected matches no longer in the price table: {}'.format(match.INV_NAMEDOSE),
+                      resp.get_data(as_text=True))
+
+    def test_malformed_match_ids_are_ignored(self):
+        upload(self.client)
+        matches_before = dict(json.loads(self.client.get_cookie('screen_output').decoded_value))['Number of medication matches']
+
+        resp = self.client.post('/result', data={'usermatches': ['\u00b2', '-1', 'x', '99999']})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Number of medication matches: {}'.format(matches_before), resp.get_data(as_text=True))
+
+
+class PriceHistoryRouteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.client = load_app(self.dir).test_client()
+
+    def tearDown(self):
+        ev.shutdown()
+        shutil.rmtree(self.dir)
+
+    def test_unknown_period_is_a_bad_request(self):
+        self.assertEqual(self.client.get('/price-history?drug=72955&period=week').status_code, 400)
+
+    def test_unknown_drug_is_not_found(self):
+        self.assertEqual(self.client.get('/price-history?drug=72955').status_code, 404)
+
+    def test_movers_limit_below_one_is_a_bad_request(self):
+        for limit in (0, -3):
+            resp = self.client.get('/price-history/movers?since=2015-01-01&limit={}'.format(limit))
+            self.assertEqual(resp.status_code, 400)
+        self.assertEqual(self.client.get('/price-history/movers?since=2015-01-01&limit=1').status_code, 200)
+
+
+class LookupRouteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.app = load_app(self.dir)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        ev.shutdown()
+        shutil.rmtree(self.dir)
+
+    def test_failed_load_is_tried_again(self):
+        backup_folder = self.app.config['BACKUP_FOLDER']
+        os.rmdir(backup_folder)
+        self.assertEqual(self.client.get('/lookup?q=trazodone').status_code, 500)
+
+        os.makedirs(backup_folder)
+        shutil.copy(os.path.join(FIXTURES, 'formulary.markdown'), os.path.join(backup_folder, 'formulary.md'))
+        resp = self.client.get('/lookup?q=trazodone')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'Trazodone 50mg', resp.get_data())
+
+    def test_limit_below_one_returns_one_result(self):
+        shutil.copy(os.path.join(FIXTURES, 'formulary.markdown'),
+                    os.path.join(self.app.config['BACKUP_FOLDER'], 'formulary.md'))
+        for limit in (0, -5):
+            resp = self.client.get('/lookup?q=amox&limit={}'.format(limit))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.get_json()['results']), 1)
+
+
+class EventLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ev.shutdown()
+        shutil.rmtree(self.dir)
+
+    def test_unknown_level_fails_on_import(self):
+        with mock.patch.dict(os.environ, {'EVENT_LOG_LEVEL': 'INFOO'}):
+            with self.assertRaisesRegex(ValueError, 'EVENT_LOG_LEVEL'):
+                load_app(self.dir)
+
+    def test_first_request_starts_the_event_log_in_the_log_folder(self):
+        app = load_app(self.dir)
+        self.assertIsNone(ev._listener)
+
+        app.test_client().get('/metrics')
+        self.assertEqual(ev._listener.handlers[0].target.baseFilename,
+                         os.path.join(app.config['LOG_FOLDER'], ev.EVENTS_FILENAME))
+
+
+if __name__ == '__main__':
+    unittest.main()
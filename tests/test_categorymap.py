@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+import app.rxparse as rx
+import app.formularyhelper as fh
+import app.categorymap as cm
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class CategoryMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, cm.CATEGORY_MAP_FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_learned_categories_need_several_matches(self):
+        categorymap = cm.CategoryMap()
+        categorymap._add_learned('diabetic agents', 'DIABETES', cm.MIN_LEARNED_MATCHES)
+        categorymap._add_learned('diabetic agents', 'VITAMINS', cm.MIN_LEARNED_MATCHES - 1)
+        self.assertEqual(categorymap.categories('DIABETIC AGENTS'), {'DIABETES'})
+        self.assertIsNone(categorymap.categories('THYROID'))
+
+    def test_configured_categories_override_learned(self):
+        categorymap = cm.CategoryMap()
+        categorymap._add_learned('ANTICONVULSANTS', 'ANALGESICS', cm.MIN_LEARNED_MATCHES)
+        categorymap.configure('ANTICONVULSANTS', 'PSYCHOTROPICS')
+        self.assertEqual(categorymap.categories('ANTICONVULSANTS'), {'PSYCHOTROPICS'})
+
+    def test_matches_learned_during_a_run_are_used_once_saved(self):
+        categorymap = cm.read_category_map(self.path)
+        categorymap.learn('DIABETIC AGENTS', 'DIABETES', cm.MIN_LEARNED_MATCHES)
+        self.assertIsNone(categorymap.categories('DIABETIC AGENTS'))
+
+        self.assertEqual(cm.save_learned(categorymap, self.path), 1)
+        self.assertEqual(cm.read_category_map(self.path).categories('DIABETIC AGENTS'), {'DIABETES'})
+
+    def test_save_keeps_matches_saved_by_other_jobs(self):
+        job_a = cm.read_category_map(self.path)
+        job_b = cm.read_category_map(self.path)
+        job_a.learn('DIABETIC AGENTS', 'DIABETES', 2)
+        job_b.learn('DIABETIC AGENTS', 'DIABETES', 1)
+        cm.save_learned(job_a, self.path)
+        cm.save_learned(job_b, self.path)
+
+        self.assertEqual(cm.read_category_map(self.path).LEARNED['DIABETIC AGENTS']['DIABETES'], 3)
+
+
+class CategoryMatchingTest(unittest.TestCase):
+    """Match a real invoice against the formulary with category matching off and in 'first' mode.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.map_path = os.path.join(cls.dir, cm.CATEGORY_MAP_FILENAME)
+        cls.markdown = fh.read_md(os.path.join(FIXTURES, 'formulary.markdown'))
+        cls.pricetable = rx.compare_pricetable({}, rx.read_invoice(os.path.join(FIXTURES, 'invoice.csv')))
+
+        # Matches are learned with category matching off, then used by the 'first' run
+        learner = cm.read_category_map(cls.map_path)
+        cls.off = cls.match(learner, cm.MODE_OFF)
+        cm.save_learned(learner, cls.map_path)
+        cls.categorymap = cm.read_category_map(cls.map_path)
+        cls.first = cls.match(cls.categorymap, cm.MODE_FIRST)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    @classmethod
+    def match(cls, categorymap, category_mode):
+        formulary = fh.store_formulary(fh.parse_mddata(cls.markdown))
+        mcount, pricechanges, formulary, pricetable, _, unmatched, fuzzymatches = rx.formulary_update_from_pricetable(
+            formulary, dict(cls.pricetable), categorymap=categorymap, category_mode=category_mode)
+        return {'mcount': mcount,
+                'pricechanges': pricechanges,
+                'markdown': [record._to_markdown() for record in formulary],
+                'tsv': [record._to_csv() for record in formulary],
+                'pricetable': pricetable,
+                'unmatched': unmatched,
+                'fuzzymatches': fuzzymatches}
+
+    def test_commodities_are_mapped(self):
+        self.assertEqual(self.categorymap.categories('ANTICONVULSANTS'), {'ANALGESICS'})
+        self.assertEqual(self.categorymap.categories('DIABETIC AGENTS'), {'DIABETES'})
+        self.assertGreater(self.categorymap.PRUNED, 0)
+
+    def test_first_finds_the_same_matches_as_off(self):
+        for result in ('mcount', 'pricechanges', 'markdown', 'tsv', 'pricetable', 'unmatched'):
+            self.assertEqual(self.first[result], self.off[result], result)
+
+    def test_first_offers_the_same_fuzzy_matches_as_off(self):
+        # Except for lines that already matched a name and dose in their categories:
+        # 'first' does not compare those with the rest of the formulary
+        skipped = ['insulin asp prt/asp 70/30 10ml vial', 'trazodone 50mg tab bottle']
+        offered = dict((k, v) for k, v in self.off['fuzzymatches'].items() if k not in skipped)
+        self.assertEqual(self.first['fuzzymatches'], offered)
+        self.assertEqual(sorted(self.off['fuzzymatches'][k].MD_NAMEDOSE for k in skipped), ['ceftriaxone ', 'multivitamin '])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime
+import app.rxparse as rx
+import app.workspace as ws
+import app.compaction as ct
+import app.eventlog as ev
+from benchmarks.loadtest import load_app
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+MATCH_PATT = re.compile(r'name="usermatches" value="(\d+)"')
+
+
+def row(namedose, cost='$1.00', reqdate=datetime(2015, 1, 1), on_formulary='True', itemnum='10000'):
+    return rx.InvRec(NAMEDOSE=namedose, NAME='NaN', DOSE='NaN', COST=cost, CATEGORY='X', ITEMNUM=itemnum,
+                     ON_FORMULARY=on_formulary, REQDATE=reqdate)
+
+
+class CompactPricetableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shared = os.path.join(self.dir, 'persistent-pricetable.tsv')
+        self.archive = ct.archive_path(self.shared)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_old_rows_are_archived(self):
+        rx.write_pricetable({'OLD': row('OLD', reqdate=datetime(2012, 1, 1)),
+                             'NEW': row('NEW', reqdate=datetime(2015, 1, 1))}, self.shared)
+        report = ct.compact_pricetable(self.shared, max_age_days=730)
+
+        self.assertEqual(report.ROWS_ARCHIVED, 1)
+        self.assertGreater(report.BYTES_RECLAIMED, 0)
+        self.assertEqual(sorted(rx.read_pricetable(self.shared)), ['NEW'])
+        self.assertEqual(sorted(rx.read_pricetable(self.archive)), ['OLD'])
+
+    def test_rows_off_the_formulary_for_several_runs_are_archived(self):
+        rx.write_pricetable({'OFF': row('OFF', on_formulary='False'), 'ON': row('ON')}, self.shared)
+        reports = [ct.compact_pricetable(self.shared, max_age_days=0, max_off_formulary_runs=3) for _ in range(3)]
+
+        self.assertEqual([r.ROWS_ARCHIVED for r in reports], [0, 0, 1])
+        self.assertEqual(sorted(rx.read_pricetable(self.shared)), ['ON'])
+        self.assertEqual(ct.read_runs(ct.runs_path(self.shared)), {})
+
+    def test_restore_by_item_number(self):
+        rx.write_pricetable({'OLD': row('OLD', reqdate=datetime(2012, 1, 1), itemnum='72955'),
+                             'NEW': row('NEW', reqdate=datetime(2015, 1, 1))}, self.shared)
+        ct.compact_pricetable(self.shared)
+
+        restored = ct.restore(self.shared, ['72955'])
+        self.assertEqual([r.NAMEDOSE for r in restored], ['OLD'])
+        self.assertEqual(sorted(rx.read_pricetable(self.shared)), ['NEW', 'OLD'])
+        self.assertEqual(rx.read_pricetable(self.archive), {})
+        self.assertEqual(ct.restore(self.shared, ['72955']), [])
+
+
+class ConcurrentCompactionTest(unittest.TestCase):
+    """One job compacts the shared pricetable after its commit, another job that started before commits after it.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.workspaces = os.path.join(self.dir, 'workspaces')
+        self.shared = os.path.join(self.dir, 'persistent-pricetable.tsv')
+        rx.write_pricetable({'OLD': row('OLD', reqdate=datetime(2012, 1, 1)),
+                             'NEW': row('NEW', reqdate=datetime(2015, 1, 1))}, self.shared)
+        self.job_a = ws.create_workspace(self.workspaces, self.shared)
+        self.job_b = ws.create_workspace(self.workspaces, self.shared)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def update(self, job_id, *rows):
+        path = ws.work_pricetable_path(self.workspaces, job_id)
+        pricetable = rx.read_pricetable(path)
+        pricetable.update((r.NAMEDOSE, r) for r in rows)
+        rx.write_pricetable(pricetable, path)
+
+    def commit_and_compact(self, job_id):
+        ws.commit_pricetable(self.workspaces, job_id, self.shared)
+        return ct.compact_pricetable(self.shared)
+
+    def offer(self, job_id, *namedoses):
+        rx.write_fuzzymatches(dict((k, rx.FuzzyMatch(k.lower(), '$1.00', k, '$1.00', '10000')) for k in namedoses),
+                              ws.fuzzymatches_path(self.workspaces, job_id))
+
+    def test_archived_row_stays_archived(self):
+        # Matching rewrites the ON FORMULARY flag of every row, including the one job A archives
+        self.update(self.job_a, row('A'))
+        self.update(self.job_b, row('B'), row('OLD', reqdate=datetime(2012, 1, 1), on_formulary='False'))
+
+        self.assertEqual(self.commit_and_compact(self.job_a).ROWS_ARCHIVED, 1)
+
+        # Job B saves its matches after job A archived OLD, and offers it for review
+        self.offer(self.job_b, 'OLD')
+        self.assertEqual(self.commit_and_compact(self.job_b).ROWS_ARCHIVED, 0)
+
+        self.assertEqual(sorted(rx.read_pricetable(self.shared)), ['A', 'B', 'NEW'])
+        self.assertEqual(sorted(rx.read_pricetable(ct.archive_path(self.shared))), ['OLD'])
+        self.assertIn('OLD', rx.read_pricetable(ws.work_pricetable_path(self.workspaces, self.job_b)))
+
+    def test_rows_offered_by_jobs_in_flight_are_not_archived(self):
+        self.offer(self.job_b, 'OLD')
+        ws.commit_pricetable(self.workspaces, self.job_a, self.shared)
+        report = ct.compact_pricetable(self.shared, keep=ws.live_offered_namedoses(self.workspaces))
+
+        self.assertEqual(report.ROWS_ARCHIVED, 0)
+        self.assertEqual(sorted(rx.read_pricetable(self.shared)), ['NEW', 'OLD'])
+
+    def test_archived_row_with_a_new_price_is_hot_again(self):
+        self.update(self.job_b, row('OLD', '$2.00', datetime(2015, 2, 1)))
+
+        self.commit_and_compact(self.job_a)
+        report = self.commit_and_compact(self.job_b)
+
+        self.assertEqual(rx.read_pricetable(self.shared)['OLD'].COST, '$2.00')
+        self.assertEqual(report.ROWS_COLD, 0)
+        self.assertEqual(rx.read_pricetable(ct.archive_path(self.shared)), {})
+
+
+class CompactionDuringReviewTest(unittest.TestCase):
+    """A job archives rows that another job is offering for review on its selection page.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.app = load_app(self.dir)
+        self.shared = os.path.join(self.app.config['PERSISTENT_FOLDER'], 'persistent-pricetable.tsv')
+
+    def tearDown(self):
+        ev.shutdown()
+        shutil.rmtree(self.dir)
+
+    def upload(self, client, formulary_path=os.path.join(FIXTURES, 'formulary.markdown')):
+        with open(formulary_path, 'rb') as formulary, open(os.path.join(FIXTURES, 'invoice.csv'), 'rb') as invoice:
+            resp = client.post('/selection', data={'file': [(formulary, 'formulary.markdown'), (invoice, 'invoice.csv')]},
+                               content_type='multipart/form-data')
+        self.assertEqual(resp.status_code, 200)
+        job_id = client.get_cookie('job_id').value
+        return job_id, MATCH_PATT.findall(resp.get_data(as_text=True))
+
+    def test_archived_row_stays_archived(self):
+        self.upload(self.app.test_client())  # Fills the shared pricetable
+
+        # Job A archives every row off the formulary between job B's snapshot and job B's commit
+        commit_pricetable = ws.commit_pricetable
+        def commit_after_compaction(*args):
+            ct.compact_pricetable(self.shared, max_age_days=0, max_off_formulary_runs=1)
+            return commit_pricetable(*args)
+
+        client = self.app.test_client()
+        with mock.patch.object(ws, 'commit_pricetable', side_effect=commit_after_compaction):
+            job_id, match_ids = self.upload(client)
+        matchlist = rx.read_fuzzymatches(ws.fuzzymatches_path(self.app.config['WORKSPACE_FOLDER'], job_id))
+        offered = set(m.INV_NAMEDOSE.upper() for m in matchlist)
+        archived = set(rx.read_pricetable(ct.archive_path(self.shared)))
+        self.assertTrue(offered & archived)
+
+        # Job B still has the archived rows it offers, and can submit a match on them
+        work_path = ws.work_pricetable_path(self.app.config['WORKSPACE_FOLDER'], job_id)
+        self.assertLessEqual(offered, set(rx.read_pricetable(work_path)))
+        selected = [i for i in match_ids if matchlist[int(i)].INV_NAMEDOSE.upper() in archived]
+        resp = client.post('/result', data={'usermatches': selected})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('no longer in the price table', resp.get_data(as_text=True))
+
+        # Job B's commits did not bring the archived rows back
+        self.assertFalse(archived & set(rx.read_pricetable(self.shared)))
+        self.assertEqual(set(rx.read_pricetable(ct.archive_path(self.shared))), archived)
+
+    def test_rows_offered_for_review_are_not_archived(self):
+        job_id, _ = self.upload(self.app.test_client())
+        offered = ws.offered_namedoses(ws.fuzzymatches_path(self.app.config['WORKSPACE_FOLDER'], job_id))
+
+        # Another upload against a formulary that offers no matches makes every row off the formulary cold
+        formulary_path = os.path.join(self.dir, 'formulary.markdown')
+        with open(formulary_path, 'w') as f:
+            f.write('* ANALGESICS\n> Acetaminophen | $0.01 (325mg) | \n')
+        self.app.config['PRICETABLE_MAX_OFF_FORMULARY_RUNS'] = 1
+        other_job_id, match_ids = self.upload(self.app.test_client(), formulary_path)
+        self.assertEqual(match_ids, [])
+
+        self.assertTrue(rx.read_pricetable(ct.archive_path(self.shared)))
+        self.assertLessEqual(offered, set(rx.read_pricetable(self.shared)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import unittest
+import app.druglookup as dl
+
+FORMULARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'formulary.markdown')
+
+
+def entry(namedose, source='pricetable', cost='$1.00', on_formulary='True'):
+    return dl.LookupEntry(SOURCE=source, NAMEDOSE=namedose, NAME='NaN', DOSE='NaN', COST=cost, CATEGORY='X',
+                          ON_FORMULARY=on_formulary, BLACKLISTED='NaN')
+
+
+class DrugIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = dl.DrugIndex()
+        self.index.update_source('formulary', dl.formulary_entries(FORMULARY_PATH))
+
+    def search(self, query, limit=10):
+        return [e.NAMEDOSE for _, e in self.index.search(query, limit)]
+
+    def test_prefixes_of_every_word_match(self):
+        self.assertEqual(self.search('amox 500', 1), ['Amoxicillin 500mg'])
+        self.assertEqual(self.search('glimep 4', 1), ['Glimepiride 4mg'])
+
+    def test_misspellings_match_by_trigrams(self):
+        self.assertIn('Amoxicillin 500mg', self.search('amoxicilin', 3))
+
+    def test_common_dose_trigrams_do_not_add_fuzzy_matches(self):
+        self.index.update_source('pricetable', [entry('ZINC 20MG')] + [entry('DRUG{:03d} 20MG'.format(i)) for i in range(200)])
+        results = self.search('zinx 20mg', 50)
+        self.assertEqual(results[0], 'ZINC 20MG')
+        self.assertFalse([r for r in results if r.startswith('DRUG')])
+        self.assertEqual(len(self.search('20mg', 5)), 5)
+
+    def test_blank_query_matches_nothing(self):
+        self.assertEqual(self.index.search(' '), [])
+
+    def test_update_source_reindexes_only_changes(self):
+        self.assertEqual(self.index.update_source('pricetable', [entry('QUUXOLOL 5MG'), entry('ZINC 50MG')]), 2)
+        self.assertEqual(self.index.update_source('pricetable', [entry('QUUXOLOL 5MG', cost='$2.00'),
+                                                                 entry('ZINC 50MG')]), 2)
+        self.assertEqual(self.index.update_source('pricetable', [entry('ZINC 50MG')]), 1)
+
+        self.assertNotIn('QUUXOLOL 5MG', self.search('quuxolol'))
+        self.assertEqual(self.search('zinc', 1), ['ZINC 50MG'])
+        self.assertIn('Trazodone 50mg', self.search('trazodone'))
+
+
+if __name__ == '__main__':
+    unittest.main()
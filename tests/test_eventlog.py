@@ -0,0 +1,58 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+import app.eventlog as ev
+
+log = ev.get_logger('test')
+
+
+def read_lines(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f]
+
+
+class EventLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ev.shutdown()
+        ev.clear_context()
+        shutil.rmtree(self.dir)
+
+    def test_events_at_or_above_the_level_are_written_with_context(self):
+        ev.configure(self.dir, logging.INFO)
+        ev.set_context(job_id='abc')
+        ev.event(log, logging.DEBUG, 'drug_parsed', namedose='A 5MG')
+        ev.event(log, logging.INFO, 'pricetable_updated', entries=3)
+        ev.shutdown()
+
+        lines = read_lines(os.path.join(self.dir, ev.EVENTS_FILENAME))
+        self.assertEqual([(l['event'], l['job_id'], l['entries']) for l in lines], [('pricetable_updated', 'abc', 3)])
+
+    def test_price_changes_are_audited_whatever_the_level(self):
+        ev.configure(self.dir, logging.ERROR)
+        ev.event(ev.audit, logging.INFO, 'price_change', namedose='A 5MG', old='$1.00', new='$1.10')
+        ev.shutdown()
+
+        self.assertEqual([l['new'] for l in read_lines(os.path.join(self.dir, ev.AUDIT_FILENAME))], ['$1.10'])
+        self.assertFalse(os.path.exists(os.path.join(self.dir, ev.EVENTS_FILENAME)))
+
+    def test_concurrent_configure_starts_one_listener(self):
+        threads = [threading.Thread(target=ev.configure, args=(self.dir,)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        handlers = [h for h in logging.getLogger(ev.ROOT_LOGGER).handlers if isinstance(h, ev._LazyQueueHandler)]
+        self.assertEqual(len(handlers), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
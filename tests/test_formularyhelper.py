@@ -0,0 +1,32 @@
+import unittest
+import app.formularyhelper as fh
+
+
+class CostTest(unittest.TestCase):
+
+    def test_cost_to_cents_rounds_fractions_of_a_cent(self):
+        self.assertEqual(fh.cost_to_cents('$1,071.59'), 107159)
+        self.assertEqual(fh.cost_to_cents('$0.0149'), 1)
+        self.assertEqual(fh.cost_to_cents('$0.005'), 1)
+        self.assertIsNone(fh.cost_to_cents('NaN'))
+
+    def test_cost_to_subcents_keeps_fractions_of_a_cent(self):
+        self.assertEqual(fh.cost_to_subcents('$0.0125'), 125)
+        self.assertEqual(fh.cost_to_subcents('$.5'), 5000)
+        self.assertEqual(fh.cost_to_subcents('$0.01255'), 126)
+
+    def test_price_differs_below_a_cent(self):
+        self.assertTrue(fh.price_differs('$0.0125', '$0.0149'))
+        self.assertFalse(fh.price_differs('$0.0125', '$0.01250'))
+        self.assertFalse(fh.price_differs('$0.5', '$0.50'))
+        self.assertTrue(fh.price_differs('call', 'NaN'))
+
+    def test_subcents_to_cost(self):
+        self.assertEqual(fh.subcents_to_cost(28800, 31600), '$2.88-$3.16')
+        self.assertEqual(fh.subcents_to_cost(125), '$0.0125')
+        self.assertEqual(fh.subcents_to_cost(1490), '$0.149')
+        self.assertEqual(fh.subcents_to_cost(0), '$0.00')
+
+
+if __name__ == '__main__':
+    unittest.main()
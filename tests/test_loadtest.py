@@ -0,0 +1,79 @@
+import os
+import html
+import shutil
+import tempfile
+import unittest
+import app.rxparse as rx
+import app.workspace as ws
+import app.eventlog as ev
+from benchmarks import loadtest
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class SelectionPageTest(unittest.TestCase):
+    """The streamed selection page and its extra batches offer every saved match once, by position.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.app = loadtest.load_app(self.dir)
+        self.app.config['MATCH_PAGE_SIZE'] = 2
+        self.session = loadtest.TestClientSession(self.app)
+
+    def tearDown(self):
+        ev.shutdown()
+        shutil.rmtree(self.dir)
+
+    def test_match_ids_are_positions_in_fuzzymatches_json(self):
+        with open(os.path.join(FIXTURES, 'formulary.markdown'), 'rb') as f:
+            formulary = f.read()
+        with open(os.path.join(FIXTURES, 'invoice.csv'), 'rb') as f:
+            invoice = f.read()
+        status, _, page = self.session.request('POST', '/selection',
+                                               files=[('formulary.markdown', formulary), ('invoice.csv', invoice)])
+        self.assertEqual(status, 200)
+
+        job_id = self.session.CLIENT.get_cookie('job_id').value
+        matchlist = rx.read_fuzzymatches(ws.fuzzymatches_path(self.app.config['WORKSPACE_FOLDER'], job_id))
+        self.assertGreater(len(matchlist), 2)
+        pages = [page]
+        offset = len(loadtest._MATCHPATT_.findall(page))
+        while offset < len(matchlist):
+            status, headers, fragment = self.session.request('GET', '/selection/matches?offset={}'.format(offset))
+            self.assertEqual(status, 200)
+            pages.append(fragment)
+            offset = int(headers['X-Next-Offset'])
+
+        match_ids = [int(i) for p in pages for i in loadtest._MATCHPATT_.findall(p)]
+        self.assertEqual(match_ids, list(range(len(matchlist))))
+        text = html.unescape(''.join(pages))
+        for m in matchlist:
+            self.assertIn('"{}" is "{}"'.format(m.INV_NAMEDOSE, m.MD_NAMEDOSE), text)
+
+
+class RunLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ev.shutdown()
+        shutil.rmtree(self.dir)
+
+    def test_sessions_run_without_errors(self):
+        app = loadtest.load_app(os.path.join(self.dir, 'app'))
+        summary = loadtest.run_load(lambda: loadtest.TestClientSession(app), 'small', 2, 2, 0, self.dir)
+
+        self.assertEqual(summary['POST /selection']['requests'], 2)
+        self.assertEqual(summary['POST /result']['requests'], 2)
+        self.assertEqual(sum(s['errors'] for route, s in summary.items() if route != 'sessions'), 0)
+
+    def test_percentile_is_nearest_rank(self):
+        self.assertEqual(loadtest.percentile([4, 1, 3, 2], 50), 2)
+        self.assertEqual(loadtest.percentile([4, 1, 3, 2], 99), 4)
+        self.assertIsNone(loadtest.percentile([], 50))
+
+
+if __name__ == '__main__':
+    unittest.main()
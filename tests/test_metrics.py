@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+import app.formularyhelper as fh
+import app.rxparse as rx
+import app.metrics as mt
+
+
+class RequestTimingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = mt.begin_request()
+
+    def tearDown(self):
+        mt.end_request()
+
+    def test_stages_and_counts_are_collected_for_the_request(self):
+        with mt.stage('read_invoice', rows_in=3) as s:
+            s.ROWS_OUT = 2
+        mt.inc('formulary_fuzzy_comparisons_total', 5)
+
+        self.assertEqual([(t.STAGE, t.ROWS_IN, t.ROWS_OUT) for t in self.timings.STAGES], [('read_invoice', 3, 2)])
+        self.assertEqual(self.timings.COUNTS, {('formulary_fuzzy_comparisons_total', ()): 5})
+
+    def test_dose_comparisons_count_every_formulary_dose_per_invoice_medication(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'formulary.markdown')
+            with open(path, 'w') as f:
+                f.write('* VITAMINS\n> Zinc | $0.01 (50mg), $0.02 (100mg) | \n> Iron | $0.03 (325mg) | \n')
+            formulary = fh.store_formulary(fh.parse_mddata(fh.read_md(path)))
+        finally:
+            shutil.rmtree(directory)
+        pricetable = dict((nd, fh.InvRec(nd, 'NaN', 'NaN', '$0.01', 'VITAMINS', '10000', 'NaN', 'NaN'))
+                          for nd in ('ZINC SULFATE 50MG TAB', 'QUUXOLOL 5MG TAB'))
+        rx.formulary_update_from_pricetable(formulary, pricetable)
+
+        self.assertEqual(self.timings.COUNTS[('formulary_dose_comparisons_total', ())], 2*3)
+
+    def test_snapshot_counts_cache_use_and_keeps_collecting(self):
+        fh.parse_cost('$123.45-$678.91')
+        fh.parse_cost('$123.45-$678.91')
+        snapshot = self.timings.snapshot()
+        with mt.stage('write_pricetable'):
+            pass
+
+        self.assertGreaterEqual(snapshot.COUNTS[('formulary_cache_hits_total', (('cache', 'parse_cost'),))], 1)
+        self.assertEqual(len(snapshot.STAGES), 0)
+        self.assertEqual(len(self.timings.STAGES), 1)
+        self.assertIs(mt.current_request(), self.timings)
+
+    def test_timings_file_round_trip(self):
+        with mt.stage('read_invoice', rows_in=3) as s:
+            s.ROWS_OUT = 2
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'timings.json')
+            mt.write_timings(self.timings.snapshot(), path)
+            self.assertEqual(mt.read_timings(path).breakdown(), self.timings.snapshot().breakdown())
+            self.assertIsNone(mt.read_timings(os.path.join(directory, 'missing.json')))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_end_request_stops_collecting(self):
+        self.assertIs(mt.end_request(), self.timings)
+        self.assertIsNone(mt.current_request())
+        self.assertIsNone(mt.end_request())
+
+
+class RenderPrometheusTest(unittest.TestCase):
+
+    def test_counters_with_labels(self):
+        mt.inc('formulary_bytes_read_total', 10, file='te"st')
+        text = mt.render_prometheus()
+
+        self.assertIn('# TYPE formulary_bytes_read_total counter\n', text)
+        self.assertIn('formulary_bytes_read_total{file="te\\"st"} 10.0\n', text)
+        self.assertIn('formulary_cache_hits_total{cache="parse_cost"}', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+import app.rxparse as rx
+import app.pricehistory as ph
+
+
+def row(namedose, cost, reqdate, itemnum='10000'):
+    return rx.InvRec(NAMEDOSE=namedose, NAME='NaN', DOSE='NaN', COST=cost, CATEGORY='X', ITEMNUM=itemnum,
+                     ON_FORMULARY='NaN', REQDATE=reqdate)
+
+
+class PriceHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'price-history.bin')
+
+    def tearDown(self):
+        ph._histories.pop(self.path, None)
+        shutil.rmtree(self.dir)
+
+    def test_append_skips_prices_already_recorded(self):
+        records = [row('A 5MG', '$1.00', datetime(2015, 1, 1)), row('A 5MG', '$1.20', datetime(2015, 2, 1))]
+        self.assertEqual(ph.append_records(self.path, records), 2)
+        self.assertEqual(ph.append_records(self.path, records), 0)
+
+        history = ph.PriceHistory(self.path)
+        history._refresh()
+        self.assertEqual(history.history(history.keyids('A 5MG')[0]),
+                         [(ph.to_epoch(datetime(2015, 1, 1)), 100), (ph.to_epoch(datetime(2015, 2, 1)), 120)])
+
+    def test_keyids_by_item_number(self):
+        ph.append_records(self.path, [row('A 5MG', '$1.00', datetime(2015, 1, 1), itemnum='72955')])
+        history = ph.load_history(self.path)
+        self.assertEqual([history.KEYS[k] for k in history.keyids('72955')], ['A 5MG'])
+
+    def test_concurrent_appends_record_each_price_once(self):
+        records = [row('D{} 5MG'.format(i), '$1.{:02d}'.format(i), datetime(2015, 1, 1)) for i in range(50)]
+        threads = [threading.Thread(target=ph.append_records, args=(self.path, records)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(os.path.getsize(self.path), 50*ph.RECORD.size)
+        self.assertEqual(len(ph.load_history(self.path).KEYID), 50)
+
+    def test_concurrent_refreshes_read_each_record_once(self):
+        history = ph.load_history(self.path)
+
+        # Another process appends, then several request threads refresh the shared history at once
+        records = [row('D{} 5MG'.format(i), '$1.00', datetime(2015, 1, 1 + i % 28)) for i in range(20000)]
+        ph.PriceHistory(self.path).append(records)
+        threads = [threading.Thread(target=ph.load_history, args=(self.path,)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(history.KEYS), 20000)
+        self.assertEqual(len(history.KEYID), 20000)
+
+    def test_queries_wait_for_a_key_being_added(self):
+        ph.append_records(self.path, [row('A 5MG', '$1.00', datetime(2015, 1, 1)),
+                                      row('A 5MG', '$2.00', datetime(2015, 6, 1))])
+        history = ph.load_history(self.path)
+        since = ph.to_epoch(datetime(2015, 1, 1))
+        movers = []
+        query = threading.Thread(target=lambda: movers.extend(history.top_movers(since)))
+
+        # Stop an append halfway through _add_key, with ROWS grown but not ROWEPOCHS
+        with history._lock:
+            history.ROWS.append(ph.array('i'))
+            query.start()
+            query.join(0.2)
+            self.assertTrue(query.is_alive())
+            history.KEYS.append('B 5MG')
+            history.ITEMNUMS.append('20000')
+            history.ROWEPOCHS.append(ph.array('q'))
+        query.join()
+
+        self.assertEqual([m['namedose'] for m in movers], ['A 5MG'])
+
+    def test_period_deltas(self):
+        ph.append_records(self.path, [row('A 5MG', '$1.00', datetime(2015, 1, 1)),
+                                      row('A 5MG', '$1.50', datetime(2015, 1, 20)),
+                                      row('A 5MG', '$2.00', datetime(2015, 3, 1))])
+        history = ph.load_history(self.path)
+        keyid = history.keyids('A 5MG')[0]
+
+        self.assertEqual(history.period_deltas(keyid, 'month'),
+                         [{'period': '2015-01', 'cents': 150, 'change_cents': None},
+                          {'period': '2015-03', 'cents': 200, 'change_cents': 50}])
+        self.assertEqual(history.period_deltas(keyid, 'year'),
+                         [{'period': '2015', 'cents': 200, 'change_cents': None}])
+        with self.assertRaises(ValueError):
+            history.period_deltas(keyid, 'week')
+
+    def test_top_movers(self):
+        ph.append_records(self.path, [row('A 5MG', '$1.00', datetime(2015, 1, 1)),
+                                      row('A 5MG', '$2.00', datetime(2015, 6, 1)),
+                                      row('B 5MG', '$1.00', datetime(2015, 1, 1)),
+                                      row('B 5MG', '$1.10', datetime(2015, 6, 1))])
+        movers = ph.load_history(self.path).top_movers(ph.to_epoch(datetime(2015, 1, 1)))
+        self.assertEqual([m['namedose'] for m in movers], ['A 5MG', 'B 5MG'])
+        self.assertEqual(movers[0]['change_percent'], 100.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
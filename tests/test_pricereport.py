@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+import app.pricereport as pr
+
+
+def columns(*pairs):
+    cols = pr.PriceColumns()
+    for i, (old, new) in enumerate(pairs):
+        cols.add('Drug{} 5mg'.format(i), old, 'DRUG{} 5MG TAB'.format(i), new, str(10000 + i))
+    return cols
+
+
+class PriceChangeReportTest(unittest.TestCase):
+
+    def test_unparsable_prices_are_skipped(self):
+        cols = columns(('$1.00', '$1.10'), ('NaN', '$1.00'), ('$1.00', 'call'))
+        self.assertEqual(len(cols), 1)
+
+    def test_unchanged_prices_are_left_out(self):
+        report = pr.price_change_report(columns(('$0.5', '$0.50'), ('$1.00', '$1.05')))
+        self.assertEqual([r.MD_NAMEDOSE for r in report], ['Drug1 5mg'])
+
+    def test_changes_sorted_largest_percentage_first(self):
+        report = pr.price_change_report(columns(('$1.00', '$1.05'), ('$0.10', '$0.20'), ('$2.00', '$1.00')))
+        self.assertEqual([r.CHANGE_PERCENT for r in report], [100.0, -50.0, 5.0])
+        self.assertEqual([r.CHANGE_SUBCENTS for r in report], [1000, -10000, 500])
+
+    def test_range_change_is_taken_at_the_end_that_moved_most(self):
+        report = pr.price_change_report(columns(('$2.88-$3.16', '$2.90-$4.00')))
+        self.assertEqual(report[0].CHANGE_SUBCENTS, 8400)
+        self.assertAlmostEqual(report[0].CHANGE_PERCENT, 100.0*84/316)
+
+    def test_changes_below_a_cent_are_reported(self):
+        report = pr.price_change_report(columns(('$0.0125', '$0.0149'), ('$0.0125', '$0.0125')))
+        self.assertEqual([r.MD_NAMEDOSE for r in report], ['Drug0 5mg'])
+        self.assertEqual(report[0].CHANGE_SUBCENTS, 24)
+        self.assertAlmostEqual(report[0].CHANGE_PERCENT, 19.2)
+
+    def test_change_from_zero_counts_as_whole_price(self):
+        report = pr.price_change_report(columns(('$0.00', '$0.25')))
+        self.assertEqual(report[0].CHANGE_PERCENT, 100.0)
+
+    def test_significance_threshold(self):
+        report = pr.price_change_report(columns(('$1.00', '$1.10'), ('$1.00', '$1.09')), significance_percent=10)
+        self.assertEqual([r.SIGNIFICANT for r in report], [True, False])
+        self.assertEqual(pr.significant_count(report), 1)
+
+
+class ReportFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, pr.PRICE_REPORT_FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_report_reads_back_into_columns(self):
+        report = pr.price_change_report(columns(('$2.88-$3.16', '$3.00'), ('$1.00', '$0.90')))
+        pr.write_report(report, self.path)
+
+        cols = pr.read_report_columns(self.path)
+        cols.add('Added 5mg', '$1.00', 'ADDED 5MG TAB', '$2.00', '20000')
+        self.assertEqual(pr.price_change_report(cols)[1:], report)
+
+    def test_prices_below_a_cent_read_back_unrounded(self):
+        report = pr.price_change_report(columns(('$0.0125', '$0.0149')))
+        pr.write_report(report, self.path)
+
+        with open(self.path) as f:
+            self.assertEqual(f.read().splitlines()[1].split('\t')[3:6], ['$0.0125', '$0.0149', '$0.0024'])
+        self.assertEqual(pr.price_change_report(pr.read_report_columns(self.path)), report)
+
+    def test_missing_report_reads_as_no_columns(self):
+        self.assertEqual(len(pr.read_report_columns(self.path)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+import app.rxparse as rx
+import app.formularyhelper as fh
+
+
+class ScreenOutputRowTest(unittest.TestCase):
+
+    def test_rows_are_found_by_label(self):
+        screen_output = [['Number of invoice entries', 10], ['Number of medication matches', 3]]
+        rx.screen_output_row(screen_output, 'Number of medication matches')[1] += 2
+        self.assertEqual(screen_output[1], ['Number of medication matches', 5])
+
+    def test_unknown_label(self):
+        with self.assertRaises(KeyError):
+            rx.screen_output_row([], 'Number of medication matches')
+
+
+class FuzzyMatchesFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'fuzzymatches.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_written_list_is_the_list_read_back(self):
+        fuzzymatches = {inv: rx.FuzzyMatch(md, '$1.00', inv, '$1.10', itemnum)
+                        for md, inv, itemnum in (('Zinc 50mg', 'ZINC SULFATE 50MG TAB', '20000'),
+                                                 ('Amoxicillin 500mg', 'AMOXICILLIN 500MG CAP', '10000'))}
+        matchlist = rx.write_fuzzymatches(fuzzymatches, self.path)
+
+        self.assertEqual([m.INV_NAMEDOSE for m in matchlist], ['AMOXICILLIN 500MG CAP', 'ZINC SULFATE 50MG TAB'])
+        self.assertEqual(rx.read_fuzzymatches(self.path), matchlist)
+
+
+class UserMatchesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'formulary.markdown')
+        with open(path, 'w') as f:
+            f.write('* VITAMINS\n> Zinc | $0.0125 (50mg) | \n')
+        self.formulary = fh.store_formulary(fh.parse_mddata(fh.read_md(path)))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_price_change_below_a_cent_updates_the_formulary(self):
+        pricetable = {'ZINC SULFATE 50MG TAB': rx.InvRec('ZINC SULFATE 50MG TAB', 'NaN', 'NaN', '$0.0149', 'VITAMINS',
+                                                         '10000', 'False', 'NaN')}
+        match = rx.FuzzyMatch('Zinc 50mg', '$0.0125', 'ZINC SULFATE 50MG TAB', '$0.0149', '10000')
+        _, formulary, mcount, pricechanges, _ = rx.formulary_update_from_usermatches(self.formulary, pricetable, set(), [match])
+
+        self.assertEqual((mcount, pricechanges), (1, 1))
+        self.assertEqual(formulary[0].PRICETABLE['Zinc 50mg'].COST, '$0.0149')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+import app.rxparse as rx
+import app.spreadsheet as ss
+from benchmarks import generate
+
+XLS_INVOICE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'app', 'input', 'pharmteam', 'ehop jan jun 2015.xls')
+
+
+class SpreadsheetInvoiceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.items = generate.generate_catalog(generate.generate_formulary(20), 30)
+        cls.csv_path = os.path.join(cls.dir, 'invoice.csv')
+        generate.write_invoice(cls.items, 200, cls.csv_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def test_xlsx_reads_like_the_csv_export(self):
+        path = os.path.join(self.dir, 'invoice.xlsx')
+        generate.write_invoice_xlsx(self.items, 200, path)
+        self.assertEqual(rx.read_invoice(path), rx.read_invoice(self.csv_path))
+
+    def test_ods_reads_like_the_csv_export(self):
+        path = os.path.join(self.dir, 'invoice.ods')
+        generate.write_invoice_ods(self.items, 200, path)
+        self.assertEqual(rx.read_invoice(path), rx.read_invoice(self.csv_path))
+
+    def test_non_drug_lines_are_filtered(self):
+        self.assertEqual(len(rx.read_invoice(self.csv_path)), 180)
+
+    def test_xls(self):
+        if ss.xlrd is None:
+            self.skipTest('xlrd is not installed')
+        rows = rx.read_invoice(XLS_INVOICE_PATH)
+        self.assertTrue(rows)
+        self.assertTrue(all(row[15].startswith('$') for row in rows))
+
+
+class CellValueTest(unittest.TestCase):
+
+    def test_values_are_written_like_a_csv_export(self):
+        row = ['Location', 72955.0, 1.5, datetime(2015, 1, 6, 12, 45), True] + [''] * 10 + [1071.59]
+        self.assertEqual(rx.spreadsheet_row_to_strings(row),
+                         ['Location', '72955', '1.5', '1/6/15 12:45', 'TRUE'] + [''] * 10 + ['$1,071.59'])
+
+    def test_spreadsheet_extensions(self):
+        self.assertTrue(ss.is_spreadsheet('invoice.XLSX'))
+        self.assertFalse(ss.is_spreadsheet('invoice.csv'))
+        with self.assertRaises(ValueError):
+            ss.iter_rows('invoice.csv')
+
+
+if __name__ == '__main__':
+    unittest.main()
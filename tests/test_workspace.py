@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+import app.rxparse as rx
+import app.workspace as ws
+
+
+def row(namedose, cost='$1.00', reqdate=datetime(2015, 1, 1), on_formulary='True'):
+    return rx.InvRec(NAMEDOSE=namedose, NAME='NaN', DOSE='NaN', COST=cost, CATEGORY='X', ITEMNUM='10000',
+                     ON_FORMULARY=on_formulary, REQDATE=reqdate)
+
+
+class MergePricetableTest(unittest.TestCase):
+
+    def test_unchanged_rows_keep_shared_value(self):
+        base = {'A': row('A')}
+        theirs = {'A': row('A', '$2.00', datetime(2015, 2, 1))}
+        merged, conflicts = ws.merge_pricetable(base, dict(base), theirs)
+        self.assertEqual(merged, theirs)
+        self.assertEqual(conflicts, 0)
+
+    def test_rows_only_the_job_changed_take_the_job_value(self):
+        base = {'A': row('A')}
+        ours = {'A': row('A', '$2.00', datetime(2015, 2, 1)), 'B': row('B')}
+        merged, conflicts = ws.merge_pricetable(base, ours, dict(base))
+        self.assertEqual(merged, ours)
+        self.assertEqual(conflicts, 0)
+
+    def test_conflict_keeps_most_recent_reqdate(self):
+        base = {'A': row('A')}
+        ours = {'A': row('A', '$2.00', datetime(2015, 2, 1))}
+        theirs = {'A': row('A', '$3.00', datetime(2015, 3, 1))}
+        merged, conflicts = ws.merge_pricetable(base, ours, theirs)
+        self.assertEqual(merged['A'].COST, '$3.00')
+        self.assertEqual(conflicts, 1)
+
+    def test_same_change_on_both_sides_is_not_a_conflict(self):
+        base = {'A': row('A')}
+        changed = row('A', '$2.00', datetime(2015, 2, 1))
+        merged, conflicts = ws.merge_pricetable(base, {'A': changed}, {'A': changed})
+        self.assertEqual(merged, {'A': changed})
+        self.assertEqual(conflicts, 0)
+
+    def test_rows_deleted_from_shared_stay_deleted(self):
+        base = {'A': row('A'), 'B': row('B')}
+        ours = {'A': row('A', on_formulary='False'), 'B': row('B')}
+        merged, conflicts = ws.merge_pricetable(base, ours, {'B': row('B')})
+        self.assertNotIn('A', merged)
+        self.assertEqual(conflicts, 0)
+
+    def test_rows_deleted_from_shared_come_back_with_a_new_price(self):
+        base = {'A': row('A')}
+        ours = {'A': row('A', '$2.00', datetime(2015, 2, 1))}
+        merged, _ = ws.merge_pricetable(base, ours, {})
+        self.assertEqual(merged, ours)
+
+
+class CommitPricetableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.workspaces = os.path.join(self.dir, 'workspaces')
+        self.shared = os.path.join(self.dir, 'persistent-pricetable.tsv')
+        rx.write_pricetable({'A': row('A')}, self.shared)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_concurrent_jobs_both_reach_the_shared_pricetable(self):
+        job_a = ws.create_workspace(self.workspaces, self.shared)
+        job_b = ws.create_workspace(self.workspaces, self.shared)
+
+        for job_id, namedose in ((job_a, 'B'), (job_b, 'C')):
+            path = ws.work_pricetable_path(self.workspaces, job_id)
+            pricetable = rx.read_pricetable(path)
+            pricetable[namedose] = row(namedose)
+            rx.write_pricetable(pricetable, path)
+
+        self.assertEqual(ws.commit_pricetable(self.workspaces, job_a, self.shared), 0)
+        self.assertEqual(ws.commit_pricetable(self.workspaces, job_b, self.shared), 0)
+        self.assertEqual(sorted(rx.read_pricetable(self.shared)), ['A', 'B', 'C'])
+
+    def test_rows_offered_for_review_stay_in_the_job_after_they_leave_the_shared_pricetable(self):
+        job_id = ws.create_workspace(self.workspaces, self.shared)
+        rx.write_fuzzymatches({'A': rx.FuzzyMatch('a 1mg', '$1.00', 'A', '$1.00', '10000')},
+                              ws.fuzzymatches_path(self.workspaces, job_id))
+        rx.write_pricetable({}, self.shared)  # Another job archived A
+
+        ws.commit_pricetable(self.workspaces, job_id, self.shared)
+        self.assertEqual(rx.read_pricetable(self.shared), {})
+        self.assertEqual(sorted(rx.read_pricetable(ws.work_pricetable_path(self.workspaces, job_id))), ['A'])
+
+        # The kept row is part of the job's base as well, so the next commit does not bring it back
+        ws.commit_pricetable(self.workspaces, job_id, self.shared)
+        self.assertEqual(rx.read_pricetable(self.shared), {})
+
+    def test_rejects_malformed_job_ids(self):
+        with self.assertRaises(ValueError):
+            ws.workspace_path(self.workspaces, '../etc')
+
+
+if __name__ == '__main__':
+    unittest.main()